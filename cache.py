@@ -0,0 +1,175 @@
+import os
+import shutil
+import pickle
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+##############
+# Disk Cache #
+##############
+# Placeholders left in the pickled skeleton of a cached object,
+# pointing to where its arrays were stored.
+class _ArrayRef:
+    def __init__(self, idx):
+        self.idx = idx
+
+class _FrameRef:
+    def __init__(self, columns, refs, index):
+        self.columns = columns
+        self.refs = refs
+        self.index = index
+
+# Objects that provide _cache_state() and _from_cache_state(state),
+# such as data.Scan, are stored as their state.
+class _ObjectRef:
+    def __init__(self, cls, state):
+        self.cls = cls
+        self.state = state
+
+class DiskCache:
+    """
+    Directory of cached objects, each stored as a pickled skeleton plus one
+    .npy file per array so that loaded arrays can be memory-mapped.
+    Numpy arrays, DataFrames of numeric columns, objects providing
+    _cache_state/_from_cache_state, and dicts, lists and tuples of these and
+    plain values can be stored. Least recently used entries are
+    removed once the total size goes over max_size.
+
+    Parameters
+    ----------
+    directory : string
+        Where to keep the cache, created if needed.
+    max_size : int, optional
+        Maximum size of the cache in bytes, by default 1 GiB
+    """
+    def __init__(self, directory, max_size=2**30):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """
+        Hashes the reprs of the given parts into a key string.
+        """
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, mmap_mode='c'):
+        """
+        Loads the object stored under key, or returns None if there isn't one.
+        Arrays are memory-mapped with mmap_mode, by default copy-on-write so
+        that changing them never touches the cache.
+        """
+        path = self._path(key)
+        meta = os.path.join(path, 'meta.pkl')
+        try:
+            with open(meta, 'rb') as f:
+                skeleton = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+        # Mark as recently used
+        os.utime(meta)
+        return _decode(skeleton, path, mmap_mode)
+
+    def put(self, key, obj):
+        """
+        Stores obj under key. Returns False if obj can't be stored.
+        """
+        arrays = []
+        try:
+            skeleton = _encode(obj, arrays)
+        except TypeError:
+            return False
+
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        try:
+            for i, arr in enumerate(arrays):
+                np.save(os.path.join(tmp, '%d.npy' % i), arr, allow_pickle=False)
+            with open(os.path.join(tmp, 'meta.pkl'), 'wb') as f:
+                pickle.dump(skeleton, f)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            # Someone else already stored this key.
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+        return True
+
+    def entries(self):
+        """
+        Returns a list of (last use time, size in bytes, path) of each entry.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            try:
+                used = os.stat(os.path.join(entry.path, 'meta.pkl')).st_mtime
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            except OSError:
+                continue
+            entries.append((used, size, entry.path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in max_size.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+def _encode(obj, arrays):
+    if isinstance(obj, np.ndarray):
+        # Empty arrays can't be memory-mapped, and object arrays can't be saved.
+        if obj.dtype.hasobject:
+            raise TypeError("Can't cache object arrays")
+        if obj.size == 0:
+            return obj
+        arrays.append(np.ascontiguousarray(obj))
+        return _ArrayRef(len(arrays) - 1)
+    if isinstance(obj, pd.DataFrame):
+        index = obj.index
+        if not isinstance(index, pd.RangeIndex):
+            index = _encode(index.to_numpy(), arrays)
+        refs = [_encode(obj[col].to_numpy(), arrays) for col in obj.columns]
+        return _FrameRef(list(obj.columns), refs, index)
+    if hasattr(obj, '_cache_state'):
+        return _ObjectRef(type(obj), _encode(obj._cache_state(), arrays))
+    if isinstance(obj, dict):
+        return {key : _encode(val, arrays) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_encode(val, arrays) for val in obj)
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+        return obj
+    raise TypeError("Can't cache objects of type %s" % type(obj))
+
+def _decode(obj, path, mmap_mode):
+    if isinstance(obj, _ArrayRef):
+        return np.load(os.path.join(path, '%d.npy' % obj.idx), mmap_mode=mmap_mode)
+    if isinstance(obj, _FrameRef):
+        index = _decode(obj.index, path, mmap_mode)
+        columns = {col : _decode(ref, path, mmap_mode) for col, ref in zip(obj.columns, obj.refs)}
+        return pd.DataFrame(columns, index=index, copy=False)
+    if isinstance(obj, _ObjectRef):
+        return obj.cls._from_cache_state(_decode(obj.state, path, mmap_mode))
+    if isinstance(obj, dict):
+        return {key : _decode(val, path, mmap_mode) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_decode(val, path, mmap_mode) for val in obj)
+    return obj
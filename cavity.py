@@ -1,10 +1,15 @@
 import functools
+import inspect
+import time
+import collections
 from os import linesep
 import numpy as np
-from numba import jit
+import pandas as pd
+from numba import jit, guvectorize, float64
 from scipy import constants
 from scipy.signal import find_peaks
-from multiprocessing import Pool
+from multiprocessing import shared_memory
+from concurrent import futures
 import matplotlib.pyplot as plt
 
 from scipy.optimize import curve_fit
@@ -12,6 +17,7 @@ from scipy.optimize import curve_fit
 import lmfit as lm
 
 from . import data as _d
+from . import cache as _c
 from . import uncert as _u
 
 # Pretty Plotting
@@ -24,32 +30,60 @@ c  = constants.c
 ##################
 # Analytic Error #
 ##################
+# The error and transmission are split into parts that only depend on the
+# cavity parameters, and the rest which depends on the detuning dl.
+# That way the parameter dependent parts are only computed once per curve.
+# Powers are written out as products, which keeps them exact for the complex
+# arguments used by the PDH fitting below.
 @jit(nopython=True)
-def errf(dL, r, fm, m, lamb, a, phi, theta):
-    dl = (4 * pi / lamb) * dL
+def _errf_pre(r, fm, m, lamb, a, phi):
     lm = 2 * pi * fm * m * lamb / c
-    poly1=(24 - 12*dl**2 + dl**4)
-    t1 = ((lm**2 *
-          (-24 + lm**2)**2 * r**2 * (-1 + r**2) * (3 * dl * r**2 *
-            (-1 + r**2) * (6 *
-                (-3 + lm**2 + 2 * r**2 + r**4) -
-                dl**2 * (-3 + lm**2 + 8 * r**2 + r**4)) +
-            3 * a * dl * (-6 + dl**2 + 4 *
-                (-3 + 2 * dl**2) * r**2 + 2 * (-6 + dl**2) * (-3 + lm**2) * r**4 +
-                4 * (-3 + 2 * dl**2) * r**6 + (-6 + dl**2) * r**8) * np.cos(phi) -
-            a * (-1 + r**4) * (9 *
-                (-2 + dl**2) + (36 + dl**2 * (-6 + dl**2)**2 - 18 * lm**2) * r**2 +
-                9 * (-2 + dl**2) * r**4)  * np.sin(phi))) /
-          (32. * (1 + (-2 + dl**2) * r**2 + r**4) * (18 + r**2 * (6 * dl * lm * (-6 + lm**2) - dl**3 * lm * (-6 + lm**2) - 9 * dl**2 * (-2 + lm**2) + 18 * (-2 + lm**2 + r**2))) *
-          (18 + r**2 * (-6 * dl * lm * (-6 + lm**2) + dl**3 * lm * (-6 + lm**2) - 9 * dl**2 * (-2 + lm**2) + 18 * (-2 + lm**2 + r**2)))))
-
-    t2 = ((-7776 * (lm - lm**3 / 6.) * r**2 * (-1 + r**2) * ((2 * dl - (4 * dl**3) / 3.) * r**2 * (r**4 + a * np.cos(phi)) +
-         (dl - dl**3 / 6.) * ((-2 + lm**2) * r**2 * (-1 + r**2) - (poly1 * (r**4 + a * r**6 * np.cos(phi))) / 12. + (-1 + r**4) * (r**2 - r**4 + a * (1 + r**4) * np.cos(phi))) -
-         a * (dl - dl**3 / 6.)**2 * r**2 * (1 + r**4) * np.sin(phi) + a * (-((-24 + 12 * dl**2 - dl**4 + 24 * r**2) * (-24 + poly1 * r**2) * (1 + r**4)) / 576. +
-         2 * (1 - lm**2 / 2.) * (r**2 + (-2 + dl**2 - dl**4 / 12.) * r**4 + r**6)) * np.sin(phi))) /
-         ((12 - poly1 * r**2 + 12 * r**4) * (18 + r**2 * (6 * dl * lm * (-6 + lm**2) - dl**3 * lm * (-6 + lm**2) - 9 * dl**2 * (-2 + lm**2) + 18 * (-2 + lm**2 + r**2))) *
-         (18 + r**2 * (-6 * dl * lm * (-6 + lm**2) + dl**3 * lm * (-6 + lm**2) - 9 * dl**2 * (-2 + lm**2) + 18 * (-2 + lm**2 + r**2)))))
+    r2 = r * r
+    r4 = r2 * r2
+    lm2 = lm * lm
+    return (r2, r4, r4 * r2, r4 * r4, lm2,
+            lm * (-6 + lm2),                        # lmc
+            lm2 * (-24 + lm2) * (-24 + lm2) * r2 * (-1 + r2),  # t1 prefactor
+            6 * (-3 + lm2 + 2 * r2 + r4),
+            -3 + lm2 + 8 * r2 + r4,
+            -7776 * (lm - lm2 * lm / 6.) * r2 * (-1 + r2), # t2 prefactor
+            a * np.cos(phi),
+            a * np.sin(phi),
+            18 * (-2 + lm2 + r2))
+
+@jit(nopython=True)
+def _errf_terms(dl, p):
+    r2, r4, r6, r8, lm2, lmc, k1, A1, B1, k2, acp, asp, c18 = p
+    dl2 = dl * dl
+    dl3 = dl2 * dl
+    dl4 = dl2 * dl2
+    poly1 = (24 - 12*dl2 + dl4)
+    # The two 18 + r^2(...) denominators
+    odd = 6 * dl * lmc - dl3 * lmc
+    even = 9 * dl2 * (-2 + lm2)
+    dens = (18 + r2 * (odd - even + c18)) * (18 + r2 * (-odd - even + c18))
+
+    t1 = ((k1 * (3 * dl * r2 * (-1 + r2) * (A1 - dl2 * B1) +
+            3 * acp * dl * (-6 + dl2 + 4 *
+                (-3 + 2 * dl2) * r2 + 2 * (-6 + dl2) * (-3 + lm2) * r4 +
+                4 * (-3 + 2 * dl2) * r6 + (-6 + dl2) * r8) -
+            asp * (-1 + r4) * (9 *
+                (-2 + dl2) + (36 + dl2 * (-6 + dl2) * (-6 + dl2) - 18 * lm2) * r2 +
+                9 * (-2 + dl2) * r4))) /
+          (32. * (1 + (-2 + dl2) * r2 + r4) * dens))
+
+    d6 = dl - dl3 / 6.
+    t2 = ((k2 * ((2 * dl - (4 * dl3) / 3.) * r2 * (r4 + acp) +
+         d6 * ((-2 + lm2) * r2 * (-1 + r2) - (poly1 * (r4 + acp * r6)) / 12. + (-1 + r4) * (r2 - r4 + acp * (1 + r4))) -
+         asp * d6 * d6 * r2 * (1 + r4) + asp * (-((-poly1 + 24 * r2) * (-24 + poly1 * r2) * (1 + r4)) / 576. +
+         2 * (1 - lm2 / 2.) * (r2 + (-2 + dl2 - dl4 / 12.) * r4 + r6)))) /
+         ((12 - poly1 * r2 + 12 * r4) * dens))
+    return t1, t2
 
+@jit(nopython=True)
+def errf(dL, r, fm, m, lamb, a, phi, theta):
+    dl = (4 * pi / lamb) * dL
+    t1, t2 = _errf_terms(dl, _errf_pre(r, fm, m, lamb, a, phi))
     err = t1*np.cos(theta) + t2*np.sin(theta)
     return err
 
@@ -57,18 +91,82 @@ def errf(dL, r, fm, m, lamb, a, phi, theta):
 # Analytic Transmission #
 #########################
 @jit(nopython=True)
-def transf(dL, r, fm, m, lamb, pc):
-    dl = (4 * pi / lamb) * dL
+def _transf_pre(r, fm, m, lamb, pc):
     lm = 2 * pi * fm * m * lamb / c
-    poly1= (24 - 12*dl**2 + dl**4)
+    r2 = r * r
+    lm2 = lm * lm
+    return (r2, r2 * r2, lm, lm2,
+            12*pc*(-1 + r2)*(-1 + r2),          # carrier prefactor
+            -(-1 + pc)*(-1 + r2)*(-1 + r2),     # sideband prefactor
+            24 - 12*lm2 + lm2*lm2,
+            2*(-2 + lm2 + r2))
+
+@jit(nopython=True)
+def _transf_terms(dl, p):
+    r2, r4, lm, lm2, kc, ks, q, e = p
+    dl2 = dl * dl
+    poly1= (24 - 12*dl2 + dl2*dl2)
     # Carrier Trans
-    cr = (12*pc*(-1 + r**2)**2)/(12 - poly1*r**2 + 12*r**4)
+    cr = kc/(12 - poly1*r2 + 12*r4)
     # Sideband Trans
-    sb = (-((-1 + pc)*(-1 + r**2)**2 * (288 - poly1*(24 - 12*lm**2 + lm**4)*r**2 + 288*r**4))/
-           (72.*(2 - (4 - 2*dl**2 + 4*dl*lm + (-2 + dl**2)*lm**2)*r**2 + 2*r**4) *
-                (2 + r**2*(4*dl*lm - dl**2*(-2 + lm**2) + 2*(-2 + lm**2 + r**2)))))
-    tr = cr+sb
-    return tr
+    sb = ((ks * (288 - poly1*q*r2 + 288*r4))/
+           (72.*(2 - (4 - 2*dl2 + 4*dl*lm + (-2 + dl2)*lm2)*r2 + 2*r4) *
+                (2 + r2*(4*dl*lm - dl2*(-2 + lm2) + e))))
+    return cr+sb
+
+@jit(nopython=True)
+def transf(dL, r, fm, m, lamb, pc):
+    dl = (4 * pi / lamb) * dL
+    return _transf_terms(dl, _transf_pre(r, fm, m, lamb, pc))
+
+###################
+# Parameter Grids #
+###################
+# Broadcasting versions of errf and transf. dL is the last (core) axis, and
+# every other argument broadcasts against the rest, so a whole grid of cavity
+# parameters is evaluated in one parallel call. Parameter dependent parts are
+# computed once for each point of the grid rather than once per dL.
+# Results can be written into an existing array with out=.
+#
+# e.g. errf_grid(dLs, rs[:,None], fm, m, lamb, a, phis[None,:], theta, out=buf)
+# fills buf with shape (len(rs), len(phis), len(dLs)).
+def errf_grid(dL, r, fm, m, lamb, a, phi, theta, out=None):
+    args = (dL, r, fm, m, lamb, a, phi, theta)
+    if out is None:
+        return _grid_kernels()['errf'](*args)
+    return _grid_kernels()['errf'](*args, out)
+
+def transf_grid(dL, r, fm, m, lamb, pc, out=None):
+    args = (dL, r, fm, m, lamb, pc)
+    if out is None:
+        return _grid_kernels()['transf'](*args)
+    return _grid_kernels()['transf'](*args, out)
+
+# Parallel gufuncs are compiled on first use rather than on import, since
+# compiling them starts numba's thread pool, which mustn't be running when
+# processes are forked.
+@functools.lru_cache(maxsize=None)
+def _grid_kernels():
+    @guvectorize([(float64[:], float64, float64, float64, float64, float64, float64, float64, float64[:])],
+                 '(n),(),(),(),(),(),(),()->(n)', nopython=True, target='parallel')
+    def errf_kernel(dL, r, fm, m, lamb, a, phi, theta, out):
+        p = _errf_pre(r, fm, m, lamb, a, phi)
+        k = 4 * pi / lamb
+        ct = np.cos(theta)
+        st = np.sin(theta)
+        for i in range(dL.shape[0]):
+            t1, t2 = _errf_terms(k * dL[i], p)
+            out[i] = t1*ct + t2*st
+
+    @guvectorize([(float64[:], float64, float64, float64, float64, float64, float64[:])],
+                 '(n),(),(),(),(),()->(n)', nopython=True, target='parallel')
+    def transf_kernel(dL, r, fm, m, lamb, pc, out):
+        p = _transf_pre(r, fm, m, lamb, pc)
+        k = 4 * pi / lamb
+        for i in range(dL.shape[0]):
+            out[i] = _transf_terms(k * dL[i], p)
+
+    return {'errf' : errf_kernel, 'transf' : transf_kernel}
 
 #############
 # Normalize #
@@ -86,10 +184,254 @@ def min_dist(pair,es,ts,sigmae,sigmat):
     t = pair[1]
     return np.min(np.hypot((e-es)/sigmae,(t-ts)/sigmat))
 
-def min_dists(pairs,es,ts,sigmae,sigmat):
-    func = functools.partial(min_dist, es=es, ts=ts,sigmae=sigmae,sigmat=sigmat)
-    with Pool(10) as p:
-        return np.array(p.map(func, pairs))
+# Serial kernel over a block of points. Parallelism comes from running
+# blocks on separate workers, so numba threads don't oversubscribe them.
+@jit(nopython=True, nogil=True)
+def _min_dists_block(xs, ys, es, ts, sigmae, sigmat, out):
+    for i in range(xs.shape[0]):
+        best = np.inf
+        for j in range(es.shape[0]):
+            de = (xs[i] - es[j]) / sigmae
+            dt = (ys[i] - ts[j]) / sigmat
+            d = de*de + dt*dt
+            if d < best:
+                best = d
+        out[i] = np.sqrt(best)
+    return out
+
+# Reference curve of each worker process, attached from shared memory once.
+_shared_curve = {}
+
+def _attach_curve(name, M):
+    shm = shared_memory.SharedMemory(name=name)
+    curve = np.ndarray((2, M), dtype=np.float64, buffer=shm.buf)
+    _shared_curve.update({'shm' : shm, 'es' : curve[0], 'ts' : curve[1]})
+
+def _shared_block(xs, ys, sigmae, sigmat):
+    out = np.empty(len(xs))
+    return _min_dists_block(xs, ys, _shared_curve['es'], _shared_curve['ts'], sigmae, sigmat, out)
+
+class MinDistEngine:
+    """
+    Persistent pool for computing the minimum (sigma weighted) distance
+    between many points and a fixed reference curve {es, ts}.
+    Points are split into large blocks which are spread over the workers.
+    With processes, the curve is placed in shared memory once when the engine
+    is created, rather than being sent along with every task.
+
+    Parameters
+    ----------
+    es : np.array
+        Error signal values of the reference curve.
+    ts : np.array
+        Transmission values of the reference curve.
+    sigmae : float
+        Uncertainty of the error signal.
+    sigmat : float
+        Uncertainty of the transmission.
+    workers : int, optional
+        Number of threads or processes, by default the number of CPUs.
+    executor : str, optional
+        'thread' or 'process', by default 'thread'.
+    blocks_per_worker : int, optional
+        How many blocks to split the points into per worker, by default 4
+
+    Use as a context manager, or call close() when done.
+    """
+    def __init__(self, es, ts, sigmae, sigmat, workers=None, executor='thread', blocks_per_worker=4):
+        self.sigmae = sigmae
+        self.sigmat = sigmat
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.blocks_per_worker = blocks_per_worker
+        self.executor = executor
+        M = len(es)
+        self._shm = None
+        if executor == 'thread':
+            self.es = np.ascontiguousarray(es, dtype=np.float64)
+            self.ts = np.ascontiguousarray(ts, dtype=np.float64)
+            self._pool = futures.ThreadPoolExecutor(self.workers)
+        elif executor == 'process':
+            self._shm = shared_memory.SharedMemory(create=True, size=2 * M * 8)
+            curve = np.ndarray((2, M), dtype=np.float64, buffer=self._shm.buf)
+            curve[0] = es
+            curve[1] = ts
+            self._pool = _d._process_pool(self.workers, initializer=_attach_curve,
+                                          initargs=(self._shm.name, M))
+        else:
+            raise ValueError("executor must be 'thread' or 'process'")
+
+    def __call__(self, pairs):
+        """
+        Minimum distance from each of pairs (an N x 2 array of (e, t)) to the curve.
+        """
+        pairs = np.asarray(pairs, dtype=np.float64)
+        xs = np.ascontiguousarray(pairs[:, 0])
+        ys = np.ascontiguousarray(pairs[:, 1])
+        N = len(xs)
+        out = np.empty(N)
+        nblocks = max(min(self.workers * self.blocks_per_worker, N), 1)
+        bounds = np.linspace(0, N, nblocks + 1).astype(int)
+
+        jobs = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            if self.executor == 'thread':
+                # Threads write straight into the output
+                job = self._pool.submit(_min_dists_block, xs[lo:hi], ys[lo:hi], self.es, self.ts,
+                                        self.sigmae, self.sigmat, out[lo:hi])
+            else:
+                job = self._pool.submit(_shared_block, xs[lo:hi], ys[lo:hi], self.sigmae, self.sigmat)
+            jobs.append((lo, hi, job))
+        for lo, hi, job in jobs:
+            out[lo:hi] = job.result()
+        return out
+
+    def close(self):
+        self._pool.shutdown()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Thread engine kept between calls of min_dists, for the last curve used.
+_engine = None
+# The curve arrays given for it, kept so that their ids can't be reused,
+# and the rest of what it was made with.
+_engine_curve = None
+_engine_key = None
+
+def _cached_engine(es, ts, sigmae, sigmat, workers):
+    global _engine, _engine_curve, _engine_key
+    key = (np.shape(es), np.shape(ts), float(sigmae), float(sigmat), workers)
+    if (_engine_curve is None or _engine_curve[0] is not es
+            or _engine_curve[1] is not ts or _engine_key != key):
+        if _engine is not None:
+            _engine.close()
+        _engine = MinDistEngine(es, ts, sigmae, sigmat, workers=workers)
+        _engine_curve = (es, ts)
+        _engine_key = key
+    return _engine
+
+def min_dists(pairs,es,ts,sigmae,sigmat,workers=None,engine=None):
+    """
+    Minimum distance from each of pairs (an N x 2 array of (e, t)) to the
+    curve {es, ts}. A thread MinDistEngine for the last curve is kept between
+    calls, so calling again with the same es and ts arrays reuses its pool.
+    Curves are recognised by identity rather than by their values, so pass
+    new arrays after changing a curve in place. Callers that
+    alternate between curves, or want processes, should create and hold a
+    MinDistEngine themselves and pass it as engine, in which case es, ts,
+    sigmae, sigmat and workers are ignored.
+    """
+    if engine is None:
+        engine = _cached_engine(es, ts, sigmae, sigmat, workers)
+    return engine(pairs)
+
+####################
+# Reference Curves #
+####################
+# Most recently used curves kept in memory, see pdh_curve.
+_curves = collections.OrderedDict()
+_curves_max = 32
+# On-disk store of curves, see enable_curve_cache.
+_curve_cache = None
+
+def enable_curve_cache(directory=None, max_size=2**28, memory=32):
+    """
+    Turns on storing the curves computed by pdh_curve on disk, so that later
+    runs and other processes can load them instead of computing them again.
+
+    Parameters
+    ----------
+    directory : string, optional
+        Where to store the curves, by default ~/.cache/cavspy/curves
+    max_size : int, optional
+        Size of the store in bytes above which the least recently used
+        curves are removed, by default 256 MiB
+    memory : int, optional
+        Number of curves also kept in memory, by default 32
+
+    Returns
+    -------
+    cache.DiskCache
+        The on-disk store.
+    """
+    global _curve_cache, _curves_max
+    if directory is None:
+        directory = os.path.join(os.path.expanduser('~'), '.cache', 'cavspy', 'curves')
+    _curves_max = memory
+    while len(_curves) > _curves_max:
+        _curves.popitem(last=False)
+    _curve_cache = _c.DiskCache(directory, max_size)
+    return _curve_cache
+
+def disable_curve_cache():
+    """
+    Turns off storing curves on disk, and empties the ones kept in memory.
+    Stored curves are left on disk.
+    """
+    global _curve_cache
+    _curve_cache = None
+    _curves.clear()
+
+def pdh_curve(r, fm, m, lamb, a, phi, theta, pc, dL_min, dL_max, num, cache=True):
+    """
+    Reference curve of the error signal and transmission over an evenly
+    spaced grid of cavity detunings, for use with paramopt.
+    Curves are kept in memory, keyed by the parameters and grid, and on disk
+    too if enable_curve_cache was called, so each is only computed once.
+    paramopt.get_lengths takes the same arguments as curve= to use them.
+
+    Parameters
+    ----------
+    r, fm, m, lamb, a, phi, theta, pc : float
+        Cavity parameters, see errf and transf.
+    dL_min : float
+        First detuning of the grid.
+    dL_max : float
+        Last detuning of the grid.
+    num : int
+        Number of points in the grid.
+    cache : bool, optional
+        If False, always compute the curve, by default True
+
+    Returns
+    -------
+    np.array, np.array, np.array
+        The detunings, error signal and transmission. The curves are shared
+        with the cache, so they're read only.
+    """
+    dLs = np.linspace(dL_min, dL_max, num)
+    params = tuple(float(x) for x in (r, fm, m, lamb, a, phi, theta, pc))
+    key = _c.DiskCache.key('pdh', params, (float(dL_min), float(dL_max), int(num)))
+
+    curve = None
+    if cache:
+        curve = _curves.get(key)
+        if curve is not None:
+            _curves.move_to_end(key)
+        elif _curve_cache is not None:
+            curve = _curve_cache.get(key, mmap_mode='r')
+    if curve is None:
+        r, fm, m, lamb, a, phi, theta, pc = params
+        es = errf_grid(dLs, r, fm, m, lamb, a, phi, theta)
+        ts = transf_grid(dLs, r, fm, m, lamb, pc)
+        es.flags.writeable = False
+        ts.flags.writeable = False
+        curve = {'es' : es, 'ts' : ts}
+        if cache and _curve_cache is not None:
+            _curve_cache.put(key, curve)
+
+    if cache and key not in _curves:
+        _curves[key] = curve
+        while len(_curves) > _curves_max:
+            _curves.popitem(last=False)
+    return dLs, curve['es'], curve['ts']
 
 #########################
 # Simple Fitting Funcs. #
@@ -118,15 +460,78 @@ def triple_lor(x, splitting, amp, center, linewidth, ps, offset):
                       + lorenz(x, amp, linewidth, center-shift))
     return offset + carrier + sidebands
 
+# Compiled versions of triple_fan and triple_lor, which compute the model and
+# its derivatives with respect to each parameter in a single pass over x.
+@jit(nopython=True, nogil=True)
+def _fano_terms(dx, amp, slope, hw):
+    hw2 = hw * hw
+    L = hw2 / (hw2 + dx * dx)
+    a = amp + slope * dx
+    # Value, then derivatives by amp, slope, width and center
+    return (a * L, L, dx * L, a * L * (1 - L) / hw,
+            2 * a * dx * L * L / hw2 - slope * L)
+
+@jit(nopython=True, nogil=True)
+def _triple_kernel(x, splitting, amp, slope, center, linewidth, ps, offset, out, jac, scale):
+    shift = splitting / 2
+    hw = linewidth / 2
+    want_jac = jac.shape[1] > 0
+    for i in range(x.shape[0]):
+        dx = x[i] - center
+        f0, a0, s0, w0, c0 = _fano_terms(dx, amp, slope, hw)
+        fp, ap, sp, wp, cp = _fano_terms(dx - shift, amp, slope, hw)
+        fm, am, sm, wm, cm = _fano_terms(dx + shift, amp, slope, hw)
+        out[i] = offset + f0 + ps * (fp + fm)
+        if want_jac:
+            # One row per parameter, in the same order as the arguments of
+            # triple_fan, each multiplied by scale.
+            w = scale[i]
+            jac[0, i] = w * ps * (cp - cm) / 2
+            jac[1, i] = w * (a0 + ps * (ap + am))
+            jac[2, i] = w * (s0 + ps * (sp + sm))
+            jac[3, i] = w * (c0 + ps * (cp + cm))
+            jac[4, i] = w * (w0 + ps * (wp + wm))
+            jac[5, i] = w * (fp + fm)
+            jac[6, i] = w
+
+_no_jac = np.empty((7, 0))
+
+def _triple_fan_jit(x, splitting, amp, slope, center, linewidth, ps, offset):
+    x = np.asarray(x, dtype=np.float64)
+    out = np.empty(x.shape[0])
+    _triple_kernel(x, splitting, amp, slope, center, linewidth, ps, offset, out, _no_jac, x)
+    return out
+
+def _triple_lor_jit(x, splitting, amp, center, linewidth, ps, offset):
+    return _triple_fan_jit(x, splitting, amp, 0.0, center, linewidth, ps, offset)
+
+# Jacobian rows of _triple_kernel, by parameter name.
+_fan_columns = ['splitting', 'amp', 'slope', 'center', 'linewidth', 'ps', 'offset']
+
+def _triple_dfun(params, data, weights, x=None, lor=False, **kwargs):
+    """
+    Jacobian of lmfit.Model's residual, (data - model) * weights, with respect
+    to the varying parameters, one row per parameter for leastsq's Dfun with
+    col_deriv=True.
+    """
+    v = params.valuesdict()
+    slope = 0.0 if lor else v['slope']
+    x = np.asarray(x, dtype=np.float64)
+    if weights is None:
+        scale = -np.ones(x.shape[0])
+    else:
+        scale = -np.broadcast_to(weights, x.shape).astype(np.float64)
+    out = np.empty(x.shape[0])
+    jac = np.empty((7, x.shape[0]))
+    _triple_kernel(x, v['splitting'], v['amp'], slope, v['center'], v['linewidth'],
+                   v['ps'], v['offset'], out, jac, scale)
+    idx = [_fan_columns.index(name) for name, par in params.items() if par.vary and not par.expr]
+    return jac[idx]
+
 ####################
 # Sideband Fitting #
 ####################
-def fit_triple(filename, func, mod_freq, ax=None, idx_offset=0, sb_ratio=10, lw_ratio=2):
-    print("Fitting sideband data in %s" % filename)
-    data = _d.read(filename)
-    xs = data[0]
-    ys = data[1+idx_offset]
-
+def _guess_triple(xs, ys, sb_ratio, lw_ratio):
     # Getting main peak
     peak=find_peaks(ys, height=(np.mean(ys)+0.1*np.std(ys)),distance=50000)[0][0]
 
@@ -138,24 +543,43 @@ def fit_triple(filename, func, mod_freq, ax=None, idx_offset=0, sb_ratio=10, lw_
 
     # Guesses
     offset = np.mean(ys)/2
-    center = xs[peak]
-    split = (xs[split_right]-xs[split_left])
-    amp = max(ys) - offset
+    return {'splitting' : (xs[split_right]-xs[split_left]),
+            'amp' : max(ys) - offset,
+            'center' : xs[peak],
+            'linewidth' : (xs[lw_right] - xs[lw_left]),
+            'ps' : 1/sb_ratio,
+            'offset' : offset,
+            'slope' : 0.0001}
+
+def _fit_triple(xs, ys, func, sb_ratio, lw_ratio, analytic=True):
     sigma = min(np.diff(ys))
-    lw = (xs[lw_right] - xs[lw_left])
 
-    # Fitting
+    # Fitting, with the compiled model and analytic jacobian where there is one
+    fit_kws = None
+    if analytic and func is triple_fan:
+        func = _triple_fan_jit
+        fit_kws = {'Dfun' : _triple_dfun, 'col_deriv' : True}
+    elif analytic and func is triple_lor:
+        func = _triple_lor_jit
+        fit_kws = {'Dfun' : functools.partial(_triple_dfun, lor=True), 'col_deriv' : True}
     model = lm.Model(func)
-    params = model.make_params(splitting=split, 
-                               amp=amp, 
-                               center=center, 
-                               linewidth=lw, 
-                               ps=1/sb_ratio, 
-                               offset=offset,
-                               slope=0.0001)
-    
+    params = model.make_params(**_guess_triple(xs, ys, sb_ratio, lw_ratio))
+    return model.fit(ys, params, x=xs, weights = 1/sigma * np.ones(ys.size), fit_kws=fit_kws)
+
+def _linewidth(result, mod_freq):
+    best_vals = _u.from_fit(result)
+    # Splitting is the distance between sidebands, and so total
+    # Frequency difference is twice the modulation frequency.
+    return best_vals, best_vals['linewidth'] / best_vals['splitting'] * (2 * mod_freq)
+
+def fit_triple(filename, func, mod_freq, ax=None, idx_offset=0, sb_ratio=10, lw_ratio=2, analytic=True):
+    print("Fitting sideband data in %s" % filename)
+    data = _d.read(filename)
+    xs = data[0]
+    ys = data[1+idx_offset]
+
     # Computing results
-    result = model.fit(ys, params, x=xs, weights = 1/sigma * np.ones(ys.size))
+    result = _fit_triple(xs, ys, func, sb_ratio, lw_ratio, analytic)
     chisqr = result.redchi
     best_vals = result.best_values
     if ax is not None:
@@ -163,16 +587,397 @@ def fit_triple(filename, func, mod_freq, ax=None, idx_offset=0, sb_ratio=10, lw_
     if chisqr > 1.5:
         print("Chi-Square from triplet fit is greater than 1.5!")
         return None
-    best_vals = _u.from_fit(result)
-    # Splitting is the distance between sidebands, and so total
-    # Frequency difference is twice the modulation frequency.
-    lw = best_vals['linewidth'] / best_vals['splitting'] * (2 * mod_freq)
+    _, lw = _linewidth(result, mod_freq)
     print("Linwidth = %.2f MHz (Chisq = %.2f)" % (np.abs(lw),chisqr))
     return np.abs(lw)
 
+def _fit_triple_row(args):
+    source, func, mod_freq, idx_offset, sb_ratio, lw_ratio, max_chisq, analytic = args
+    data = _d.read(source) if isinstance(source, str) else source
+    xs = np.asarray(data[0], dtype=np.float64)
+    ys = np.asarray(data[1+idx_offset], dtype=np.float64)
+    result = _fit_triple(xs, ys, func, sb_ratio, lw_ratio, analytic)
+    best_vals, lw = _linewidth(result, mod_freq)
+    row = dict(best_vals)
+    row['linewidth'] = abs(lw)
+    row.update({'redchi' : result.redchi,
+                'chisqr' : result.chisqr,
+                'accepted' : bool(result.redchi <= max_chisq),
+                'success' : result.success,
+                'nfev' : result.nfev})
+    return row
+
+def fit_triples(sources, func, mod_freq, idx_offset=0, sb_ratio=10, lw_ratio=2,
+                max_chisq=1.5, workers=None, executor='process', analytic=True):
+    """
+    Fits many sideband sweeps with the same model as fit_triple, in parallel.
+
+    Parameters
+    ----------
+    sources : [string or (np.array, np.array, ...)]
+        Files to read with data.read, or sequences of arrays (xs, ys, ...).
+        Files are read by the workers.
+    func : function
+        The model to fit, triple_lor or triple_fan.
+    mod_freq : float
+        The modulation frequency, which sets the scale of the linewidth.
+    idx_offset : int, optional
+        Which column after the first of each source to fit, by default 0
+    sb_ratio : float, optional
+        Guessed ratio of the carrier to sideband heights, by default 10
+    lw_ratio : float, optional
+        Fraction of the peak height at which the linewidth is guessed, by default 2
+    max_chisq : float, optional
+        Fits with a larger reduced chi-square are marked as rejected, by default 1.5
+    workers : int, optional
+        Number of processes (or threads) to fit with, by default the number of CPUs.
+    executor : str, optional
+        'process' or 'thread', by default 'process'
+    analytic : bool, optional
+        If True, triple_lor and triple_fan are fit with their compiled versions
+        and analytic jacobians, see fit_triple, by default True
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per source, with the linewidth (in units of mod_freq) and a
+        gummy for each fit parameter, along with redchi, chisqr, success and nfev.
+        'accepted' is False for fits with redchi over max_chisq. Fits that
+        raised an error have success and accepted False and the error in 'error'.
+    """
+    if executor == 'process':
+        pool = _d._process_pool(workers)
+    elif executor == 'thread':
+        pool = futures.ThreadPoolExecutor(workers)
+    else:
+        raise ValueError("executor must be 'process' or 'thread'")
+
+    sources = list(sources)
+    with pool:
+        jobs = [pool.submit(_fit_triple_row, (source, func, mod_freq, idx_offset,
+                                              sb_ratio, lw_ratio, max_chisq, analytic))
+                for source in sources]
+        rows = []
+        for job in jobs:
+            try:
+                rows.append(job.result())
+            except Exception as e:
+                rows.append({'accepted' : False, 'success' : False, 'error' : e})
+    results = pd.DataFrame(rows)
+    results.insert(0, 'source', [s if isinstance(s, str) else i for i, s in enumerate(sources)])
+    return results
+
+def benchmark_triple(func=triple_lor, n=10**5, repeat=3, seed=None):
+    """
+    Times fitting a synthetic sideband sweep of n points with func, using the
+    numpy model with finite difference derivatives and then the compiled model
+    with analytic jacobian.
+
+    Returns
+    -------
+    float, float
+        The best time per fit in seconds of each.
+    """
+    rng = np.random.default_rng(seed)
+    xs = np.linspace(-1, 1, n)
+    true = {'splitting' : 0.8, 'amp' : 1.0, 'slope' : 0.05, 'center' : 0.01,
+            'linewidth' : 0.05, 'ps' : 0.1, 'offset' : 0.02}
+    names = list(inspect.signature(func).parameters)[1:]
+    ys = func(xs, *[true[name] for name in names]) + rng.normal(0, 0.003, n)
+    # Compile first
+    _fit_triple(xs[:1000], ys[:1000], func, 10, 2, True)
+
+    times = []
+    for analytic in (False, True):
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = _fit_triple(xs, ys, func, 10, 2, analytic)
+            best = min(best, time.perf_counter() - start)
+        times.append(best)
+        print("%s: %.3g s per fit, %d evaluations, redchi %.3f" %
+              ('analytic' if analytic else 'numeric', best, result.nfev, result.redchi))
+    print("Speedup: %.2fx" % (times[0] / times[1]))
+    return times[0], times[1]
+
+###############
+# PDH Fitting #
+###############
+# Fits measured error signal and transmission traces directly to errf and
+# transf, with the detuning given by dL = scale * (x - x0) and each signal
+# scaled and offset: err = amp_e * errf + off_e, trans = amp_t * transf + off_t.
+# Derivatives are taken by complex step, evaluating the same kernels at
+# p + ih, which is exact to machine precision since the expressions are analytic.
+_pdh_names = ['r', 'm', 'a', 'phi', 'theta', 'pc', 'scale', 'x0',
+              'amp_e', 'off_e', 'amp_t', 'off_t']
+_h = 1E-20
+
+@jit(nopython=True, nogil=True)
+def _pdh_kernel(xe, xt, v, fm, lamb, out, jac, we, wt):
+    r, m, a, phi, theta, pc, scale, x0, amp_e, off_e, amp_t, off_t = v
+    want_jac = jac.shape[1] > 0
+    k = 4 * pi / lamb
+    ct = np.cos(theta)
+    st = np.sin(theta)
+    ih = 1j * _h
+    fmc = fm + 0j
+    lambc = lamb + 0j
+    # Parameter dependent parts, at the values and with each stepped
+    pe = _errf_pre(r + 0j, fmc, m + 0j, lambc, a + 0j, phi + 0j)
+    pe_r = _errf_pre(r + ih, fmc, m + 0j, lambc, a + 0j, phi + 0j)
+    pe_m = _errf_pre(r + 0j, fmc, m + ih, lambc, a + 0j, phi + 0j)
+    pe_a = _errf_pre(r + 0j, fmc, m + 0j, lambc, a + ih, phi + 0j)
+    pe_phi = _errf_pre(r + 0j, fmc, m + 0j, lambc, a + 0j, phi + ih)
+    pt = _transf_pre(r + 0j, fmc, m + 0j, lambc, pc + 0j)
+    pt_r = _transf_pre(r + ih, fmc, m + 0j, lambc, pc + 0j)
+    pt_m = _transf_pre(r + 0j, fmc, m + ih, lambc, pc + 0j)
+    pt_pc = _transf_pre(r + 0j, fmc, m + 0j, lambc, pc + ih)
+
+    ne = xe.shape[0]
+    for i in range(ne):
+        dl = k * scale * (xe[i] - x0) + 0j
+        t1, t2 = _errf_terms(dl, pe)
+        f = (t1 * ct + t2 * st).real
+        out[i] = amp_e * f + off_e
+        if want_jac:
+            w = we[i]
+            t1, t2 = _errf_terms(dl + ih, pe)
+            ddl = (t1 * ct + t2 * st).imag / _h
+            t1, t2 = _errf_terms(dl, pe_r)
+            jac[0, i] = w * amp_e * (t1 * ct + t2 * st).imag / _h
+            t1, t2 = _errf_terms(dl, pe_m)
+            jac[1, i] = w * amp_e * (t1 * ct + t2 * st).imag / _h
+            t1, t2 = _errf_terms(dl, pe_a)
+            jac[2, i] = w * amp_e * (t1 * ct + t2 * st).imag / _h
+            t1, t2 = _errf_terms(dl, pe_phi)
+            jac[3, i] = w * amp_e * (t1 * ct + t2 * st).imag / _h
+            t1, t2 = _errf_terms(dl, pe)
+            jac[4, i] = w * amp_e * (t2 * ct - t1 * st).real
+            jac[5, i] = 0.0
+            jac[6, i] = w * amp_e * ddl * k * (xe[i] - x0)
+            jac[7, i] = -w * amp_e * ddl * k * scale
+            jac[8, i] = w * f
+            jac[9, i] = w
+            jac[10, i] = 0.0
+            jac[11, i] = 0.0
+
+    for i in range(xt.shape[0]):
+        j = ne + i
+        dl = k * scale * (xt[i] - x0) + 0j
+        f = _transf_terms(dl, pt).real
+        out[j] = amp_t * f + off_t
+        if want_jac:
+            w = wt[i]
+            ddl = _transf_terms(dl + ih, pt).imag / _h
+            jac[0, j] = w * amp_t * _transf_terms(dl, pt_r).imag / _h
+            jac[1, j] = w * amp_t * _transf_terms(dl, pt_m).imag / _h
+            jac[2, j] = 0.0
+            jac[3, j] = 0.0
+            jac[4, j] = 0.0
+            jac[5, j] = w * amp_t * _transf_terms(dl, pt_pc).imag / _h
+            jac[6, j] = w * amp_t * ddl * k * (xt[i] - x0)
+            jac[7, j] = -w * amp_t * ddl * k * scale
+            jac[8, j] = 0.0
+            jac[9, j] = 0.0
+            jac[10, j] = w * f
+            jac[11, j] = w
+
+class _PDHData:
+    # Traces being fit, with the weight of each point.
+    def __init__(self, x, err, trans, fm, lamb, sigma_e, sigma_t, x_t=None):
+        self.fm = fm
+        self.lamb = lamb
+        x = np.asarray(x, dtype=np.float64)
+        x_t = x if x_t is None else np.asarray(x_t, dtype=np.float64)
+        empty = np.empty(0)
+        self.xe = x if err is not None else empty
+        self.xt = x_t if trans is not None else empty
+        self.data = np.concatenate([np.asarray(err, dtype=np.float64) if err is not None else empty,
+                                    np.asarray(trans, dtype=np.float64) if trans is not None else empty])
+        self.we = np.full(len(self.xe), 1 / sigma_e) if err is not None else empty
+        self.wt = np.full(len(self.xt), 1 / sigma_t) if trans is not None else empty
+        self.w = np.concatenate([self.we, self.wt])
+
+    def eval(self, v, jac=None):
+        out = np.empty(len(self.data))
+        if jac is None:
+            jac = np.empty((len(_pdh_names), 0))
+        _pdh_kernel(self.xe, self.xt, np.asarray(v, dtype=np.float64), self.fm, self.lamb,
+                    out, jac, self.we, self.wt)
+        return out
+
+def _pdh_objective(params, d):
+    v = [params[n].value for n in _pdh_names]
+    return (d.eval(v) - d.data) * d.w
+
+def _pdh_jacobian(params, d):
+    v = [params[n].value for n in _pdh_names]
+    jac = np.empty((len(_pdh_names), len(d.data)))
+    d.eval(v, jac)
+    # Only the varying parameters, in the order lmfit uses
+    return jac[[_pdh_names.index(n) for n, p in params.items() if p.vary]]
+
+def _noise(ys):
+    # Point to point noise, insensitive to the slow signal
+    return np.std(np.diff(ys)) / np.sqrt(2)
+
+def pdh_params(r, m, a, phi, theta, pc, scale, x0, amp_e=1.0, off_e=0.0, amp_t=1.0, off_t=0.0):
+    """
+    Starting parameters for fit_pdh. The detuning of each point of a trace is
+    dL = scale * (x - x0), and the signals are amp_e * errf + off_e and
+    amp_t * transf + off_t. See errf and transf for the rest.
+    Set .vary = False on any of them to hold them fixed.
+
+    Returns
+    -------
+    lmfit.Parameters
+    """
+    params = lm.Parameters()
+    params.add('r', value=r, min=0, max=1)
+    params.add('m', value=m, min=0)
+    params.add('a', value=a)
+    params.add('phi', value=phi)
+    params.add('theta', value=theta)
+    params.add('pc', value=pc, min=0, max=1)
+    params.add('scale', value=scale)
+    params.add('x0', value=x0)
+    params.add('amp_e', value=amp_e)
+    params.add('off_e', value=off_e)
+    params.add('amp_t', value=amp_t)
+    params.add('off_t', value=off_t)
+    return params
+
+def fit_pdh(x, err, trans, params, fm, lamb, x_t=None, sigma_e=None, sigma_t=None, linear=True):
+    """
+    Fits an error signal and/or transmission trace directly to errf and transf,
+    jointly when both are given, using leastsq with jacobians from
+    complex-step derivatives of the compiled models.
+
+    Parameters
+    ----------
+    x : np.array
+        Sweep coordinate of each point (e.g. time or piezo voltage).
+    err : np.array or None
+        Measured error signal, or None to only fit the transmission.
+    trans : np.array or None
+        Measured transmission, or None to only fit the error signal.
+    params : lmfit.Parameters
+        Starting values, see pdh_params.
+    fm : float
+        Modulation frequency.
+    lamb : float
+        Laser wavelength.
+    x_t : np.array, optional
+        Sweep coordinate of the transmission, if different from x.
+    sigma_e, sigma_t : float, optional
+        Noise of each signal, which weights them in a joint fit,
+        by default estimated from the point to point scatter.
+    linear : bool, optional
+        If True, start the varying amplitudes and offsets from their linear
+        least squares values given the other parameters, by default True
+
+    Returns
+    -------
+    lmfit.MinimizerResult
+    """
+    if err is None and trans is None:
+        raise ValueError("At least one of err and trans must be given")
+    if sigma_e is None and err is not None:
+        sigma_e = _noise(err)
+    if sigma_t is None and trans is not None:
+        sigma_t = _noise(trans)
+    d = _PDHData(x, err, trans, fm, lamb, sigma_e, sigma_t, x_t)
+
+    params = params.copy()
+    if linear:
+        v = [params[n].value for n in _pdh_names]
+        v[8:12] = [1.0, 0.0, 1.0, 0.0]
+        shape = d.eval(v)
+        ne = len(d.xe)
+        for part, amp, off in ((slice(0, ne), 'amp_e', 'off_e'),
+                               (slice(ne, None), 'amp_t', 'off_t')):
+            if len(shape[part]) and params[amp].vary and params[off].vary:
+                A = np.column_stack((shape[part], np.ones(len(shape[part]))))
+                sol = np.linalg.lstsq(A, d.data[part], rcond=None)[0]
+                params[amp].value, params[off].value = sol
+    # Parameters that don't affect the fitted signals are held fixed
+    if err is None:
+        for n in ('a', 'phi', 'theta', 'amp_e', 'off_e'):
+            params[n].vary = False
+    if trans is None:
+        for n in ('pc', 'amp_t', 'off_t'):
+            params[n].vary = False
+
+    minimizer = lm.Minimizer(_pdh_objective, params, fcn_args=(d,))
+    return minimizer.leastsq(Dfun=_pdh_jacobian, col_deriv=True)
+
+def _fit_pdh_row(args):
+    trace, params, fm, lamb, kwargs = args
+    result = fit_pdh(*trace, params, fm, lamb, **kwargs)
+    row = _u.from_fit(result)
+    row.update({'chisqr' : result.chisqr,
+                'redchi' : result.redchi,
+                'success' : result.success,
+                'nfev' : result.nfev})
+    return row
+
+def fit_pdh_many(traces, params, fm, lamb, workers=None, executor='process', **kwargs):
+    """
+    Fits many traces with fit_pdh in parallel.
+
+    Parameters
+    ----------
+    traces : [(np.array, np.array or None, np.array or None)]
+        (x, err, trans) of each trace.
+    params : lmfit.Parameters
+        Starting values shared by every trace, see pdh_params.
+    fm : float
+        Modulation frequency.
+    lamb : float
+        Laser wavelength.
+    workers : int, optional
+        Number of processes (or threads) to fit with, by default the number of CPUs.
+    executor : str, optional
+        'process' or 'thread', by default 'process'
+    kwargs :
+        Passed on to fit_pdh.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per trace, with a gummy (from uncert.from_fit) for each
+        parameter, along with chisqr, redchi, success and nfev. Fits that raised
+        an error have success False and the error in 'error'.
+    """
+    if executor == 'process':
+        pool = _d._process_pool(workers)
+    elif executor == 'thread':
+        pool = futures.ThreadPoolExecutor(workers)
+    else:
+        raise ValueError("executor must be 'process' or 'thread'")
+
+    with pool:
+        jobs = [pool.submit(_fit_pdh_row, (trace, params, fm, lamb, kwargs)) for trace in traces]
+        rows = []
+        for job in jobs:
+            try:
+                rows.append(job.result())
+            except Exception as e:
+                rows.append({'success' : False, 'error' : e})
+    return pd.DataFrame(rows)
+
 #####################
 # WhiteLight Length #
 #####################
+# Peak wavelengths, and the lengths and FSRs between neighbouring peaks.
+def _white_peaks(wavelength, counts, height, dist, **kwargs):
+    peaks = find_peaks(counts, height=height, distance=dist, **kwargs)
+    peak_wl = wavelength[peaks[0]]
+    peak_freq = c/(peak_wl * 1E-9)
+    fsrs = np.diff(peak_freq[::-1])
+    lengths = c/(2*fsrs)
+    return peak_wl, lengths, fsrs
+
 def white_length(filename, plot=False, disp=False, col=10,
                  wlmin=600.0, wlmax=650.0, dist=50, height=None, ratio=0.05, **kwargs):
     """
@@ -220,11 +1025,7 @@ def white_length(filename, plot=False, disp=False, col=10,
     wavelength = wavelength[bounds]
     counts = counts[bounds]
 
-    peaks = find_peaks(counts, height=height, distance=dist, **kwargs)
-    peak_wl = wavelength[peaks[0]]
-    peak_freq = c/(peak_wl * 1E-9)
-    fsrs = np.diff(peak_freq[::-1])
-    lengths = c/(2*fsrs)
+    peak_wl, lengths, fsrs = _white_peaks(wavelength, counts, height, dist, **kwargs)
 
     length = _u.from_floats(lengths * 1E6)  # um
     fsr = _u.from_floats(fsrs / 1E6) # MHz
@@ -242,3 +1043,86 @@ def white_length(filename, plot=False, disp=False, col=10,
         print("\tCavity length is: %s um" % length)
         print("\tFSR is: %s MHz" % fsr)
     return length, fsr
+
+def _white_file(filename, cols, wlmin, wlmax, dist, height, ratio, kwargs):
+    wl_data = _d.read_csv(filename, df=True, head=0, skiprows=30, delim=',')
+    frame = wl_data.to_numpy(dtype=np.float64)
+    wavelength = frame[:, 0]
+    if cols is None:
+        cols = range(1, frame.shape[1])
+    cols = list(cols)
+    counts = frame[:, cols]
+
+    # Heights of every column at once, from the whole spectrum like white_length
+    if height is None:
+        heights = np.mean(counts, axis=0) + (np.max(counts, axis=0) * ratio)
+    else:
+        heights = np.broadcast_to(height, (len(cols),))
+
+    bounds = np.logical_and(wavelength >= wlmin, wavelength <= wlmax)
+    wavelength = wavelength[bounds]
+    counts = counts[bounds]
+
+    rows = []
+    for i, col in enumerate(cols):
+        _, lengths, fsrs = _white_peaks(wavelength, counts[:, i], heights[i], dist, **kwargs)
+        lengths = lengths * 1E6 # um
+        fsrs = fsrs / 1E6 # MHz
+        # The uncertainty of a single length divides by zero
+        success = len(lengths) > 1
+        rows.append({'file' : filename,
+                     'col' : col,
+                     'lengths' : lengths,
+                     'fsrs' : fsrs,
+                     'length' : _u.from_floats(lengths) if success else np.nan,
+                     'fsr' : _u.from_floats(fsrs) if success else np.nan,
+                     'success' : success})
+    return rows
+
+def white_lengths(filenames, cols=None, wlmin=600.0, wlmax=650.0, dist=50, height=None,
+                  ratio=0.05, workers=None, executor='thread', **kwargs):
+    """
+    Fits the whitelight data of many columns, and/or many files, like
+    white_length. Each file is only parsed once for all of its columns, and
+    files are read in parallel.
+
+    Parameters
+    ----------
+    filenames : string or [string]
+        The file, or files, containing the counts data.
+    cols : [int], optional
+        Which columns of the data to use, by default every column after the
+        wavelengths.
+    wlmin, wlmax, dist, height, ratio :
+        See white_length. If height is None, it's found for each column.
+    workers : int, optional
+        Number of threads (or processes) reading files, by default the number of CPUs.
+    executor : str, optional
+        'thread' or 'process', by default 'thread'
+    **kwargs will be passed to find_peaks
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per column of each file, with the file and column, arrays
+        of the lengths (um) and FSRs (MHz) between neighbouring peaks, and
+        their uncert.from_floats summaries 'length' and 'fsr'. Those need at
+        least three peaks; columns with fewer have nan summaries and
+        'success' False.
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    if executor == 'thread':
+        pool = futures.ThreadPoolExecutor(workers)
+    elif executor == 'process':
+        pool = _d._process_pool(workers)
+    else:
+        raise ValueError("executor must be 'thread' or 'process'")
+
+    with pool:
+        jobs = [pool.submit(_white_file, filename, cols, wlmin, wlmax, dist, height, ratio, kwargs)
+                for filename in filenames]
+        rows = []
+        for job in jobs:
+            rows += job.result()
+    return pd.DataFrame(rows)
@@ -1,6 +1,11 @@
+import hashlib
+import collections
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import scipy.optimize as opt
+import scipy.linalg as la
+from concurrent import futures
 
 from . import data
 
@@ -11,6 +16,78 @@ plt.style.use(os.path.join(os.path.dirname(__file__),"style.mplstyle"))
 ###############################;
 # Numerical Complex Functions #
 ###############################
+# Interpolation weights between pairs of frequency grids, most recent last.
+_weights = collections.OrderedDict()
+_weights_max = 64
+# Whether binary operators resample mismatched grids, see enable_align.
+_align = False
+
+def enable_align(memory=64):
+    """
+    Turns on aligning the operands of CompFun arithmetic automatically.
+    When two functions' frequencies differ, both are resampled onto the
+    left operand's frequencies that lie within the right's range, see
+    CompFun.resample. Otherwise mismatched grids raise a ValueError.
+
+    Parameters
+    ----------
+    memory : int, optional
+        Number of pairs of grids to keep interpolation weights for, by default 64
+    """
+    global _align, _weights_max
+    _align = True
+    _weights_max = memory
+
+def disable_align():
+    """
+    Turns off aligning operands, and empties the cached interpolation weights.
+    """
+    global _align
+    _align = False
+    _weights.clear()
+
+def _grid_key(freq):
+    return (len(freq), hashlib.sha1(freq.tobytes()).hexdigest())
+
+def _interp_weights(source, target):
+    """
+    Weights to linearly interpolate from the source to the target frequencies
+    in log frequency, cached per pair of grids.
+
+    Returns
+    -------
+    np.array or None, np.array, np.array
+        Order that sorts the source (None if it's sorted already), and for
+        each target the sorted index of the point below it and the fraction of
+        the way to the next point.
+    """
+    key = (_grid_key(source), _grid_key(target))
+    weights = _weights.get(key)
+    if weights is not None:
+        _weights.move_to_end(key)
+        return weights
+
+    if len(source) < 2:
+        raise ValueError("Need at least two points to interpolate")
+    if np.any(source <= 0) or np.any(target <= 0):
+        raise ValueError("Frequencies must be positive for log interpolation")
+    order = None
+    if np.any(np.diff(source) < 0):
+        order = np.argsort(source, kind='stable')
+        source = source[order]
+    ls = np.log(source)
+    lt = np.log(target)
+    # Targets outside the source are extrapolated from the end points
+    idx = np.clip(np.searchsorted(ls, lt, side='right') - 1, 0, len(ls) - 2)
+    step = ls[idx + 1] - ls[idx]
+    w = np.where(step > 0, (lt - ls[idx]) / np.where(step > 0, step, 1), 0.0)
+    weights = (order, idx, w)
+
+    _weights[key] = weights
+    while len(_weights) > _weights_max:
+        _weights.popitem(last=False)
+    return weights
+
 class CompFun:
     def __init__(self, comp, freq):
         if not len(comp) == len(freq):
@@ -33,11 +110,66 @@ class CompFun:
         return (np.array_equal(self.c, other.c)
                 and np.array_equal(self.f, other.f))
 
+    def resample(self, freq):
+        """
+        Interpolates onto other frequencies, linearly in log frequency of the
+        log magnitude and unwrapped phase. The interpolation weights are cached
+        for each pair of grids, so resampling more functions between the same
+        grids is a gather and a multiply-add.
+
+        Parameters
+        ----------
+        freq : np.array
+            The new frequencies, all positive. Ones outside this function's
+            range are extrapolated from its end points.
+
+        Returns
+        -------
+        CompFun
+            The resampled function.
+        """
+        freq = np.asarray(freq, dtype=np.float64)
+        order, idx, w = _interp_weights(np.asarray(self.f, dtype=np.float64), freq)
+        c = np.asarray(self.c, dtype=np.complex128)
+        if order is not None:
+            c = c[order]
+        # log(c) with the phase unwrapped along the sweep
+        z = np.log(np.maximum(np.abs(c), np.finfo(np.float64).tiny)) + 1j * np.unwrap(np.angle(c))
+        lo = z[idx]
+        return CompFun(np.exp(lo + w * (z[idx + 1] - lo)), freq)
+
+    def align(self, other):
+        """
+        Both functions on this one's frequencies within the range of the other's.
+
+        Returns
+        -------
+        CompFun, CompFun
+            This function and the other, on the same frequencies.
+        """
+        if np.array_equal(self.f, other.f):
+            return self, other
+        lo = max(np.min(self.f), np.min(other.f))
+        hi = min(np.max(self.f), np.max(other.f))
+        keep = (self.f >= lo) & (self.f <= hi)
+        if not np.any(keep):
+            raise ValueError("No overlap between the frequencies of two functions")
+        left = self if np.all(keep) else CompFun(self.c[keep], self.f[keep])
+        return left, other.resample(left.f)
+
+    def _pair(self, other):
+        # The values of both functions on a shared grid
+        if np.array_equal(self.f, other.f):
+            return self.c, other.c, self.f
+        if not _align:
+            raise ValueError("Frequency mismatch between two functions")
+        left, right = self.align(other)
+        return left.c, right.c, left.f
+
     def __add__(self,other):
         if isinstance(other, CompFun):
-            if not np.array_equal(self.f, other.f):
-                raise ValueError("Frequency mismatch between two functions")
-            return CompFun(self.c + other.c, self.f)
+            a, b, f = self._pair(other)
+            return CompFun(a + b, f)
         else:
             return CompFun(self.c + other, self.f)
 
@@ -46,9 +178,8 @@ class CompFun:
 
     def __sub__(self,other):
         if isinstance(other, CompFun):
-            if not np.array_equal(self.f, other.f):
-                raise ValueError("Frequency mismatch between two functions")
-            return CompFun(self.c - other.c, self.f)
+            a, b, f = self._pair(other)
+            return CompFun(a - b, f)
         else:
             return CompFun(self.c - other, self.f)
 
@@ -57,9 +188,8 @@ class CompFun:
             return CompFun(self.c * other.func(self.f), self.f)
 
         elif isinstance(other, CompFun):
-            if not np.array_equal(self.f, other.f):
-                raise ValueError("Frequency mismatch between two functions")
-            return CompFun(self.c * other.c, self.f)
+            a, b, f = self._pair(other)
+            return CompFun(a * b, f)
         elif isinstance(other, float):
             return CompFun(self.c * other, self.f)
     def __truediv__(self,other):
@@ -67,9 +197,8 @@ class CompFun:
         if isinstance(other, AnCompFun):
             return CompFun(self.c / other.func(self.f), self.f)
         elif isinstance(other, CompFun):
-            if not np.array_equal(self.f, other.f):
-                raise ValueError("Frequency mistmatch between two functions")
-            return CompFun(self.c / other.c, self.f)
+            a, b, f = self._pair(other)
+            return CompFun(a / b, f)
         elif isinstance(other, float):
             return CompFun(self.c / other, self.f)
 
@@ -88,25 +217,57 @@ class CompFun:
         else:
             np.savetxt(filename,np.transpose(np.array([self.f,np.real(self.c),np.imag(self.c)])))
 
-# Combines the dataset of two CompFun objects.
-# Averages data points of identical frequency, concats other points.
-def merge(cm1, cm2):
-    c = cm1.c
-    f = cm1.f
-    newfs = []
-    newcs = []
-    for i, freq in enumerate(cm2.f):
-        if freq in f:
-            j = np.argmin(np.abs(f - freq))
-            c[j] = np.average([cm1.c[j], cm2.c[i]])
-        else:
-            newfs.append(freq)
-            newcs.append(cm2.c[i])
-    f = np.append(f, np.array(newfs))
-    c = np.append(c, np.array(newcs))
-    combined = zip(c,f)
-    combined = sorted(combined, key = lambda pair: pair[1])
-    c,f = map(list, zip(*combined))
+def merge(*funcs, tol=0.0, weights=None):
+    """
+    Combines the datasets of any number of CompFun objects into one, sorted
+    by frequency. Points whose frequencies are within tol of each other
+    (chained from one to the next) are averaged together, all other points
+    are kept as they are. The inputs aren't modified.
+
+    Parameters
+    ----------
+    *funcs : CompFun
+        The sweeps to merge.
+    tol : float, optional
+        Largest difference between frequencies treated as the same,
+        by default 0.0 so only identical frequencies are averaged.
+    weights : [float or np.array], optional
+        Weight of each sweep, either one number or one per point, used when
+        averaging the values (and frequencies) of coincident points.
+        By default every point is weighted equally.
+
+    Returns
+    -------
+    CompFun
+        The merged sweep.
+    """
+    if len(funcs) == 1 and not isinstance(funcs[0], CompFun):
+        funcs = tuple(funcs[0])
+    f = np.concatenate([np.asarray(func.f, dtype=np.float64) for func in funcs])
+    c = np.concatenate([np.asarray(func.c, dtype=np.complex128) for func in funcs])
+    if weights is None:
+        w = np.ones(len(f))
+    else:
+        if len(weights) != len(funcs):
+            raise ValueError("Need one weight per function")
+        w = np.concatenate([np.broadcast_to(np.asarray(wt, dtype=np.float64), np.shape(func.f))
+                            for wt, func in zip(weights, funcs)])
+
+    if len(f) == 0:
+        return CompFun(c, f)
+    order = np.argsort(f, kind='stable')
+    f = f[order]
+    c = c[order]
+    w = w[order]
+
+    # Start of each group of coincident frequencies
+    starts = np.concatenate(([0], np.nonzero(np.diff(f) > tol)[0] + 1))
+    wsum = np.add.reduceat(w, starts)
+    c = np.add.reduceat(c * w, starts) / wsum
+    if tol > 0:
+        f = np.add.reduceat(f * w, starts) / wsum
+    else:
+        f = f[starts]
     return CompFun(c, f)
 
 def load(filename, polar=True):
@@ -157,47 +318,360 @@ class AnCompFun:
     def plot(self,freq, **kwargs):
         return self.apply(freq).plot(**kwargs)
 
+##############################
+# Rational Complex Functions #
+##############################
+class RatCompFun(AnCompFun):
+    """
+    Rational transfer function of s = 2j*pi*f, stored as its zeros, poles
+    and gain, along with a pure time delay:
+        H(f) = gain * prod(s - zeros) / prod(s - poles) * exp(-s * delay)
+    Products and quotients with other RatCompFuns or numbers combine the
+    roots, so any chain of filters is evaluated in a single pass over the
+    frequencies. Anything else falls back to AnCompFun.
+    """
+    def __init__(self, zeros=(), poles=(), gain=1.0, delay=0.0):
+        self.zeros = np.asarray(zeros, dtype=np.complex128).ravel()
+        self.poles = np.asarray(poles, dtype=np.complex128).ravel()
+        self.gain = gain
+        self.delay = delay
+        self._cancel()
+
+    @classmethod
+    def from_poly(cls, num, den, delay=0.0):
+        """
+        From numerator and denominator polynomial coefficients in s,
+        highest power first.
+        """
+        num = np.trim_zeros(np.atleast_1d(np.asarray(num, dtype=np.complex128)), 'f')
+        den = np.trim_zeros(np.atleast_1d(np.asarray(den, dtype=np.complex128)), 'f')
+        if len(den) == 0:
+            raise ZeroDivisionError("Denominator is zero")
+        if len(num) == 0:
+            return cls(gain=0.0)
+        gain = num[0] / den[0]
+        return cls(np.roots(num), np.roots(den), gain.real if gain.imag == 0 else gain, delay)
+
+    def _cancel(self):
+        # Remove zeros and poles that are the same
+        zeros = list(self.zeros)
+        poles = []
+        for p in self.poles:
+            match = [i for i, z in enumerate(zeros) if np.isclose(z, p, rtol=1E-12, atol=0)]
+            if match:
+                zeros.pop(match[0])
+            else:
+                poles.append(p)
+        self.zeros = np.array(zeros, dtype=np.complex128)
+        self.poles = np.array(poles, dtype=np.complex128)
+
+    def poly(self):
+        """
+        Numerator and denominator polynomial coefficients in s, highest power first.
+        """
+        return self.gain * np.poly(self.zeros), np.poly(self.poles)
+
+    def func(self, f):
+        s = 2j * np.pi * np.asarray(f, dtype=np.float64)
+        out = np.full(s.shape, self.gain, dtype=np.complex128)
+        for z in self.zeros:
+            out *= s - z
+        for p in self.poles:
+            out /= s - p
+        if self.delay:
+            out *= np.exp(-s * self.delay)
+        return out
+
+    def __mul__(self, other):
+        if isinstance(other, RatCompFun):
+            return RatCompFun(np.concatenate((self.zeros, other.zeros)),
+                              np.concatenate((self.poles, other.poles)),
+                              self.gain * other.gain, self.delay + other.delay)
+        elif isinstance(other, (int, float, complex)):
+            return RatCompFun(self.zeros, self.poles, self.gain * other, self.delay)
+        return super().__mul__(other)
+
+    def __rmul__(self, other):
+        if isinstance(other, (int, float, complex)):
+            return self * other
+        return NotImplemented
+
+    def __truediv__(self, other):
+        if isinstance(other, RatCompFun):
+            return RatCompFun(np.concatenate((self.zeros, other.poles)),
+                              np.concatenate((self.poles, other.zeros)),
+                              self.gain / other.gain, self.delay - other.delay)
+        elif isinstance(other, (int, float, complex)):
+            return RatCompFun(self.zeros, self.poles, self.gain / other, self.delay)
+        return super().__truediv__(other)
+
+    def __add__(self, other):
+        # Sums are only rational if the delays match
+        if isinstance(other, RatCompFun) and other.delay == self.delay:
+            n1, d1 = self.poly()
+            n2, d2 = other.poly()
+            return RatCompFun.from_poly(np.polyadd(np.polymul(n1, d2), np.polymul(n2, d1)),
+                                        np.polymul(d1, d2), self.delay)
+        return super().__add__(other)
+
+    def __repr__(self):
+        return "RatCompFun(zeros=%s, poles=%s, gain=%s, delay=%s)" % (
+            self.zeros, self.poles, self.gain, self.delay)
+
 # High Pass Filter with cutoff frequency
 def hp(cutoff):
     wc = 2 * np.pi * cutoff
-    return AnCompFun(lambda f : 2 * np.pi * f/wc / (2 * np.pi * f/wc - 1j))
+    return RatCompFun([0.0], [-wc], 1.0)
 
 # Low Pass Filter with cutoff frequency
 def lp(cutoff):
     wc = 2 * np.pi * cutoff
-    return AnCompFun(lambda f: -1j / ((2 * np.pi * f/wc) - 1j))
+    return RatCompFun([], [-wc], wc)
 
 # PI Transfer function with corner frequency and HF gain
 def pi(corner, gain):
-    return AnCompFun(lambda f: gain * (1 - 1.0j * corner / f))
+    return RatCompFun([-2 * np.pi * corner], [0.0], gain)
 
 # Harmonic Oscillator T.F. with resonant frequency and damping rate.
 def ho(res, damp):
     wres = 2 * np.pi * res
     wdamp = 2 * np.pi * damp
-    return AnCompFun(lambda f: 1 / (1 + 1j * 2 * np.pi * f * wdamp / wres**2 - ((2 * np.pi * f)/wres)**2))
+    return RatCompFun.from_poly([wres**2], [1, wdamp, wres**2])
 
 # Lag Compensator with frequency and amplitude
 def lag(ff,a):
     assert a <= 1 and a > 0, "Invalid 'a' value in lag filter"
-    return AnCompFun(lambda f: a*(1 + 1j*f/ff)/(a + 1j * f/ff))
+    wf = 2 * np.pi * ff
+    return RatCompFun([-wf], [-a * wf], a)
 
 # Lead Compensator with frequency and amplitude
 def lead(ff,a):
     assert a <= 1 and a > 0, "Invalid 'a' value in lead filter"
-    return AnCompFun(lambda f: a*(1 + 1j*f/ff)/(a*1j*f/ff + 1))
+    wf = 2 * np.pi * ff
+    return RatCompFun([-wf], [-wf / a], 1.0)
 
 # Flat gain amplification
 def amp(a):
-    return AnCompFun(lambda f: np.ones(np.size(f)) * a)
+    return RatCompFun(gain=a)
 
 # Time delay
 def delay(delta_t):
-    return AnCompFun(lambda f: np.exp(-1j * 2 * np.pi * f * delta_t))
+    return RatCompFun(delay=delta_t)
 
 # LFGL filter defined by two resistances and two capacitances.
 def lfgl(R1,R2,C1,C2):
-    return AnCompFun(lambda f: (R2 * (-1j + C1*R1*2*np.pi*f))/(-1j*(R1+R2)+(C1+C2)*R1*R2*2*np.pi*f))
+    return RatCompFun.from_poly([R2*C1*R1, R2], [(C1+C2)*R1*R2, R1+R2])
+
+##################
+# Vector Fitting #
+##################
+# Poles are kept in real form: one column per real pole, and two per complex
+# pair a, conj(a), spanning 1/(s-a) + 1/(s-conj(a)) and j/(s-a) - j/(s-conj(a)).
+# The coefficients (c1, c2) of a pair are the residue c1 + j c2 of a.
+def _vf_split(poles):
+    real = poles[poles.imag == 0].real
+    pairs = poles[poles.imag > 0]
+    return real, pairs
+
+def _vf_basis(s, real, pairs):
+    cols = [1 / (s[:, None] - real[None, :])]
+    if len(pairs):
+        p = 1 / (s[:, None] - pairs[None, :])
+        q = 1 / (s[:, None] - pairs.conj()[None, :])
+        cols += [p + q, 1j * p - 1j * q]
+    return np.concatenate(cols, axis=1)
+
+def _vf_state(real, pairs):
+    # Real state space (A, b) whose c^T (sI - A)^-1 b is the basis above,
+    # columns in the same order.
+    nr = len(real)
+    nc = len(pairs)
+    n = nr + 2 * nc
+    A = np.zeros((n, n))
+    b = np.zeros(n)
+    A[:nr, :nr] = np.diag(real)
+    b[:nr] = 1.0
+    i1 = nr + np.arange(nc)
+    i2 = i1 + nc
+    A[i1, i1] = pairs.real
+    A[i2, i2] = pairs.real
+    A[i1, i2] = pairs.imag
+    A[i2, i1] = -pairs.imag
+    b[i1] = 2.0
+    return A, b
+
+def _vf_lstsq(M, h):
+    # Least squares over the real and imaginary parts, with normalized columns.
+    M = np.concatenate((M.real, M.imag))
+    h = np.concatenate((h.real, h.imag))
+    norms = np.linalg.norm(M, axis=0)
+    norms[norms == 0] = 1.0
+    x = np.linalg.lstsq(M / norms, h, rcond=None)[0]
+    return x / norms
+
+def _vf_start(f, npoles):
+    w = 2 * np.pi * np.abs(f[f != 0])
+    betas = np.geomspace(np.min(w), np.max(w), max(npoles // 2, 1))
+    poles = list(-betas[:npoles // 2] / 100 + 1j * betas[:npoles // 2])
+    if npoles % 2:
+        poles.append(-np.sqrt(np.min(w) * np.max(w)) + 0j)
+    return np.array(poles, dtype=np.complex128)
+
+def vector_fit(func, npoles, iters=10, weights=None, const=True, stable=True, delay=0.0, tol=1E-10):
+    """
+    Fits a rational transfer function to a measured CompFun by vector fitting:
+    the poles are relocated iteratively, each step a linear least squares solve
+    for the residues of the data and of a weighting function whose zeros are
+    the next poles. The residues are then solved for once more with the final
+    poles. Complex poles are kept as conjugate pairs, so the model is real.
+
+    Parameters
+    ----------
+    func : CompFun
+        The measured transfer function.
+    npoles : int
+        Number of poles, the order of the model.
+    iters : int, optional
+        Largest number of pole relocations, by default 10
+    weights : np.array, optional
+        Weight of each point in the least squares. By default 1/|func.c|,
+        so the relative error is fit evenly across decades.
+    const : bool, optional
+        If True the model has a constant term, so as many zeros as poles,
+        otherwise it's strictly proper, by default True
+    stable : bool, optional
+        If True, poles in the right half plane are flipped into the left
+        after each relocation, by default True
+    delay : float, optional
+        A known time delay, removed from the data before fitting and included
+        in the model, by default 0.0
+    tol : float, optional
+        The iterations stop once no pole moves by more than tol relative to its
+        magnitude, by default 1E-10
+
+    Returns
+    -------
+    RatCompFun
+        The fit model.
+    """
+    f = np.asarray(func.f, dtype=np.float64)
+    h = np.asarray(func.c, dtype=np.complex128)
+    s = 2j * np.pi * f
+    if delay:
+        h = h * np.exp(s * delay)
+    if weights is None:
+        weights = 1 / np.maximum(np.abs(h), np.finfo(np.float64).tiny)
+    w = np.asarray(weights, dtype=np.float64)
+    if npoles < 1:
+        raise ValueError("Need at least one pole")
+    if 2 * len(f) < 2 * npoles + const:
+        raise ValueError("Not enough points for %d poles" % npoles)
+
+    poles = _vf_start(f, npoles)
+    for _ in range(iters):
+        real, pairs = _vf_split(poles)
+        phi = _vf_basis(s, real, pairs)
+        # phi c + d - h phi c~ = h, where sigma = 1 + phi c~
+        M = [phi]
+        if const:
+            M.append(np.ones((len(s), 1)))
+        M.append(-h[:, None] * phi)
+        x = _vf_lstsq(np.concatenate(M, axis=1) * w[:, None], h * w)
+        ctilde = x[-npoles:]
+
+        # Zeros of sigma become the new poles
+        A, b = _vf_state(real, pairs)
+        new = np.linalg.eigvals(A - np.outer(b, ctilde)).astype(np.complex128)
+        if stable:
+            new = np.where(new.real > 0, -new.real + 1j * new.imag, new)
+        # Keep one of each conjugate pair, and the real ones
+        new = new[new.imag >= 0]
+        # A pair can split into two real poles, and back
+        same = len(new) == len(poles) and np.all(
+            np.abs(np.sort_complex(new) - np.sort_complex(poles)) <= tol * np.abs(np.sort_complex(poles)))
+        poles = new
+        if same:
+            break
+
+    # Residues with the final poles
+    real, pairs = _vf_split(poles)
+    phi = _vf_basis(s, real, pairs)
+    M = [phi, np.ones((len(s), 1))] if const else [phi]
+    x = _vf_lstsq(np.concatenate(M, axis=1) * w[:, None], h * w)
+    c = x[:npoles]
+    d = x[npoles] if const else 0.0
+
+    # Zeros from the generalized eigenvalues of the state space system
+    A, b = _vf_state(real, pairs)
+    n = npoles
+    S = np.zeros((n + 1, n + 1))
+    S[:n, :n] = A
+    S[:n, n] = b
+    S[n, :n] = c
+    S[n, n] = d
+    T = np.zeros((n + 1, n + 1))
+    T[:n, :n] = np.eye(n)
+    zeros = la.eigvals(S, T)
+    zeros = zeros[np.isfinite(zeros)]
+    allpoles = np.concatenate((real, pairs, pairs.conj()))
+
+    # Gain matched to the pole-residue form where it's largest
+    i = np.argmax(np.abs(h))
+    model = RatCompFun(zeros, allpoles, 1.0, delay)
+    ref = phi[i] @ c + d
+    gain = ref / RatCompFun(zeros, allpoles).func(f[i])
+    model.gain = gain.real
+    return model
+
+def _vector_fit_row(args):
+    func, npoles, kwargs = args
+    model = vector_fit(func, npoles, **kwargs)
+    err = model.func(func.f) / func.c - 1
+    return {'model' : model,
+            'rms' : np.sqrt(np.mean(np.abs(err)**2)),
+            'max' : np.max(np.abs(err)),
+            'success' : True}
+
+def vector_fit_many(funcs, npoles, workers=None, executor='process', **kwargs):
+    """
+    Fits many sweeps with vector_fit in parallel.
+
+    Parameters
+    ----------
+    funcs : [CompFun]
+        The measured transfer functions.
+    npoles : int
+        Number of poles of each model.
+    workers : int, optional
+        Number of processes (or threads) to fit with, by default the number of CPUs.
+    executor : str, optional
+        'process' or 'thread', by default 'process'
+    kwargs :
+        Passed on to vector_fit.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per sweep, with the RatCompFun 'model', and the 'rms' and 'max'
+        relative error of the model over the sweep. Fits that raised an error
+        have success False and the error in 'error'.
+    """
+    if executor == 'process':
+        pool = data._process_pool(workers)
+    elif executor == 'thread':
+        pool = futures.ThreadPoolExecutor(workers)
+    else:
+        raise ValueError("executor must be 'process' or 'thread'")
+
+    with pool:
+        jobs = [pool.submit(_vector_fit_row, (func, npoles, kwargs)) for func in funcs]
+        rows = []
+        for job in jobs:
+            try:
+                rows.append(job.result())
+            except Exception as e:
+                rows.append({'success' : False, 'error' : e})
+    return pd.DataFrame(rows)
 
 ############
 # Plotting #
@@ -281,21 +755,176 @@ def plot_funcs(funcs, freq=np.array([]), labels=[], unwrap=False, lines=False, *
 ############
 # Analysis #
 ############
-# These likely don't work.
-def gain_margin(function):
-    if isinstance(function, AnCompFun):
-        z = opt.root_scalar(lambda f: np.angle(function.func(f)) + np.pi, bracket=[0,1E15], x0=1000.0)
-        return np.abs(function.f(z))
-    elif isinstance(function, CompFun):
-        z = function.f[np.argmin(np.abs(np.angle(function.c)))]
-        return np.abs(function.c[z])
-    raise ValueError("Wrong Type")
-
-def phase_margin(function):
-    if isinstance(function, AnCompFun):
-        z = opt.root_scalar(lambda f: np.abs(function.func(f)) - 1, bracket=[0.,1E15], x0=1000.0)
-        return np.angle(function.f(z))
-    elif isinstance(function, CompFun):
-        z = function.f[np.argmin(np.abs(np.abs(function.c) - 1))]
-        return np.angle(function.c[z])
-    raise ValueError("Wrong Type")
\ No newline at end of file
+def _numeric_crossings(f, c):
+    """
+    Unity gain and -180 degree crossings of a stack of loops c (M, N) on a
+    shared grid f (N,), found from sign changes and interpolated linearly in
+    log frequency, log magnitude and unwrapped phase.
+
+    Returns
+    -------
+    (np.array, np.array, np.array), (np.array, np.array, np.array)
+        The loop index, frequency and phase (radians) of each gain crossover,
+        and the loop index, frequency and magnitude of each phase crossover.
+    """
+    lf = np.log(f)
+    g = np.log(np.maximum(np.abs(c), np.finfo(np.float64).tiny))
+    # Unwrapped phase, from the phase step between neighbouring points
+    phase = np.empty(c.shape)
+    phase[:, 0] = np.angle(c[:, 0])
+    phase[:, 1:] = np.angle(c[:, 1:] * c[:, :-1].conj())
+    np.cumsum(phase, axis=-1, out=phase)
+
+    # Gain crossovers
+    above = g >= 0
+    rows, i = np.nonzero(above[:, :-1] != above[:, 1:])
+    t = g[rows, i] / (g[rows, i] - g[rows, i + 1])
+    gain = (rows,
+            np.exp(lf[i] + t * (lf[i + 1] - lf[i])),
+            phase[rows, i] + t * (phase[rows, i + 1] - phase[rows, i]))
+
+    # Phase crossovers, of -180 degrees plus any number of turns
+    k = np.floor((phase + np.pi) / (2 * np.pi))
+    rows, i = np.nonzero(k[:, :-1] != k[:, 1:])
+    level = -np.pi + 2 * np.pi * np.maximum(k[rows, i], k[rows, i + 1])
+    t = (level - phase[rows, i]) / (phase[rows, i + 1] - phase[rows, i])
+    phase = (rows,
+             np.exp(lf[i] + t * (lf[i + 1] - lf[i])),
+             np.exp(g[rows, i] + t * (g[rows, i + 1] - g[rows, i])))
+    return gain, phase
+
+def _analytic_crossings(func, freq):
+    """
+    Crossings of an analytic loop, bracketed on the grid freq and then
+    solved for with Brent's method in log frequency.
+    """
+    freq = np.asarray(freq, dtype=np.float64)
+    c = np.asarray(func.func(freq), dtype=np.complex128)
+    phase = np.unwrap(np.angle(c))
+    (_, gi, _), (_, pi_, _) = _numeric_crossings(freq, c[None, :])
+
+    # Bracket of each interpolated crossing on the grid
+    lf = np.log(freq)
+    gain_f = []
+    for x in np.searchsorted(freq, gi) - 1:
+        x = min(max(x, 0), len(freq) - 2)
+        gain_f.append(opt.brentq(lambda l: np.log(np.abs(func.func(np.exp(l)))),
+                                 lf[x], lf[x + 1]))
+    phase_f = []
+    for x in np.searchsorted(freq, pi_) - 1:
+        x = min(max(x, 0), len(freq) - 2)
+        k = np.floor((phase[x:x+2] + np.pi) / (2 * np.pi))
+        level = -np.pi + 2 * np.pi * np.max(k)
+        # Phase continued from the left end of the bracket
+        phase_f.append(opt.brentq(lambda l: phase[x] + np.angle(func.func(np.exp(l)) / c[x]) - level,
+                                  lf[x], lf[x + 1]))
+    gain_f = np.exp(np.array(gain_f))
+    phase_f = np.exp(np.array(phase_f))
+    return ((np.zeros(len(gain_f), dtype=np.intp), gain_f, np.angle(func.func(gain_f))),
+            (np.zeros(len(phase_f), dtype=np.intp), phase_f, np.abs(func.func(phase_f))))
+
+def _margins(n, gain, phase):
+    # Gathers the crossings of n loops into their margins
+    grows, gf, gphase = gain
+    prows, pf, pmag = phase
+    pm = np.degrees(np.angle(-np.exp(1j * np.asarray(gphase, dtype=np.float64))))
+    gm = 1 / np.asarray(pmag, dtype=np.float64)
+    # Delay that brings each gain crossover to -180 degrees, none if it's already past it.
+    dm = np.maximum(pm, 0) / 360 / np.asarray(gf, dtype=np.float64)
+    gsplit = np.cumsum(np.bincount(grows, minlength=n))[:-1]
+    psplit = np.cumsum(np.bincount(prows, minlength=n))[:-1]
+    gorder = np.argsort(grows, kind='stable')
+    porder = np.argsort(prows, kind='stable')
+
+    rows = []
+    for gfs, pms, dms, pfs, gms in zip(np.split(gf[gorder], gsplit), np.split(pm[gorder], gsplit),
+                                       np.split(dm[gorder], gsplit), np.split(pf[porder], psplit),
+                                       np.split(gm[porder], psplit)):
+        row = {'gain_margin' : np.inf, 'phase_crossover' : np.nan,
+               'phase_margin' : np.inf, 'gain_crossover' : np.nan,
+               'delay_margin' : np.inf,
+               'gain_crossovers' : gfs, 'phase_margins' : pms,
+               'phase_crossovers' : pfs, 'gain_margins' : gms}
+        if len(gms):
+            # Closest to instability
+            j = np.argmin(np.abs(np.log(gms)))
+            row['gain_margin'] = gms[j]
+            row['phase_crossover'] = pfs[j]
+        if len(pms):
+            j = np.argmin(np.abs(pms))
+            row['phase_margin'] = pms[j]
+            row['gain_crossover'] = gfs[j]
+            row['delay_margin'] = np.min(dms)
+        rows.append(row)
+    return rows
+
+def margins(loops, freq=None):
+    """
+    Finds every unity gain and -180 degree crossover of open loop transfer
+    functions, and their stability margins. Sweeps are searched for sign
+    changes all at once and interpolated in log frequency, analytic functions
+    are bracketed on freq and then solved for exactly.
+
+    Parameters
+    ----------
+    loops : CompFun, AnCompFun, [CompFun or AnCompFun] or np.array
+        The open loop transfer function, a list of them, or an (M, N) array
+        of M loops evaluated at the N frequencies freq.
+    freq : np.array, optional
+        Frequencies to evaluate the analytic functions or array on, sorted.
+        Needed unless all loops are CompFuns.
+
+    Returns
+    -------
+    dict or pd.DataFrame
+        For one loop, a dict of:
+         - 'gain_margin' : factor the gain can rise (or fall) by before
+           instability, at the phase crossover closest to it, inf if none.
+         - 'phase_crossover' : frequency of that crossover.
+         - 'phase_margin' : phase above -180 degrees at the gain crossover
+           closest to it, in degrees, inf if none.
+         - 'gain_crossover' : frequency of that crossover.
+         - 'delay_margin' : smallest added delay that brings any gain crossover
+           to -180 degrees, in seconds, 0 if a phase margin is negative.
+         - 'gain_crossovers', 'phase_margins' : every gain crossover.
+         - 'phase_crossovers', 'gain_margins' : every phase crossover.
+        For many loops, a DataFrame with a row for each.
+    """
+    single = isinstance(loops, (CompFun, AnCompFun))
+    if single:
+        loops = [loops]
+    elif isinstance(loops, np.ndarray):
+        if freq is None:
+            raise ValueError("No frequencies provided for array of loops")
+        loops = np.atleast_2d(loops)
+        rows = _margins(len(loops), *_numeric_crossings(np.asarray(freq, dtype=np.float64), loops))
+        return pd.DataFrame(rows)
+
+    rows = [None] * len(loops)
+    # Sweeps on the same grid are stacked together
+    grids = {}
+    for idx, loop in enumerate(loops):
+        if isinstance(loop, AnCompFun):
+            if freq is None:
+                raise ValueError("No frequencies provided for analytic function")
+            rows[idx] = _margins(1, *_analytic_crossings(loop, freq))[0]
+        elif isinstance(loop, CompFun):
+            key = (len(loop.f), np.asarray(loop.f).tobytes())
+            grids.setdefault(key, []).append(idx)
+        else:
+            raise ValueError("Wrong Type")
+    for idxs in grids.values():
+        f = np.asarray(loops[idxs[0]].f, dtype=np.float64)
+        c = np.array([loops[idx].c for idx in idxs], dtype=np.complex128)
+        for idx, row in zip(idxs, _margins(len(idxs), *_numeric_crossings(f, c))):
+            rows[idx] = row
+
+    if single:
+        return rows[0]
+    return pd.DataFrame(rows)
+
+def gain_margin(function, freq=None):
+    return margins(function, freq)['gain_margin']
+
+def phase_margin(function, freq=None):
+    return margins(function, freq)['phase_margin']
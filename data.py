@@ -2,6 +2,17 @@ import numpy as np
 import pandas as pd
 import spinmob as sp
 import re
+import os
+import glob
+import functools
+import warnings
+import pickle
+import collections.abc
+import multiprocessing
+from concurrent import futures
+
+from . import cache as _c
+from . import tttr as _t
 
 ################
 # Lock-In Data #
@@ -10,30 +21,39 @@ import re
 def get_delim(file):
     with open(file, "r") as f:
         # Reads file line by line, so that only one line needs to be read
-        for _, line in enumerate(f):
-            # ignore comments and header if present
-            if re.search("[a-df-z]", line) is not None or line.strip() == "":
-                continue
-            
-            for delim in [",", ";", ":", "\t"]:
-                if delim in line:
-                    return delim
-
-    print("No delimiters found")
-    return ""
+        delim = _find_delim(f)
+    if delim is None:
+        print("No delimiters found")
+        return ""
+    return delim
 
 # Determine how many lines of header are in a file.
 def get_header(file):
     with open(file, "r") as f:
-        i = 0
-        for _, line in enumerate(f):
-            if re.search("[a-df-zA-DF-Z]", line) is not None or line.strip() == "":
-                i += 1
-            else:
-                break
-                
-        return i
+        return _count_header(f)
 
+# Same as get_delim, but over any iterable of lines.
+# Returns None if no delimiter is found.
+def _find_delim(lines):
+    for line in lines:
+        # ignore comments and header if present
+        if re.search("[a-df-z]", line) is not None or line.strip() == "":
+            continue
+
+        for delim in [",", ";", ":", "\t"]:
+            if delim in line:
+                return delim
+    return None
+
+# Same as get_header, but over any iterable of lines.
+def _count_header(lines):
+    i = 0
+    for line in lines:
+        if re.search("[a-df-zA-DF-Z]", line) is not None or line.strip() == "":
+            i += 1
+        else:
+            break
+    return i
 
 # Read data from csv file. 
 def read_csv_old(file, names=True, delim=None, head=None):
@@ -46,47 +66,296 @@ def read_csv_old(file, names=True, delim=None, head=None):
     else:
         return np.genfromtxt(file, delimiter=delim, skip_header=head)
 
-def read(filename, **kwargs):
+###################
+# Reader Registry #
+###################
+# Number of bytes read from the start of a file to figure out its type.
+SNIFF_SIZE = 65536
+
+# Registered readers, checked in order of registration.
+_readers = []
+
+def register_reader(func, magic=None, extensions=(), hints=None):
+    """
+    Registers a file reading function to be dispatched to by `read`.
+
+    Parameters
+    ----------
+    func : callable
+        Reading function with signature func(filename, **kwargs).
+    magic : bytes, optional
+        Bytes that a file must begin with to be read by func, by default None
+    extensions : [str], optional
+        File extensions (e.g. '.ptu') to use func for when no magic bytes match,
+        by default none.
+    hints : callable, optional
+        Function taking the block of bytes read from the start of the file
+        and returning a dict of keyword arguments to pass on to func, so that
+        func doesn't need to scan the file for them again. By default None
+
+    Returns
+    -------
+    callable
+        func, so that this can be used as a decorator.
+    """
+    _readers.append({'func' : func,
+                     'magic' : magic,
+                     'extensions' : tuple(ext.lower() for ext in extensions),
+                     'hints' : hints})
+    return func
+
+def sniff(filename):
+    """
+    Reads the start of a file once and figures out which registered reader
+    to use for it. Files are first matched by magic bytes, then by extension,
+    falling back to read_csv.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the file to check.
+
+    Returns
+    -------
+    callable, dict
+        The reading function to use and the keyword arguments it should be
+        given, as determined from the start of the file.
+    """
+    with open(filename, 'rb') as f:
+        block = f.read(SNIFF_SIZE)
+
+    reader = None
+    for entry in _readers:
+        if entry['magic'] is not None and block.startswith(entry['magic']):
+            reader = entry
+            break
+    else:
+        ext = os.path.splitext(filename)[1].lower()
+        for entry in _readers:
+            if ext and ext in entry['extensions']:
+                reader = entry
+                break
+
+    if reader is None:
+        return read_csv, _csv_hints(block)
+    if reader['hints'] is None:
+        return reader['func'], {}
+    return reader['func'], reader['hints'](block)
+
+def _block_lines(block):
+    lines = block.decode('utf-8', errors='replace').splitlines()
+    # Last line might have been cut off by the end of the block
+    if len(block) >= SNIFF_SIZE:
+        lines = lines[:-1]
+    return lines
+
+# Delimiter shared by every line of data in lines, or None if there isn't
+# exactly one, e.g. a decimal comma, in which case pandas sniffs it instead.
+def _unique_delim(lines):
+    data = [line for line in lines
+            if re.search("[a-df-z]", line) is None and line.strip() != ""]
+    if not data:
+        return None
+    found = [delim for delim in [",", ";", ":", "\t"]
+             if len(set(line.count(delim) for line in data)) == 1 and delim in data[0]]
+    return found[0] if len(found) == 1 else None
+
+# Header line and delimiter of a csv file, if they can be found in block.
+def _csv_hints(block):
+    lines = _block_lines(block)
+    hints = {}
+    head = _count_header(lines)
+    # Only trust the header count if a line of data was actually reached,
+    # and leave files without column names to read_csv.
+    if 0 < head < len(lines):
+        hints['head'] = head - 1
+    delim = _unique_delim(lines)
+    if delim is not None:
+        hints['delim'] = delim
+    return hints
+
+# Header length of a labview scan file, given on the first line.
+def _scan_hints(block):
+    first = _block_lines(block)[0]
+    return {'head' : int(re.split(',|:', first)[2])}
+
+#########
+# Cache #
+#########
+# Cache of parsed files used by read, see enable_cache.
+_file_cache = None
+
+def enable_cache(directory=None, max_size=2**30):
+    """
+    Turns on caching of the results of read. Parsed files are stored in a
+    binary format keyed by the file's path, modification time, size and the
+    keyword arguments given to read. Cached arrays are memory-mapped when loaded.
+
+    Parameters
+    ----------
+    directory : string, optional
+        Where to store the cache, by default ~/.cache/cavspy
+    max_size : int, optional
+        Size of the cache in bytes above which the least recently used
+        files are removed, by default 1 GiB
+
+    Returns
+    -------
+    cache.DiskCache
+        The cache being used.
+    """
+    global _file_cache
+    if directory is None:
+        directory = os.path.join(os.path.expanduser('~'), '.cache', 'cavspy')
+    _file_cache = _c.DiskCache(directory, max_size)
+    return _file_cache
+
+def disable_cache():
+    """
+    Turns off caching of the results of read. Cached files are left on disk.
+    """
+    global _file_cache
+    _file_cache = None
+
+def read(filename, _cache=True, **kwargs):
     """
     Checks if a file is of the following type, and uses the appropriate function
     to read it:
      - Spinmob Binary
      - Picoharp 300 Histogram
+     - PicoQuant .ptu and .phu files, see tttr
      - Custom scan file from labview
+     - Any other reader added with register_reader
 
     Otherwise, reads the file as a csv.
+    The start of the file is only read once to figure this out, see sniff.
 
     Parameters
     ----------
     filename : string
         Path to the file to read
 
+    _cache : bool, optional
+        If False, skip the cache even if it's turned on, see enable_cache. By default True.
+        Underscored so it never collides with a keyword of the reader.
+
     kwargs :
         key word arguments to pass to whatever file reading function gets called.
+        These take precedence over anything determined from the file.
 
     Returns
     -------
     object
         Some sort of data container, depending on the filetype and kwargs
     """
+    key = None
+    if _cache and _file_cache is not None:
+        stat = os.stat(filename)
+        key = _file_cache.key(os.path.abspath(filename), stat.st_mtime_ns, stat.st_size,
+                         sorted(kwargs.items()))
+        result = _file_cache.get(key)
+        if result is not None:
+            return result
+
+    func, hints = sniff(filename)
+    hints.update(kwargs)
+    result = func(filename, **hints)
+
+    if key is not None:
+        _file_cache.put(key, result)
+    return result
+
+# Process pool used by the parallel helpers. Numba's tbb thread pool isn't
+# fork safe, so forking after any parallel kernel has run can deadlock the
+# workers. Where it's available, they're forked from a clean server instead.
+def _process_pool(workers, **kwargs):
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        kwargs.setdefault('mp_context', multiprocessing.get_context('forkserver'))
+    return futures.ProcessPoolExecutor(workers, **kwargs)
+
+# Reads a file for read_many, making sure lazy scans are loaded
+# by the worker rather than whoever gets the result.
+def _read_loaded(filename, kwargs):
+    result = read(filename, **kwargs)
+    if isinstance(result, Scan):
+        result.raw_data
+    return result
+
+def read_many(paths, workers=None, executor='process', ordered=True, max_in_flight=None, **kwargs):
+    """
+    Reads many files in parallel with read, yielding the results as they come in.
+    Files that fail to read don't stop the rest, their exception is given
+    in place of the result.
+
+    Parameters
+    ----------
+    paths : string or [string]
+        Either a glob pattern (e.g. 'data/*.csv') or a list of paths.
+    workers : int, optional
+        Number of processes or threads to read with, by default the number of CPUs.
+    executor : str, optional
+        'process' or 'thread', by default 'process'. Threads avoid copying the
+        results between processes, but only help when reading is IO bound.
+    ordered : bool, optional
+        If True, results are given in the same order as paths, otherwise in the
+        order they finish, by default True
+    max_in_flight : int, optional
+        Maximum number of files being read or waiting to be yielded at once,
+        which bounds memory use, by default 2*workers.
+    kwargs :
+        key word arguments passed on to read for each file.
+
+    Yields
+    ------
+    string, object
+        The path of each file, and either what read returned or the exception raised.
+    """
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))
+    if workers is None:
+        workers = os.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    if executor == 'process':
+        pool = _process_pool(workers)
+    elif executor == 'thread':
+        pool = futures.ThreadPoolExecutor(workers)
+    else:
+        raise ValueError("executor must be 'process' or 'thread'")
+
+    todo = iter(enumerate(paths))
+    pending = {}
+    finished = {}
+    next_idx = 0
     try:
-        with open(filename, 'rb') as f:
-            if f.read(14).decode('utf-8') == 'SPINMOB_BINARY':
-                return read_sp_bin(filename, **kwargs)
-        with open(filename, 'r') as f:
-            if f.read(33) == "Scan data, number of header lines":
-                return read_scan(filename, **kwargs)
-        with open(filename, 'r') as f:
-            if f.read(29) == "#PicoHarp 300  Histogram Data":
-                return read_tcspc(filename, **kwargs)
-        with open(filename, 'r') as f:
-            if f.read(4) == "date":
-                return read_michael_scan(filename, **kwargs)
-    except UnicodeDecodeError:
-        print("Unicode Decore Error when Loading")
-        pass
+        while True:
+            # Keep the number of files in memory bounded
+            while len(pending) + len(finished) < max_in_flight:
+                try:
+                    i, path = next(todo)
+                except StopIteration:
+                    break
+                pending[pool.submit(_read_loaded, path, kwargs)] = (i, path)
+            if not pending:
+                break
 
-    return read_csv(filename, **kwargs)
+            done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for fut in done:
+                i, path = pending.pop(fut)
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    result = e
+                if ordered:
+                    finished[i] = (path, result)
+                else:
+                    yield path, result
+
+            while next_idx in finished:
+                yield finished.pop(next_idx)
+                next_idx += 1
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
 
 def read_csv(file, df=False, head=None, delim=None, **kwargs):
     """
@@ -124,46 +393,313 @@ def read_csv(file, df=False, head=None, delim=None, **kwargs):
 def read_sp_bin(file):
     return sp.data.load(file)
 
+# Number of bytes of lines read at once by unpack.
+UNPACK_BLOCK = 1 << 24
+
+# Growable array which doubles its capacity when full,
+# so appending n values costs O(n) overall.
+class _Buffer:
+    def __init__(self, capacity=1024):
+        self._data = np.empty(capacity, dtype=np.float64)
+        self._size = 0
+
+    def append(self, values):
+        end = self._size + len(values)
+        if end > len(self._data):
+            grown = np.empty(max(end, 2 * len(self._data)), dtype=np.float64)
+            grown[:self._size] = self._data[:self._size]
+            self._data = grown
+        self._data[self._size:end] = values
+        self._size = end
+
+    def values(self):
+        return self._data[:self._size].copy()
+
+# Parse a delimited string of numbers in C, falling back to python floats
+# (and their errors) if numpy can't read all of it.
+def _parse_floats(text, delim):
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(text, sep=delim)
+        except (ValueError, DeprecationWarning):
+            pass
+    return np.array([float(x) for x in text.split(delim) if x.strip()])
+
 # Get data from csv file exported from lock in.
 def unpack(filename, fields = [], delim=None):
+    """
+    Unpacks a csv file exported from a zurich lock-in, where each line has the form:
+        chunk;timestamp;size;fieldname;data0;data1;...;dataN
+    Lines are read in large blocks, and all the data of each field within a block
+    is parsed in one go.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the file to unpack.
+    fields : [str], optional
+        Names of the fields to keep, by default keeps all of them.
+    delim : str, optional
+        The delimiter between entries, by default found from the first line of data.
+
+    Returns
+    -------
+    [dict]
+        One dictionary per chunk (run) in the file, mapping each fieldname to its data.
+    """
     chunks = {}
     with open(filename) as f:
         # Skip header line
         next(f)
-        for line in f:
-            # Each line has form:
-            # chunk;timestamp;size;fieldname;data0;data1;...;dataN
+        while True:
+            lines = f.readlines(UNPACK_BLOCK)
+            if not lines:
+                break
             if delim is None:
-                delim = get_delim(filename)
-            entries = line.split(delim)
-
-            chunk = entries[0]
-            # If this is a new chunk, add to chunks dictionary.
-            if chunk not in chunks.keys():
-                chunks[chunk] = {}
-            # Use chunk dictionary for data storage
-            # This separates the runs
-            dic = chunks[chunk]
-
-            fieldname = entries[3]
-            data = np.array([float(x) for x in entries[4:]])
-
-            # Add named dataset to dictionary for each desired fieldname
-            # If no fieldnames specified in fields, just return all.
-            if fieldname in fields or len(fields) == 0:
-                if fieldname not in dic.keys():
-                    dic[fieldname] = data
-                else:
-                    dic[fieldname] = np.concatenate((dic[fieldname], data))
+                delim = next((d for d in [",", ";", ":", "\t"] if d in lines[0]), None)
+
+            # Collect the data strings of each chunk and field in this block
+            block = {}
+            for line in lines:
+                entries = line.split(delim, 4)
+                if len(entries) < 5:
+                    continue
+                chunk = entries[0]
+                # If this is a new chunk, add to chunks dictionary.
+                # This separates the runs
+                if chunk not in chunks:
+                    chunks[chunk] = {}
+
+                # Add named dataset for each desired fieldname
+                # If no fieldnames specified in fields, just return all.
+                fieldname = entries[3]
+                if fieldname in fields or len(fields) == 0:
+                    block.setdefault((chunk, fieldname), []).append(entries[4])
+
+            for (chunk, fieldname), texts in block.items():
+                dic = chunks[chunk]
+                if fieldname not in dic:
+                    dic[fieldname] = _Buffer()
+                dic[fieldname].append(_parse_floats(delim.join(texts), delim))
 
-    data_chunks = list(chunks.values())
+    data_chunks = [{name : buf.values() for name, buf in dic.items()}
+                   for dic in chunks.values()]
     return data_chunks
 
-def read_scan(filename, **kwargs):
-    with open(filename, 'r') as scanfile:
-        head = scanfile.readline()
-        res = re.split(',|:', head)
-        head = int(res[2])
+#########
+# Scans #
+#########
+class Scan(collections.abc.MutableMapping):
+    """
+    Header and data of a scan, as returned by read_scan and read_michael_scan.
+    Header fields are read straight away, but the data is only loaded from the
+    file the first time it's needed, so scans can be listed and filtered by
+    their headers cheaply.
+
+    Scans are mutable mappings of their fields, like the dicts they replace,
+    e.g. scan['Xpoints']. On top of the header fields, the following are
+    computed when accessed:
+     - 'data' : The scan data, flipped to match the converted units. Flips are views.
+     - 'Vxs', 'Vys', 'Vzs' : The scan voltages along each axis.
+     - 'xs', 'ys', 'zs' : The positions along each axis, after convert_units.
+
+    Parameters
+    ----------
+    header : dict
+        The header fields of the scan, must include 'scan_type'.
+    data : np.array, optional
+        The scan data, if already loaded.
+    loader : callable, optional
+        Function with no arguments which loads the scan data, used when data is None.
+    """
+    def __init__(self, header, data=None, loader=None):
+        self.header = dict(header)
+        self._data = data
+        self._loader = loader
+        self._gains = None
+        self._flips = []
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    @property
+    def has_data(self):
+        return self._data is not None or self._loader is not None
+
+    @property
+    def raw_data(self):
+        """
+        The scan data as stored in the file, loading it if needed.
+        """
+        if self._data is None:
+            if self._loader is None:
+                raise KeyError('data')
+            self._data = self._loader()
+        return self._data
+
+    @property
+    def data(self):
+        data = self.raw_data
+        for axes in self._flips:
+            data = np.flip(data, axis=axes)
+        return data
+
+    def voltages(self, axis):
+        """
+        Voltages along the given axis ('x', 'y' or 'z') of the scan.
+        """
+        ax = axis.upper()
+        return np.linspace(float(self.header[ax + 'start (V)']),
+                           float(self.header[ax + 'stop (V)']),
+                           int(self.header[ax + 'points']))
+
+    def positions(self, axis):
+        """
+        Positions along the given axis ('x', 'y' or 'z') of the scan,
+        in the units chosen by convert_units.
+        """
+        if self._gains is None or axis not in self._gains:
+            raise KeyError(axis + 's')
+        return self.voltages(axis) * self._gains[axis]
+
+    def convert_units(self, pz_gain=None, cpz_gain=None, gv_gain=None):
+        """
+        Sets the gains used to convert voltages to positions, and the
+        matching flips of the data. See unit_conversion.
+        """
+        self._gains, self._flips = unit_conversion(self.header['scan_type'],
+                                                   pz_gain, cpz_gain, gv_gain)
+        return self
+
+    def __getitem__(self, key):
+        if key == 'data':
+            return self.data
+        if key in self.header:
+            return self.header[key]
+        if key in ('Vxs', 'Vys', 'Vzs'):
+            return self.voltages(key[1].lower())
+        if key in ('xs', 'ys', 'zs'):
+            return self.positions(key[0])
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'data':
+            self._data = value
+            self._flips = []
+        else:
+            self.header[key] = value
+
+    def __delitem__(self, key):
+        if key == 'data' and self.has_data:
+            self._data = None
+            self._loader = None
+            self._flips = []
+        else:
+            # Computed fields go with the header fields they're computed from.
+            del self.header[key]
+
+    def __contains__(self, key):
+        # Avoid loading the data just to check for it.
+        if key == 'data':
+            return self.has_data
+        if key in self.header:
+            return True
+        try:
+            self[key]
+        except (KeyError, ValueError, TypeError):
+            return False
+        return True
+
+    def __iter__(self):
+        if self.has_data:
+            yield 'data'
+        yield from list(self.header)
+        for key in ['Vxs', 'Vys', 'Vzs', 'xs', 'ys', 'zs']:
+            if key not in self.header and key in self:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "Scan(scan_type=%s, loaded=%s)" % (self.header.get('scan_type'), self.loaded)
+
+    # Used by cache.DiskCache to store scans. Data that hasn't been loaded yet
+    # is left in the file, and only the way to load it is stored.
+    def _cache_state(self):
+        if self.loaded:
+            return {'header' : self.header, 'data' : self._data, 'loader' : None}
+        return {'header' : self.header, 'data' : None, 'loader' : pickle.dumps(self._loader)}
+
+    @classmethod
+    def _from_cache_state(cls, state):
+        loader = state.get('loader')
+        return cls(state['header'], data=state['data'],
+                   loader=None if loader is None else pickle.loads(loader))
+
+def unit_conversion(scan_type, pz_gain=None, cpz_gain=None, gv_gain=None):
+    """
+    Works out the gains for converting scan voltages into positions in um,
+    and which axes of the data need to be flipped so that positions increase.
+
+    Parameters
+    ----------
+    scan_type : int
+        The type of scan, see read_scan.
+    pz_gain : float, optional
+        Piezo gain, amplifier gain (V/V) times piezo sensitivity (nm/V) converted to um.
+    cpz_gain : float, optional
+        Cavity piezo gain, full stroke distance in um over full voltage range.
+    gv_gain : float, optional
+        Galvo gain in um/V.
+
+    Returns
+    -------
+    dict, list
+        The gain for each of 'x', 'y' and 'z' that applies to the scan type, and
+        a list of the axes to pass to np.flip in turn (None flips every axis).
+    """
+    gains = {}
+    flips = []
+    if pz_gain is None:
+        pz_gain = -17 * 77 / 1000
+    if gv_gain is None:
+        gv_gain = 117
+    if cpz_gain is None:
+        cpz_gain = 1.5/640 * -17
+
+    # Piezo scan
+    if scan_type == 0:
+        if pz_gain < 0:
+            flips.append(None)
+        gains = {'x' : pz_gain, 'y' : pz_gain}
+    # Galvo scan
+    if scan_type in [1,2]:
+        if gv_gain < 0:
+            flips.append(None)
+        gains = {'x' : gv_gain, 'y' : gv_gain}
+    # Objective scan, y axis is position in um/12000, x axis is galvo, same as above.
+    # Negative values on the objective mean increasing height, so flip the sign for plotting.
+    if scan_type == 3:
+        flips.append(None if gv_gain < 0 else 0)
+        gains = {'x' : gv_gain, 'y' : -12000} # Not sure why this is the factor, but it is
+    # 3D scan, piezo in x and y with the cavity piezo in z
+    if scan_type == 5:
+        if pz_gain < 0:
+            flips.append((0,1))
+        if cpz_gain < 0:
+            flips.append(2)
+        gains = {'x' : pz_gain, 'y' : pz_gain, 'z' : cpz_gain}
+    return gains, flips
+
+def read_scan(filename, head=None, memmap=None, **kwargs):
+    if head is None:
+        with open(filename, 'r') as scanfile:
+            head = scanfile.readline()
+            res = re.split(',|:', head)
+            head = int(res[2])
     header = pd.read_csv(filename, nrows=head, header=None, sep=':', engine='python')
     # Massage loaded data into nicer dataframe
     header = header.transpose()
@@ -188,26 +724,16 @@ def read_scan(filename, **kwargs):
     if scan['scan_type'] is None:
         scan['scan_type'] = scan.pop('Scan type (0=triangle, 1=raster, 2=raster,slow return)', None)
 
+    # Data is only loaded once it's asked for.
     if scan['scan_type'] == 5:
-        data = load_3d_scan(filename, head)
+        shape = (int(scan['Xpoints']), int(scan['Ypoints']), int(scan['Zpoints']))
+        loader = functools.partial(load_3d_scan, filename, head, shape=shape, memmap=memmap)
     else:
-        data = load_2d_scan(filename, head)
-
-    scan.update({'data' : data})
-    xs = np.linspace(float(scan['Xstart (V)']), float(scan['Xstop (V)']), int(scan['Xpoints']))
-    ys = np.linspace(float(scan['Ystart (V)']), float(scan['Ystop (V)']), int(scan['Ypoints']))
-    scan['Vxs'] = xs
-    scan['Vys'] = ys
-    try:
-        zs = np.linspace(float(scan['Zstart (V)']), float(scan['Zstop (V)']), int(scan['Zpoints']))
-        scan['Vzs'] = zs
-    except KeyError:
-        pass
-    return scan
+        loader = functools.partial(load_2d_scan, filename, head)
+    return Scan(scan, loader=loader)
 
 def read_michael_scan(filename, **kwargs):
-    data = sp.data.load(filename)
-    header = data.headers
+    header = sp.data.load(filename, header_only=True).headers
     scan = {'scan_type' : 2,
             'Xstart (V)' : header['Vx_min'],
             'Xstop (V)' : header['Vx_max'],
@@ -215,33 +741,99 @@ def read_michael_scan(filename, **kwargs):
             'Ystop (V)' : header['Vy_max'],
             'Xpoints' : header['Nx'],
             'Ypoints' : header['Ny']}
-    scan['data'] = np.array(data)
-    xs = np.linspace(float(scan['Xstart (V)']), float(scan['Xstop (V)']), int(scan['Xpoints']))
-    ys = np.linspace(float(scan['Ystart (V)']), float(scan['Ystop (V)']), int(scan['Ypoints']))
-    scan['Vxs'] = xs
-    scan['Vys'] = ys
-    return scan
+    return Scan(scan, loader=functools.partial(_load_sp_array, filename))
+
+def _load_sp_array(filename):
+    return np.array(sp.data.load(filename))
 
 def load_2d_scan(filename, head):
     data = pd.read_csv(filename, skiprows=head, header=None)
     return data.to_numpy()
 
-def load_3d_scan(filename, head=0):
+def load_3d_scan(filename, head=0, shape=None, memmap=None):
+    """
+    Loads the data of a 3D (scan_type 5) scan. The file is a series of pages
+    separated by blank lines, each starting with a label line followed by
+    comma separated rows. Pages are parsed one at a time and written straight
+    into the output array, which is allocated once.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the scan file.
+    head : int, optional
+        Number of header lines to skip, by default 0
+    shape : (int, int, int), optional
+        (Xpoints, Ypoints, Zpoints) from the scan header, used to allocate the
+        output up front. If None, pages are stacked once they're all read.
+    memmap : string, optional
+        If given, the output is a .npy file at this path, memory-mapped
+        instead of held in RAM, by default None
+
+    Returns
+    -------
+    np.array
+        float32 array of shape (rows, pages, columns).
+    """
     with open(filename,'r') as f:
         for _ in range(head):
             next(f)
-        data = f.read()
-
-    pages = data.split('\n\n')
-    pages = pages[:-1]
-    processed_pages = []
-    for page in pages:
-        page = page.split('\n')[1:]
-        page = list(map(lambda line: line.split(','), page)) 
-        page = np.array(page,dtype=np.float32)
-        processed_pages.append(page)
-    data = np.dstack(processed_pages)
-    return np.swapaxes(data,1,2)
+        pages = _iter_pages(f)
+
+        if shape is None:
+            data = np.dstack(list(pages))
+            return np.swapaxes(data,1,2)
+
+        first = next(pages)
+        rows, cols = first.shape
+        total = int(np.prod(shape))
+        if total % (rows * cols):
+            raise ValueError("Page of shape %s doesn't fit scan of shape %s" % (first.shape, tuple(shape)))
+        npages = total // (rows * cols)
+
+        out_shape = (rows, npages, cols)
+        if memmap is None:
+            data = np.empty(out_shape, dtype=np.float32)
+        else:
+            data = np.lib.format.open_memmap(memmap, mode='w+', dtype=np.float32, shape=out_shape)
+
+        data[:, 0, :] = first
+        filled = 1
+        for page in pages:
+            if filled == npages:
+                break
+            data[:, filled, :] = page
+            filled += 1
+    # Scans that were stopped early only have the pages taken so far.
+    return data[:, :filled, :]
+
+# Yields each page of a 3D scan, as a float32 array, without
+# reading more than one page of the file at a time.
+def _iter_pages(f):
+    lines = []
+    for line in f:
+        if line.strip() == "":
+            # First line of a page is its label.
+            if len(lines) > 1:
+                yield _parse_page(lines[1:])
+            lines = []
+        else:
+            lines.append(line)
+    # A page that isn't followed by a blank line is incomplete, so skip it.
+
+def _parse_page(lines):
+    text = ','.join(line.rstrip() for line in lines)
+    # fromstring stops at the first value it can't parse, only warning about it.
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = np.fromstring(text, sep=',', dtype=np.float32)
+        except (ValueError, DeprecationWarning):
+            values = None
+    cols = len(lines[0].rstrip().split(','))
+    if values is None or values.size != len(lines) * cols:
+        raise ValueError("Malformed page of %d lines of %d values" % (len(lines), cols))
+    return values.reshape(len(lines), cols)
 
 def read_tcspc(filename, cntr_time=True, **kwargs):
     """ Sample File with Header:
@@ -271,4 +863,14 @@ def read_tcspc(filename, cntr_time=True, **kwargs):
     if cntr_time:
         times += ns_per_chn/2
     counts.insert(0,"times",times)
-    return counts
\ No newline at end of file
+    return counts
+
+####################
+# Built-in Readers #
+####################
+register_reader(read_sp_bin, magic=b'SPINMOB_BINARY')
+register_reader(read_scan, magic=b'Scan data, number of header lines', hints=_scan_hints)
+register_reader(read_tcspc, magic=b'#PicoHarp 300  Histogram Data')
+register_reader(read_michael_scan, magic=b'date')
+register_reader(_t.read_ptu, magic=b'PQTTTR', extensions=['.ptu'])
+register_reader(_t.read_phu, magic=b'PQHISTO', extensions=['.phu'])
@@ -1,5 +1,273 @@
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import lmfit as lm
+from concurrent import futures
 
 from . import data as _d
+from . import uncert as _u
+
+###########################
+# Reconvolved Decay Model #
+###########################
+class DecayModel:
+    """
+    Sum of exponential decays on a constant background, convolved with a
+    measured instrument response function (IRF):
+        model(t) = offset + (irf * sum_k amp_k exp(-t/tau_k))(t)
+    The IRF is transformed once, and the model along with all of its
+    derivatives are convolved together in a single FFT pass.
+
+    Parameters
+    ----------
+    times : np.array
+        Evenly spaced histogram bin times, in ns.
+    ntau : int, optional
+        Number of exponential components, by default 1
+    irf : np.array, optional
+        IRF counts on the same bins as times, normalized to unit sum.
+        If None, the decay isn't convolved, by default None
+    mask : np.array, optional
+        Boolean mask of the bins to return the model on. The model is still
+        computed on every bin, since the convolution needs them. By default all bins.
+    """
+    def __init__(self, times, ntau=1, irf=None, mask=None):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.ntau = ntau
+        self.mask = mask
+        # Decay starts from the first bin
+        self.t = self.times - self.times[0]
+        n = len(self.times)
+        if irf is None:
+            self.irf_fft = None
+        else:
+            irf = np.asarray(irf, dtype=np.float64)
+            if len(irf) != n:
+                raise ValueError("IRF and histogram must have the same number of bins")
+            # Zero padded so the convolution doesn't wrap around
+            self.nfft = 1 << int(np.ceil(np.log2(2 * n)))
+            self.irf_fft = np.fft.rfft(irf / np.sum(irf), self.nfft)
+
+    @property
+    def names(self):
+        names = []
+        for k in range(self.ntau):
+            names += ['amp%d' % k, 'tau%d' % k]
+        return names + ['offset']
+
+    def make_params(self, amps, taus, offset=0.0):
+        params = lm.Parameters()
+        for k in range(self.ntau):
+            params.add('amp%d' % k, value=amps[k], min=0)
+            params.add('tau%d' % k, value=taus[k], min=1E-6)
+        params.add('offset', value=offset, min=0)
+        return params
+
+    def _convolve(self, rows):
+        if self.irf_fft is None:
+            return rows
+        n = len(self.t)
+        return np.fft.irfft(np.fft.rfft(rows, self.nfft, axis=-1) * self.irf_fft,
+                            self.nfft, axis=-1)[..., :n]
+
+    def eval_jac(self, values):
+        """
+        Evaluates the model and its derivative with respect to every parameter.
+
+        Parameters
+        ----------
+        values : [float]
+            Parameter values in the order of names.
+
+        Returns
+        -------
+        np.array, np.array
+            The model, and its jacobian of shape (len(times), len(names)).
+        """
+        n = len(self.t)
+        rows = np.empty((2 * self.ntau, n))
+        for k in range(self.ntau):
+            amp = values[2*k]
+            tau = values[2*k + 1]
+            decay = np.exp(-self.t / tau)
+            # d/d(amp) and d/d(tau) of amp * exp(-t/tau)
+            rows[2*k] = decay
+            rows[2*k + 1] = amp * self.t / tau**2 * decay
+        rows = self._convolve(rows)
+
+        model = values[-1] + np.dot(values[0:-1:2], rows[0::2])
+        jac = np.empty((n, len(values)))
+        jac[:, :-1] = rows.T
+        jac[:, -1] = 1.0
+        if self.mask is not None:
+            return model[self.mask], jac[self.mask]
+        return model, jac
+
+    def eval(self, values):
+        return self.eval_jac(values)[0]
+
+##############
+# Objectives #
+##############
+# Smallest model value used to keep the poisson deviance finite.
+_tiny = 1E-12
+
+def _residual_jac(values, model, counts, method):
+    m, dm = model.eval_jac(values)
+    if method == 'lsq':
+        # Poisson variance estimated from the data
+        sigma = np.sqrt(np.maximum(counts, 1))
+        return (m - counts) / sigma, dm / sigma[:, None]
+    elif method == 'mle':
+        # Signed square root of the poisson deviance, whose sum of squares is
+        # minimized by the maximum likelihood parameters.
+        m = np.maximum(m, _tiny)
+        ylog = np.where(counts > 0, counts * np.log(np.where(counts > 0, counts, 1) / m), 0.0)
+        dev = np.maximum(2 * (m - counts + ylog), 0.0)
+        res = np.sign(m - counts) * np.sqrt(dev)
+        small = np.abs(res) < 1E-8
+        # d(res)/dm, using its limit of 1/sqrt(m) where res goes to 0
+        scale = np.where(small, 1 / np.sqrt(m), (1 - counts / m) / np.where(small, 1, res))
+        return res, dm * scale[:, None]
+    raise ValueError("method must be 'mle' or 'lsq'")
+
+def _objective(params, model, counts, method):
+    return _residual_jac([params[n].value for n in model.names], model, counts, method)[0]
+
+def _jacobian(params, model, counts, method):
+    values = [params[n].value for n in model.names]
+    jac = _residual_jac(values, model, counts, method)[1]
+    # Only the varying parameters, in the order lmfit uses
+    idx = [model.names.index(n) for n, p in params.items() if p.vary]
+    return jac[:, idx]
+
+###########
+# Fitting #
+###########
+def _counts(hist):
+    if isinstance(hist, str):
+        hist = _d.read(hist)
+    if isinstance(hist, pd.DataFrame):
+        return hist['times'].to_numpy(), hist['counts'].to_numpy().astype(np.float64)
+    return None, np.asarray(hist, dtype=np.float64)
+
+def fit_decay(hist, taus, irf=None, times=None, method='mle', tmin=None, tmax=None, params=None):
+    """
+    Fits a multi-exponential decay, reconvolved with an IRF, to a TCSPC histogram
+    using analytic derivatives.
+
+    Parameters
+    ----------
+    hist : pd.DataFrame, np.array or string
+        The histogram, either as returned by data.read_tcspc, an array of counts
+        (then times must be given), or a file to read with data.read.
+    taus : [float]
+        Initial guesses of the lifetimes in ns, one per exponential component.
+    irf : pd.DataFrame, np.array or string, optional
+        The measured instrument response on the same bins, by default None
+    times : np.array, optional
+        The bin times, if hist is just an array of counts.
+    method : str, optional
+        'mle' for poisson maximum likelihood, or 'lsq' for least squares weighted
+        by the square root of the counts, by default 'mle'
+    tmin : float, optional
+        Start of the fit range in ns, by default the first bin.
+    tmax : float, optional
+        End of the fit range in ns, by default the last bin.
+    params : lmfit.Parameters, optional
+        Starting parameters to use instead of guesses from taus.
+
+    Returns
+    -------
+    lmfit.MinimizerResult
+        The fit result, with parameters amp0, tau0, amp1, tau1, ..., offset.
+    """
+    hist_times, counts = _counts(hist)
+    if times is None:
+        times = hist_times
+    if times is None:
+        raise ValueError("Bin times must be given with an array of counts")
+    if irf is not None:
+        irf = _counts(irf)[1]
+
+    mask = np.ones(len(times), dtype=bool)
+    if tmin is not None:
+        mask &= times >= tmin
+    if tmax is not None:
+        mask &= times <= tmax
+    # The convolution needs the IRF from the start of the histogram,
+    # so the model is evaluated up to tmax and then masked.
+    last = np.nonzero(mask)[0][-1] + 1
+    times = times[:last]
+    counts = counts[:last]
+    mask = mask[:last]
+    if irf is not None:
+        irf = irf[:last]
+
+    model = DecayModel(times, len(taus), irf, mask)
+    if params is None:
+        # Background from before the rise with an IRF, or from the tail without one,
+        # kept off its bound at 0 where lmfit can't move it.
+        edge = max(len(counts)//20, 1)
+        offset = np.median(counts[:edge] if irf is not None else counts[-edge:])
+        offset = max(offset, 0.1)
+        amp = max(np.max(counts) - offset, 1.0) / len(taus)
+        params = model.make_params([amp] * len(taus), taus, offset)
+
+    minimizer = lm.Minimizer(_objective, params, fcn_args=(model, counts[mask], method))
+    return minimizer.leastsq(Dfun=_jacobian)
+
+def _fit_row(args):
+    hist, taus, irf, kwargs = args
+    result = fit_decay(hist, taus, irf=irf, **kwargs)
+    row = _u.from_fit(result)
+    row.update({'chisqr' : result.chisqr,
+                'redchi' : result.redchi,
+                'success' : result.success,
+                'nfev' : result.nfev})
+    return row
+
+def fit_many(hists, taus, irf=None, workers=None, executor='process', **kwargs):
+    """
+    Fits many TCSPC histograms with fit_decay in parallel.
+
+    Parameters
+    ----------
+    hists : [pd.DataFrame, np.array or string]
+        The histograms to fit, see fit_decay. Filenames are read by the workers.
+    taus : [float]
+        Initial guesses of the lifetimes in ns.
+    irf : pd.DataFrame, np.array or string, optional
+        The IRF shared by all the histograms, by default None
+    workers : int, optional
+        Number of processes (or threads) to fit with, by default the number of CPUs.
+    executor : str, optional
+        'process' or 'thread', by default 'process'
+    kwargs :
+        Passed on to fit_decay.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per histogram, with a gummy (from uncert.from_fit) for each
+        parameter, along with chisqr, redchi, success and nfev. Fits that raised
+        an error have success False and the error in 'error'.
+    """
+    if isinstance(irf, str):
+        irf = _d.read(irf)
+    if executor == 'process':
+        pool = _d._process_pool(workers)
+    elif executor == 'thread':
+        pool = futures.ThreadPoolExecutor(workers)
+    else:
+        raise ValueError("executor must be 'process' or 'thread'")
+
+    with pool:
+        jobs = [pool.submit(_fit_row, (hist, taus, irf, kwargs)) for hist in hists]
+        rows = []
+        for job in jobs:
+            try:
+                rows.append(job.result())
+            except Exception as e:
+                rows.append({'success' : False, 'error' : e})
+    return pd.DataFrame(rows)
@@ -2,16 +2,38 @@ import ctypes
 import numpy as np
 from numpy.ctypeslib import ndpointer
 import scipy.optimize as opt
+from scipy import spatial
 import os
+import time
+import warnings
 
 dbl_array = ndpointer(ctypes.c_double)
 dbl = ctypes.c_double
 intg = ctypes.c_int
 
 if os.name == "nt":
-    lib = ctypes.CDLL(os.path.join(os.path.dirname(__file__),"minPar.dll"))
+    _lib_path = os.path.join(os.path.dirname(__file__),"minPar.dll")
 else:
-    lib = ctypes.CDLL(os.path.join(os.path.dirname(__file__),"minPar.so"))
+    _lib_path = os.path.join(os.path.dirname(__file__),"minPar.so")
+if not os.path.exists(_lib_path):
+    raise ImportError("%s is missing, build it by running make in src/" % _lib_path)
+lib = ctypes.CDLL(_lib_path)
+
+# Routines added to minPar.c since the library was first distributed are only
+# bound if a library built from older sources has them, and raise once used otherwise.
+def _native(name):
+    func = getattr(lib, name, None)
+    if func is None:
+        raise RuntimeError("%s isn't in %s, rebuild it from src/minPar.c"
+                           % (name, lib._name))
+    return func
+
+if hasattr(lib, 'setThreads'):
+    lib.setThreads.argtypes = [intg]
+    lib.setThreads.restype = None
+
+    lib.getThreads.argtypes = []
+    lib.getThreads.restype = intg
 
 lib.minDist.argtypes = [dbl, dbl,             #x, y
                         dbl_array, dbl_array, #Es, Ts
@@ -57,45 +79,452 @@ lib.minLengthsHist.argtypes = [dbl_array, dbl_array, #Xs, Ys
                                dbl]                  #limit
 lib.minLengthsHist.restype = intg
 
-def make_func(pairs, es, ts, sigmae, sigmat):
+if hasattr(lib, 'viterbiLengths'):
+    lib.viterbiLengths.argtypes = [dbl_array, dbl_array, #Xs, Ys
+                                   dbl_array, dbl_array, #Es, Ts
+                                   dbl_array, dbl_array, #Dls, Output
+                                   dbl, dbl,             #SigmaX, SigmaY
+                                   intg, intg,           #Len(Xs), #Len(Es)
+                                   dbl, dbl,             #limit, penalty
+                                   intg]                 #Band width
+    lib.viterbiLengths.restype = intg
+
+if hasattr(lib, 'trackLengths'):
+    lib.trackLengths.argtypes = [dbl_array, dbl_array, #Xs, Ys
+                                 dbl_array, dbl_array, #Es, Ts
+                                 dbl_array, dbl_array, #Dls, Output
+                                 dbl, dbl,             #SigmaX, SigmaY
+                                 intg, intg,           #Len(Xs), #Len(Es)
+                                 dbl, dbl]             #limit, prev
+    lib.trackLengths.restype = intg
+
+if hasattr(lib, 'lossGrad'):
+    lib.lossGrad.argtypes = [dbl_array, dbl_array, #Xs, Ys
+                             dbl_array, dbl_array, #Es, Ts
+                             dbl_array, dbl_array, #P, Grad
+                             dbl, dbl,             #SigmaX, SigmaY
+                             intg, intg]           #Len(Xs), #Len(Es)
+    lib.lossGrad.restype = dbl
+
+# PathIndex of a path for make_func and make_func_grad, reused for as long as
+# the transforms p being queried scale it like the one the tree was built for.
+# Queries slow down quickly as the ratio of p0 to p2 drifts, by more than
+# rebuilding the tree costs past a stretch of about 1.001, so it's mostly
+# reused across finite difference steps.
+class _TreeCache:
+    max_stretch = 1.001
+
+    def __init__(self, es, ts, sigmae, sigmat):
+        self.args = (es, ts, sigmae, sigmat)
+        self.index = None
+
+    def __call__(self, p):
+        if self.index is None or self.index.stretch(p) > self.max_stretch:
+            self.index = PathIndex(*self.args, p=p)
+        return self.index
+
+def make_func(pairs, es, ts, sigmae, sigmat, method='brute'):
     xs = np.copy(pairs[0])
     ys = np.copy(pairs[1])
     es = np.copy(es)
     ts = np.copy(ts)
     N = len(xs)
     M = len(es)
+    if method == 'tree':
+        index = _TreeCache(es, ts, sigmae, sigmat)
 
     def func(p):
-        output = np.zeros(N)
-        lib.minDists(xs, ys, p[0] * es + p[1], p[2] * ts,
-                     output, sigmae, sigmat, N, M)
+        if method == 'tree':
+            output = index(p).dists(xs, ys, p)
+        else:
+            output = np.zeros(N)
+            lib.minDists(xs, ys, p[0] * es + p[1], p[2] * ts,
+                         output, sigmae, sigmat, N, M)
         return np.sum(np.power(output,2))/len(xs)
 
     return func
 
-def param_opt(func, ps0, callback):
+def make_func_grad(pairs, es, ts, sigmae, sigmat, method='brute'):
+    """
+    Same objective as make_func, but func(p) returns the loss along with its
+    gradient with respect to p, for param_opt(..., jac=True).
+    The gradient is found from the nearest vertex of each point in the same
+    pass as the loss, instead of by finite differences.
+    """
+    xs = np.ascontiguousarray(pairs[0], dtype=np.float64)
+    ys = np.ascontiguousarray(pairs[1], dtype=np.float64)
+    es = np.array(es, dtype=np.float64)
+    ts = np.array(ts, dtype=np.float64)
+    N = len(xs)
+    M = len(es)
+    if method == 'tree':
+        index = _TreeCache(es, ts, sigmae, sigmat)
+
+    def func(p):
+        p = np.array(p, dtype=np.float64)
+        if method == 'tree':
+            new_es = p[0] * es + p[1]
+            new_ts = p[2] * ts
+            dists, idx, _ = index(p).query(xs, ys, p)
+            rx = (xs - new_es[idx]) / sigmae**2
+            ry = (ys - new_ts[idx]) / sigmat**2
+            grad = -2 * np.array([np.sum(rx * es[idx]), np.sum(rx), np.sum(ry * ts[idx])]) / N
+            return np.sum(np.power(dists,2))/N, grad
+        grad = np.zeros(3)
+        loss = _native('lossGrad')(xs, ys, es, ts, p, grad, sigmae, sigmat, N, M)
+        return loss, grad
+
+    return func
+
+def param_opt(func, ps0, callback, jac=False):
+    """
+    Minimizes func, from make_func, or from make_func_grad with jac=True.
+    """
     print("Starting Optimization...")
-    result = opt.minimize(func, ps0, method='BFGS', options={'disp':True, 'maxiter':1000}, 
+    result = opt.minimize(func, ps0, method='BFGS', jac=jac, options={'disp':True, 'maxiter':1000}, 
                           callback=callback)
     if not result.success:
         print("Something has gone Awry")
         print(result.message)
     return result
 
-def get_lengths(points, es, ts, sigmae, sigmat, ls, p, hist=None):
+def get_lengths(points, es, ts, sigmae, sigmat, ls, p, hist=None, tracker='greedy', penalty=0.0, width=None,
+                curve=None):
+    """
+    Lengths along the transformed path nearest each point. With hist, the
+    lengths are tracked with hysteresis, only changing by up to hist between
+    points. tracker='dp' finds the best trajectory overall with
+    min_lengths_dp (using penalty and width), while tracker='greedy', the
+    default, takes the nearest allowed length point by point with
+    min_lengths_hist.
+
+    With curve, a tuple of the arguments of cavity.pdh_curve
+    (r, fm, m, lamb, a, phi, theta, pc, dL_min, dL_max, num), the path is that
+    reference curve, taken from its cache when it's been computed before,
+    and es, ts and ls are ignored.
+    """
+    if curve is not None:
+        from . import cavity
+        ls, es, ts = cavity.pdh_curve(*curve)
     new_es = p[0] * es + p[1]
     new_ts = p[2] * ts
     if hist is None:
         return min_lengths(points, new_es, new_ts, sigmae, sigmat, ls)
-    else:
+    elif tracker == 'dp':
+        return min_lengths_dp(points, new_es, new_ts, sigmae, sigmat, ls, hist, penalty, width)
+    elif tracker == 'greedy':
         return min_lengths_hist(points, new_es, new_ts, sigmae, sigmat, ls, hist)
+    raise ValueError("tracker must be 'dp' or 'greedy'")
     
+#####################
+# Streaming Lengths #
+#####################
+class LengthStream:
+    """
+    Tracks the cavity length, with hysteresis, from a stream of (error,
+    transmission) points fed in one block at a time, e.g. straight from a DAQ.
+    The reference curve is transformed by the calibrated parameters p once,
+    and the last length is kept between blocks, so splitting a trace into
+    blocks gives the same lengths as tracking it all at once. Only the very
+    first point is searched for over the whole curve. Each point costs
+    O(log M) plus the number of lengths within +/- limit, so the time per
+    block is bounded by its size.
+
+    Each point considers the same lengths as min_lengths_hist, so streaming
+    a trace gives the same lengths as get_lengths with hist=limit.
+
+    Parameters
+    ----------
+    es : np.array
+        Error signal of the reference curve.
+    ts : np.array
+        Transmission of the reference curve.
+    sigmae : float
+        Uncertainty of the error signal.
+    sigmat : float
+        Uncertainty of the transmission.
+    ls : np.array
+        Increasing lengths parametrizing the reference curve.
+    p : [float]
+        Calibrated parameters, as found by param_opt.
+    limit : float
+        Largest change in length between consecutive points.
+    """
+    def __init__(self, es, ts, sigmae, sigmat, ls, p, limit):
+        self.es = np.ascontiguousarray(p[0] * np.asarray(es) + p[1], dtype=np.float64)
+        self.ts = np.ascontiguousarray(p[2] * np.asarray(ts), dtype=np.float64)
+        self.ls = np.ascontiguousarray(ls, dtype=np.float64)
+        if np.any(np.diff(self.ls) < 0):
+            raise ValueError("ls must be increasing")
+        self.sigmae = sigmae
+        self.sigmat = sigmat
+        self.limit = limit
+        self.prev = np.nan
+        self.count = 0
+
+    def reset(self):
+        """
+        Forgets the last length, so the next point is searched for everywhere.
+        """
+        self.prev = np.nan
+
+    def push(self, points):
+        """
+        Lengths of a block of points, given as [errors, transmissions].
+        """
+        xs = np.ascontiguousarray(points[0], dtype=np.float64)
+        ys = np.ascontiguousarray(points[1], dtype=np.float64)
+        N = len(xs)
+        output = np.zeros(N,dtype=np.float64)
+        if N == 0:
+            return output
+        _native('trackLengths')(xs, ys, self.es, self.ts, self.ls, output,
+                                self.sigmae, self.sigmat, N, len(self.es), self.limit, self.prev)
+        self.prev = output[-1]
+        self.count += N
+        return output
+
+    __call__ = push
+
+def benchmark_stream(es, ts, sigmae, sigmat, ls, p, limit, block=4096, blocks=100, seed=None):
+    """
+    Measures the throughput of a LengthStream, feeding it blocks of points
+    that wander along the transformed reference curve with gaussian noise.
+
+    Returns
+    -------
+    float, float
+        Samples per second, and the longest time taken by a block in seconds.
+    """
+    rng = np.random.default_rng(seed)
+    M = len(es)
+    N = block * blocks
+    # Random walk along the curve, in steps well within the limit
+    step = max(int(np.searchsorted(ls, ls[0] + limit) / 4), 1)
+    walk = np.cumsum(rng.integers(-step, step + 1, N)) + M // 2
+    idx = np.abs((walk - M) % (2 * (M - 1)) - (M - 1))
+    xs = p[0] * np.asarray(es)[idx] + p[1] + rng.normal(0, sigmae, N)
+    ys = p[2] * np.asarray(ts)[idx] + rng.normal(0, sigmat, N)
+
+    stream = LengthStream(es, ts, sigmae, sigmat, ls, p, limit)
+    worst = 0.0
+    start = time.perf_counter()
+    for i in range(0, N, block):
+        t = time.perf_counter()
+        stream.push((xs[i:i+block], ys[i:i+block]))
+        worst = max(worst, time.perf_counter() - t)
+    rate = N / (time.perf_counter() - start)
+    print("%.3g samples/s, worst block of %d took %.3g ms" % (rate, block, worst * 1E3))
+    return rate, worst
+
+################
+# Spatial Index #
+################
+class PathIndex:
+    """
+    k-d tree over a path {es, ts}, scaled by the uncertainties, for finding the
+    nearest point of the path to many points in O(N log M) rather than O(N M).
+
+    By default the nearest vertex is found, matching the brute force C routines
+    exactly: candidates from the tree have their distances recomputed the same
+    way as minDist, ties go to the lowest index, and points whose candidates
+    don't provably contain the nearest vertex are queried again with more.
+    With segments=True the points are instead projected onto the straight
+    segments between consecutive vertices.
+
+    Queries can also be made against the path transformed by parameters p,
+    as in make_func ({p0*es + p1, p2*ts}), without building a new tree.
+    The tree is built for the transform p given here, and queries stay
+    fast as long as the ratio of p0 to p2 is close to the one it was built for,
+    see stretch.
+
+    Parameters
+    ----------
+    es : np.array
+        Error signal values of the path.
+    ts : np.array
+        Transmission values of the path.
+    sigmae : float
+        Uncertainty of the error signal.
+    sigmat : float
+        Uncertainty of the transmission.
+    segments : bool, optional
+        Project onto path segments rather than vertices, by default False
+    workers : int, optional
+        Number of threads used to query the tree, by default all of them (-1)
+    p : [float], optional
+        Transform whose scaling of the path the tree is built for, by default none.
+    """
+    # Number of candidates first taken from the tree for each point.
+    k = 4
+
+    def __init__(self, es, ts, sigmae, sigmat, segments=False, workers=-1, p=None):
+        self.es = np.asarray(es, dtype=np.float64)
+        self.ts = np.asarray(ts, dtype=np.float64)
+        self.sigmae = sigmae
+        self.sigmat = sigmat
+        self.workers = workers
+        self.segments = segments and len(self.es) > 1
+        # Scaling of each axis in the tree, only the distances matter so the
+        # offset and signs of p are left out.
+        self.scale = (1.0, 1.0) if p is None else (abs(p[0]), abs(p[2]))
+        if self.scale[0] == 0 or self.scale[1] == 0:
+            raise ValueError("Can't build the tree with p0 or p2 of 0")
+        us = self.scale[0] * self.es / sigmae
+        vs = self.scale[1] * self.ts / sigmat
+        if self.segments:
+            # Any point of a segment is within half its length of its middle.
+            self.du = np.diff(us)
+            self.dv = np.diff(vs)
+            self.len2 = self.du**2 + self.dv**2
+            self.reach = np.sqrt(np.max(self.len2)) / 2
+            self.tree = spatial.cKDTree(np.column_stack((us[:-1] + self.du/2, vs[:-1] + self.dv/2)))
+        else:
+            self.reach = 0.0
+            self.tree = spatial.cKDTree(np.column_stack((us, vs)))
+        self.size = self.tree.n
+
+    def _candidates(self, xs, ys, idx, p):
+        es = self.es[idx]
+        ts = self.ts[idx]
+        du = dv = len2 = None
+        if self.segments:
+            du = self.du[idx] / self.scale[0]
+            dv = self.dv[idx] / self.scale[1]
+            len2 = du**2 + dv**2
+        if p is not None:
+            # Same arithmetic as transforming the whole path first
+            es = p[0] * es + p[1]
+            ts = p[2] * ts
+            if self.segments:
+                du = p[0] * du
+                dv = p[2] * dv
+                len2 = du**2 + dv**2
+        if not self.segments:
+            d = np.hypot((xs[:, None] - es)/self.sigmae,
+                         (ys[:, None] - ts)/self.sigmat)
+            return d, np.zeros(d.shape)
+        # Projection onto each candidate segment, clipped to its ends.
+        pu = xs[:, None]/self.sigmae - es/self.sigmae
+        pv = ys[:, None]/self.sigmat - ts/self.sigmat
+        frac = np.clip((pu * du + pv * dv) / np.where(len2 > 0, len2, 1), 0, 1)
+        d = np.hypot(pu - frac * du, pv - frac * dv)
+        return d, frac
+
+    def stretch(self, p):
+        """
+        How much queries for the transform p stretch the tree along one axis
+        relative to the other, 1 when p scales the path like the tree.
+        """
+        a = abs(p[0]) / self.scale[0]
+        c = abs(p[2]) / self.scale[1]
+        return max(a, c) / min(a, c)
+
+    def query(self, xs, ys, p=None):
+        """
+        Finds the nearest point of the path to each point (xs, ys), or of the
+        path transformed by p = [p0, p1, p2] if given.
+
+        Returns
+        -------
+        np.array, np.array, np.array
+            The weighted distance to the path, the index of the nearest vertex
+            (or of the first vertex of the nearest segment), and the fraction
+            of the way along that segment (always 0 for vertices).
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        N = len(xs)
+        dists = np.empty(N)
+        index = np.empty(N, dtype=np.intp)
+        fracs = np.zeros(N)
+        todo = np.arange(N)
+        k = self.k
+        if p is None:
+            p = (1.0, 0.0, 1.0)
+            qs = xs
+            qt = ys
+        else:
+            if p[0] == 0 or p[2] == 0:
+                raise ValueError("Can't transform the path with p0 or p2 of 0")
+            # Points mapped back onto the untransformed path
+            qs = (xs - p[1]) / p[0]
+            qt = ys / p[2]
+        # Distances along each axis are the tree's stretched by these factors,
+        # so are never less than the smaller one times the tree's.
+        scale = min(abs(p[0]) / self.scale[0], abs(p[2]) / self.scale[1])
+        tol = 1E-9 * (1 + (abs(p[0]) * np.max(np.abs(self.es)) + abs(p[1])) / self.sigmae
+                        + abs(p[2]) * np.max(np.abs(self.ts)) / self.sigmat)
+        while len(todo):
+            k = min(k, self.size)
+            x = xs[todo]
+            y = ys[todo]
+            r, idx = self.tree.query(np.column_stack((self.scale[0] * qs[todo] / self.sigmae,
+                                                      self.scale[1] * qt[todo] / self.sigmat)),
+                                     k, workers=self.workers)
+            r = r.reshape(len(todo), -1)
+            idx = idx.reshape(len(todo), -1)
+            d, frac = self._candidates(x, y, idx, p)
+            best = np.min(d, axis=1)
+            # Lowest index among the ties, like the brute force search.
+            pick = np.argmin(np.where(d == best[:, None], idx, self.size), axis=1)
+            rows = np.arange(len(todo))
+            # Anything not among the candidates is at least this far away.
+            bound = scale * (r[:, -1] - self.reach) - tol
+            done = (best < bound) if k < self.size else np.ones(len(todo), dtype=bool)
+            sel = todo[done]
+            dists[sel] = best[done]
+            index[sel] = idx[rows, pick][done]
+            fracs[sel] = frac[rows, pick][done]
+            todo = todo[~done]
+            k *= 4
+        return dists, index, fracs
+
+    def dists(self, xs, ys, p=None):
+        """
+        Minimum weighted distance from each point to the path, see minDists.
+        """
+        return self.query(xs, ys, p)[0]
+
+    def lengths(self, xs, ys, dLs, p=None):
+        """
+        Length along the path parametrized by dLs nearest each point, see minLengths.
+        In segment mode the lengths are interpolated along the nearest segment.
+        """
+        dLs = np.asarray(dLs, dtype=np.float64)
+        _, index, fracs = self.query(xs, ys, p)
+        if not self.segments:
+            return dLs[index]
+        return dLs[index] + fracs * (dLs[index + 1] - dLs[index])
+
 ######################
 # C-Library Wrappers #
 ######################
-def min_dists(points,es,ts,sigmae,sigmat):
+def set_threads(n):
+    """
+    Sets the number of OpenMP threads the C library uses for each call.
+    """
+    _native('setThreads')(int(n))
+
+def get_threads():
+    return _native('getThreads')()
+
+def _check_brute(method, segments):
+    if method != 'brute':
+        raise ValueError("method must be 'brute' or 'tree'")
+    if segments:
+        raise ValueError("Projecting onto segments needs method='tree'")
+
+def min_dists(points,es,ts,sigmae,sigmat,method='brute',segments=False):
+    """
+    method is 'brute' for the C library or 'tree' for a PathIndex, which
+    can also project onto the path's segments.
+    """
     xs = points[0]
     ys = points[1]
+    if method == 'tree':
+        return PathIndex(es, ts, sigmae, sigmat, segments).dists(xs, ys)
+    _check_brute(method, segments)
     N = len(xs)
     M = len(es)
 
@@ -104,9 +533,15 @@ def min_dists(points,es,ts,sigmae,sigmat):
     return output
 
 
-def min_lengths(points, es, ts, sigmae, sigmat, dLs):
+def min_lengths(points, es, ts, sigmae, sigmat, dLs, method='brute', segments=False):
+    """
+    method is 'brute' for the C library or 'tree' for a PathIndex, see min_dists.
+    """
     xs = points[0]
     ys = points[1]
+    if method == 'tree':
+        return PathIndex(es, ts, sigmae, sigmat, segments).lengths(xs, ys, dLs)
+    _check_brute(method, segments)
     N = len(xs)
     M = len(es)
 
@@ -123,3 +558,55 @@ def min_lengths_hist(points, es, ts, sigmae, sigmat, dLs, limit):
     output = np.zeros(N,dtype=np.float64)
     res = lib.minLengthsHist(xs,ys,es,ts,dLs,output,sigmae,sigmat,N,M,limit)
     return output
+
+# Largest size of the back pointers min_lengths_dp widens its band to, in bytes.
+dp_memory = 2**28
+
+def min_lengths_dp(points, es, ts, sigmae, sigmat, dLs, limit=np.inf, penalty=0.0, width=None):
+    """
+    Tracks the length along the path for a sequence of points, finding the
+    trajectory that minimizes the total squared distance plus penalty times
+    the total change in length, with steps of at most limit.
+    Only a band of width path indices around the best length of each point
+    is considered, which takes O(N width) time. By default the band starts
+    at +/- 4 limit, and is doubled (up to the whole path, as long as the back
+    pointers, 4 bytes per point per index, fit in dp_memory) for as long as
+    the trajectory found runs along an edge of the band, where a narrow band
+    on a noisy trace could have lost the optimum. An integer width is used
+    as is, and width='full' always uses the whole path, which gives the exact
+    optimum in O(N M). dLs must be increasing.
+    """
+    xs = np.ascontiguousarray(points[0], dtype=np.float64)
+    ys = np.ascontiguousarray(points[1], dtype=np.float64)
+    es = np.ascontiguousarray(es, dtype=np.float64)
+    ts = np.ascontiguousarray(ts, dtype=np.float64)
+    dLs = np.ascontiguousarray(dLs, dtype=np.float64)
+    N = len(xs)
+    M = len(es)
+    if np.any(np.diff(dLs) < 0):
+        raise ValueError("dLs must be increasing")
+    widen = width is None
+    if width == 'full':
+        width = M
+    elif width is None:
+        width = M
+        if np.isfinite(limit):
+            width = np.max(np.searchsorted(dLs, dLs + 4*limit, side='right')
+                           - np.searchsorted(dLs, dLs - 4*limit))
+    width = int(min(max(width, 1), M))
+
+    output = np.zeros(N,dtype=np.float64)
+    while True:
+        res = _native('viterbiLengths')(xs,ys,es,ts,dLs,output,
+                                        sigmae,sigmat,N,M,limit,penalty,width)
+        if res < 0:
+            raise MemoryError("Tracking %d points with a band of width %d needs %.3g GB of "
+                              "back pointers, try a smaller width" % (N, width, 4 * N * width / 1E9))
+        if not widen or res == 0 or width == M:
+            return output
+        wider = min(2 * width, M)
+        if 4 * N * wider > dp_memory:
+            warnings.warn("Band of width %d constrained the trajectory, but widening it needs "
+                          "more than dp_memory, the lengths may not be optimal" % width)
+            return output
+        width = wider
@@ -105,45 +105,17 @@ def plot_scan_data(scan, convert=True, **kwargs):
     return plot_scan_raw(scan['Vxs'],scan['Vys'],scan['data'],dedouble,converted=False,**kwargs)
 
 def convert_units(scan, pz_gain=None, cpz_gain=None, gv_gain=None, **kwargs):
-    scan_type = scan['scan_type']
-    xs = scan['Vxs']
-    ys = scan['Vys']
+    """
+    Converts the scan voltages into positions in um, flipping the data to match.
+    See data.unit_conversion for the gains. A data.Scan only records the
+    conversion, its data is flipped as a view when accessed.
+    """
+    if isinstance(scan, data.Scan):
+        return scan.convert_units(pz_gain, cpz_gain, gv_gain)
 
-    # Piezo scan, conversion is amplifier gain (V/V) times piezo sensitivity (nm/V) converted to um.
-    if pz_gain is None:
-        pz_gain = -17 * 77 / 1000
-
-    if scan_type == 0:
-        if pz_gain < 0:
-            scan['data'] = np.flip(scan['data'])
-        scan['xs'] = xs * pz_gain
-        scan['ys'] = ys * pz_gain
-    # Galvo scan, conversion is in um/V
-    if gv_gain is None:
-        gv_gain = 117
-    if scan_type in [1,2]:
-        if gv_gain < 0:
-            scan['data'] = np.flip(scan['data'])
-        scan['xs'] = xs * gv_gain
-        scan['ys'] = ys * gv_gain
-    # Objective scan, y axis is position in um/12000, x axis is galvo, same as above.
-    # Negative values on the objective mean increasing height, so flip the sign for plotting.
-    if scan_type == 3:
-        if gv_gain < 0:
-            scan['data'] = np.flip(scan[data])
-        else:
-            scan['data'] = np.flip(scan[data],axis=0)
-        scan['xs'] = xs * gv_gain
-        scan['ys'] = ys * -12000 # Not sure why this is the factor, but it is
-    
-    # Cavity piezo gain for converting 3D scans
-    if cpz_gain is None:
-        cpz_gain = 1.5/640 * -17 # full stroke distance in um over full voltage range.
-    if scan_type == 5:
-        if pz_gain < 0:
-            scan['data'] = np.flip(scan['data'], axis=[0,1])
-        if cpz_gain < 0:
-            scan['data'] = np.flip(scan['data'], axis=2)
-        scan['xs'] = xs * pz_gain
-        scan['ys'] = ys * pz_gain
-        scan['zs'] = scan['Vzs'] * cpz_gain
\ No newline at end of file
+    gains, flips = data.unit_conversion(scan['scan_type'], pz_gain, cpz_gain, gv_gain)
+    for axes in flips:
+        scan['data'] = np.flip(scan['data'], axis=axes)
+    for axis, gain in gains.items():
+        scan[axis + 's'] = scan['V' + axis + 's'] * gain
+    return scan
@@ -6,7 +6,7 @@ setup(name = 'cavspy',
       url = "https://github.com/rydgel/CavSpy",
       packages = ['cavspy'],
       package_dir = {'cavspy' : '.'},
-      package_data = {'cavspy' : ['style.mplstyle', 'minPar.so', 'minPar.dll']},
+      package_data = {'cavspy' : ['style.mplstyle', 'minPar.so']},
       version_config={
         "template": "{tag}",
         "dev_template": "{tag}+git.{sha}",
@@ -1,9 +1,63 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <stdint.h>
 #include <math.h>
 #include <omp.h>
 #include "minPar.h"
 
+/**
+ * @brief Index of the vertex of {pathx, pathy} between lo and hi nearest to
+ *        (x,y), found in a single pass over squared distances without any
+ *        allocation. Ties go to the lowest index.
+ * 
+ * @param x Point x position
+ * @param y Point y position
+ * @param pathx set of x coordinates of path
+ * @param pathy set of y cooridnates of path
+ * @param wx inverse of the error on x position
+ * @param wy inverse of the error on y position
+ * @param lo first index to look at
+ * @param hi one past the last index to look at
+ * @param dist2 output for the squared distance to the nearest vertex
+ * @return int the index of the nearest vertex
+ */
+static inline int nearest(double x, double y,
+                          const double* restrict pathx, const double* restrict pathy,
+                          double wx, double wy,
+                          int lo, int hi, double* dist2){
+    double min = INFINITY;
+    int idx = lo;
+    for(int i = lo; i < hi; i++){
+        double dx = (x - pathx[i]) * wx;
+        double dy = (y - pathy[i]) * wy;
+        double d = dx*dx + dy*dy;
+        if(d < min){
+            min = d;
+            idx = i;
+        }
+    }
+    *dist2 = min;
+    return idx;
+}
+
+/**
+ * @brief Sets the number of OpenMP threads used by the functions below.
+ * 
+ * @param n number of threads
+ */
+void setThreads(int n){
+    omp_set_num_threads(n);
+}
+
+/**
+ * @brief Gets the number of OpenMP threads used by the functions below.
+ * 
+ * @return int number of threads
+ */
+int getThreads(void){
+    return omp_get_max_threads();
+}
+
 /**
  * @brief Compute the minimum distance between a point given by x,y and the path
  *        given by the set of points {pathx, pathy}.
@@ -22,23 +76,9 @@ double minDist(double x, double y,
                double* pathx, double* pathy,
                double sigmax,double sigmay, 
                int M){
-    double *dists;
-    dists = (double *)malloc(M * sizeof(double));
-    
-    #pragma omp parallel for
-    for(int i = 0; i < M; i++){
-        dists[i] = hypot((x - pathx[i])/sigmax, (y - pathy[i])/sigmay);
-    }
-
-    double min = dists[0];
-    for(int i = 1; i < M; i++){
-        if(dists[i] < min){
-            min = dists[i];
-        }
-    }
-	
-	free(dists);
-    return min;
+    double min;
+    nearest(x, y, pathx, pathy, 1/sigmax, 1/sigmay, 0, M, &min);
+    return sqrt(min);
 }
 
 /**
@@ -88,25 +128,8 @@ double minLength(double x, double y,
                  double* pathx, double* pathy, double* lengths,
                  double sigmax,double sigmay, 
                  int M){
-
-    double *dists;
-    dists = (double *)malloc(M * sizeof(double));
-
-    #pragma omp parallel for
-    for(int i = 0; i < M; i++){
-        dists[i] = hypot((x - pathx[i])/sigmax, (y - pathy[i])/sigmay);
-    }
-
-    double min = dists[0];
-    int idx = 0;
-    for(int i = 1; i < M; i++){
-        if(dists[i] < min){
-            min = dists[i];
-            idx = i;
-        }
-    }
-    
-	free(dists);
+    double min;
+    int idx = nearest(x, y, pathx, pathy, 1/sigmax, 1/sigmay, 0, M, &min);
     return lengths[idx];
 }
 
@@ -203,27 +226,10 @@ double minLengthHist(double x, double y,
 
     int range[2];
     getRange(lengths, M, prev, limit, range);
-    int L = range[1]-range[0];
-
-    double *dists;
-    dists = (double *)malloc(L * sizeof(double));
-
-    #pragma omp parallel for
-    for(int i = range[0]; i < range[1]; i++){
-        dists[i-range[0]] = hypot((x - pathx[i])/sigmax, (y - pathy[i])/sigmay);
-    }
 
-    double min = dists[0];
-    int idx = 0;
-    for(int i = 1; i < L; i++){
-        if(dists[i] < min){
-            min = dists[i];
-            idx = i;
-        }
-    }
-    
-    free(dists);
-    return lengths[idx + range[0]];
+    double min;
+    int idx = nearest(x, y, pathx, pathy, 1/sigmax, 1/sigmay, range[0], range[1], &min);
+    return lengths[idx];
 }
 
 /**
@@ -259,3 +265,286 @@ int minLengthsHist(double* x, double* y,
     
     return 0;
 }
+
+/**
+ * @brief Mean squared minimum distance between the points {xs, ys} and the 
+ *        transformed path {p0*pathx + p1, p2*pathy}, along with its gradient 
+ *        with respect to p. The gradient only depends on the nearest vertex
+ *        of each point, so both are found in the same pass.
+ * 
+ * @param xs Set of x coordinates of points
+ * @param ys Set of y coordinated of points
+ * @param pathx Set of x coordinates of untransformed path
+ * @param pathy Set of y coordinates of untransformed path
+ * @param p Transformation parameters {p0, p1, p2}
+ * @param grad Array of length 3 to put the gradient in
+ * @param sigmax Error on x point positions, taken to be constant
+ * @param sigmay Error on y point positions, taken to be constant
+ * @param N Number of points
+ * @param M Length of path
+ * @return double The mean squared minimum distance
+ */
+double lossGrad(double* xs, double* ys, 
+                double* pathx, double* pathy, double* p, double* grad,
+                double sigmax, double sigmay, 
+                int N, int M){
+
+    double loss = 0, g0 = 0, g1 = 0, g2 = 0;
+    double wx = 1/(sigmax*sigmax);
+    double wy = 1/(sigmay*sigmay);
+
+    #pragma omp parallel for reduction(+:loss,g0,g1,g2)
+    for(int i = 0; i < N; i++){
+        // Nearest vertex of the transformed path, without building it
+        double min = INFINITY;
+        int idx = 0;
+        for(int j = 0; j < M; j++){
+            double dx = xs[i] - (p[0]*pathx[j] + p[1]);
+            double dy = ys[i] - p[2]*pathy[j];
+            double d = dx*dx*wx + dy*dy*wy;
+            if(d < min){
+                min = d;
+                idx = j;
+            }
+        }
+        double rx = (xs[i] - (p[0]*pathx[idx] + p[1])) * wx;
+        double ry = (ys[i] - p[2]*pathy[idx]) * wy;
+        loss += min;
+        g0 -= 2 * rx * pathx[idx];
+        g1 -= 2 * rx;
+        g2 -= 2 * ry * pathy[idx];
+    }
+
+    grad[0] = g0/N;
+    grad[1] = g1/N;
+    grad[2] = g2/N;
+    return loss/N;
+}
+
+/**
+ * @brief Start of the band of W indices centred on c, kept inside [0, M).
+ */
+static inline int bandStart(int c, int W, int M){
+    int lo = c - W/2;
+    if(lo > M - W) lo = M - W;
+    if(lo < 0) lo = 0;
+    return lo;
+}
+
+/**
+ * @brief Tracks the length along the path {pathx, pathy}, parametrized by 
+ *        increasing lengths, for a sequence of points {x,y} by finding the
+ *        globally optimal trajectory (Viterbi) rather than the greedy one of
+ *        minLengthsHist. The cost of a trajectory is the sum of squared
+ *        weighted distances from each point to its vertex, plus 
+ *        penalty * |change in length| between consecutive points, which may
+ *        not be more than limit. The states of each point are restricted to a
+ *        band of W path indices centred on the best state of the previous
+ *        point, and the minimum over allowed transitions is found with 
+ *        sliding window minima, so this runs in O(N W).
+ * 
+ * @param xs Set of x coordinates of points
+ * @param ys Set of y coordinated of points
+ * @param pathx Set of x coordinates of path
+ * @param pathy Set of y coordinates of path
+ * @param lengths Set of increasing parametrization lengths
+ * @param output Array of same length of xs to put results in
+ * @param sigmax Error on x point positions, taken to be constant
+ * @param sigmay Error on y point positions, taken to be constant
+ * @param N Number of points
+ * @param M Length of path
+ * @param limit Largest change in length between consecutive points
+ * @param penalty Cost per unit change in length between consecutive points
+ * @param W Width of the band of path indices
+ * @return int The number of points whose state is on an inner edge of its
+ *         band (0 if the band never constrained the trajectory), -1 if memory
+ *         couldn't be allocated, -2 if the N * W back pointers don't fit in
+ *         a size_t
+ */
+int viterbiLengths(double* xs, double* ys, 
+                   double* pathx, double* pathy, double* lengths, 
+                   double* output,
+                   double sigmax, double sigmay, 
+                   int N, int M, double limit, double penalty, int W){
+    if(W > M) W = M;
+    if(W < 1 || N < 1) return 0;
+    double wx = 1/sigmax;
+    double wy = 1/sigmay;
+
+    // Back pointers (path indices) of each band slot of each point
+    if((size_t)N > SIZE_MAX / sizeof(int) / (size_t)W) return -2;
+    int *back = (int *)malloc((size_t)N * W * sizeof(int));
+    int *los = (int *)malloc(N * sizeof(int));
+    double *prev = (double *)malloc(W * sizeof(double));
+    double *cur = (double *)malloc(W * sizeof(double));
+    int *dq = (int *)malloc(W * sizeof(int));
+    double *dqv = (double *)malloc(W * sizeof(double));
+    if(!back || !los || !prev || !cur || !dq || !dqv){
+        free(back); free(los); free(prev); free(cur); free(dq); free(dqv);
+        return -1;
+    }
+
+    // Start the band at the nearest vertex of the first point
+    double d2;
+    int plo = bandStart(nearest(xs[0], ys[0], pathx, pathy, wx, wy, 0, M, &d2), W, M);
+    los[0] = plo;
+    for(int j = 0; j < W; j++){
+        nearest(xs[0], ys[0], pathx, pathy, wx, wy, plo + j, plo + j + 1, &prev[j]);
+    }
+
+    for(int i = 1; i < N; i++){
+        // Centre this point's band on the best state so far
+        int best = 0;
+        for(int j = 1; j < W; j++){
+            if(prev[j] < prev[best]) best = j;
+        }
+        int lo = bandStart(plo + best, W, M);
+        los[i] = lo;
+        int *bk = back + (size_t)i * W;
+        for(int j = 0; j < W; j++){
+            cur[j] = INFINITY;
+            bk[j] = plo + best;
+        }
+
+        // Transitions from shorter lengths: min over k <= g of
+        // prev[k] - penalty*l[k], with l[k] >= l[g] - limit.
+        int head = 0, tail = 0;
+        int k = plo;
+        for(int j = 0; j < W; j++){
+            int g = lo + j;
+            for(; k < plo + W && k <= g; k++){
+                double v = prev[k - plo] - penalty * lengths[k];
+                while(tail > head && dqv[tail-1] >= v) tail--;
+                dq[tail] = k;
+                dqv[tail++] = v;
+            }
+            while(head < tail && lengths[dq[head]] < lengths[g] - limit) head++;
+            if(head < tail){
+                double cost = dqv[head] + penalty * lengths[g];
+                if(cost < cur[j]){
+                    cur[j] = cost;
+                    bk[j] = dq[head];
+                }
+            }
+        }
+
+        // Transitions from longer lengths: min over k >= g of
+        // prev[k] + penalty*l[k], with l[k] <= l[g] + limit.
+        head = 0;
+        tail = 0;
+        k = plo + W - 1;
+        for(int j = W - 1; j >= 0; j--){
+            int g = lo + j;
+            for(; k >= plo && k >= g; k--){
+                double v = prev[k - plo] + penalty * lengths[k];
+                while(tail > head && dqv[tail-1] >= v) tail--;
+                dq[tail] = k;
+                dqv[tail++] = v;
+            }
+            while(head < tail && lengths[dq[head]] > lengths[g] + limit) head++;
+            if(head < tail){
+                double cost = dqv[head] - penalty * lengths[g];
+                if(cost < cur[j]){
+                    cur[j] = cost;
+                    bk[j] = dq[head];
+                }
+            }
+        }
+
+        for(int j = 0; j < W; j++){
+            nearest(xs[i], ys[i], pathx, pathy, wx, wy, lo + j, lo + j + 1, &d2);
+            cur[j] += d2;
+        }
+
+        double *tmp = prev;
+        prev = cur;
+        cur = tmp;
+        plo = lo;
+    }
+
+    // Follow the back pointers from the best final state
+    int best = 0;
+    for(int j = 1; j < W; j++){
+        if(prev[j] < prev[best]) best = j;
+    }
+    int s = plo + best;
+    output[N-1] = lengths[s];
+    // Points whose state is on an edge of their band (other than an end of
+    // the path), where a wider band might have found a better trajectory.
+    int edges = (s == plo && s > 0) || (s == plo + W - 1 && s < M - 1);
+    for(int i = N - 1; i > 0; i--){
+        s = back[(size_t)i * W + (s - los[i])];
+        output[i-1] = lengths[s];
+        edges += (s == los[i-1] && s > 0) || (s == los[i-1] + W - 1 && s < M - 1);
+    }
+
+    free(back); free(los); free(prev); free(cur); free(dq); free(dqv);
+    return edges;
+}
+
+/**
+ * @brief Index of the first of the increasing lengths that is at least value,
+ *        found by bisection.
+ */
+static inline int lowerBound(const double* lengths, int M, double value){
+    int lo = 0, hi = M;
+    while(lo < hi){
+        int mid = lo + (hi - lo)/2;
+        if(lengths[mid] < value) lo = mid + 1;
+        else hi = mid;
+    }
+    return lo;
+}
+
+/**
+ * @brief Same as minLengthsHist, but continuing from the length prev of the
+ *        point before x[0], so that a stream of points can be tracked one
+ *        block at a time. If prev is NaN the first point is computed without
+ *        hysteresis. The range of lengths is the same as getRange's, but found
+ *        by bisection, so lengths must be increasing, and the time per point
+ *        is O(log M + number of lengths in range).
+ * 
+ * @param xs Set of x coordinates of points
+ * @param ys Set of y coordinated of points
+ * @param pathx Set of x coordinates of path
+ * @param pathy Set of y coordinates of path
+ * @param lengths Set of increasing parametrization lengths
+ * @param out Array of same length of xs to put results in
+ * @param sigmax Error on x point positions, taken to be constant
+ * @param sigmay Error on y point positions, taken to be constant
+ * @param N Number of points
+ * @param M Length of path
+ * @param limit radius around each previous length to look at.
+ * @param prev length of the point before the first one, or NaN.
+ */
+int trackLengths(double* x, double* y, 
+                 double* pathx, double* pathy, double* lengths, 
+                 double* output,
+                 double sigmax, double sigmay, 
+                 int N, int M, double limit, double prev){
+    double wx = 1/sigmax;
+    double wy = 1/sigmay;
+    double min;
+
+    for(int i = 0; i < N; i++){
+        int lo = 0, hi = M;
+        if(!isnan(prev)){
+            // Same window as getRange: from the first length at or above
+            // prev - limit, up to and including the first one above
+            // prev + limit, searched for from index 1 on.
+            if(lengths[0] < prev - limit){
+                lo = lowerBound(lengths, M, prev - limit);
+            }
+            if(lengths[M-1] > prev + limit){
+                int start = lo > 1 ? lo : 1;
+                int above = lowerBound(lengths, M, nextafter(prev + limit, INFINITY));
+                hi = (above > start ? above : start) + 1;
+                if(hi > M) hi = M;
+            }
+        }
+        prev = lengths[nearest(x[i], y[i], pathx, pathy, wx, wy, lo, hi, &min)];
+        output[i] = prev;
+    }
+
+    return 0;
+}
@@ -6,6 +6,20 @@
 #  define CALL
 #endif
 
+/**
+ * @brief Sets the number of OpenMP threads used by the functions below.
+ * 
+ * @param n number of threads
+ */
+EXPORT void setThreads(int n);
+
+/**
+ * @brief Gets the number of OpenMP threads used by the functions below.
+ * 
+ * @return int number of threads
+ */
+EXPORT int getThreads(void);
+
 /**
  * @brief Compute the minimum distance between a point given by x,y and the path
  *        given by the set of points {pathx, pathy}.
@@ -144,3 +158,89 @@ EXPORT int minLengthsHist(double* x, double* y,
                       double* output,
                       double sigmax,double sigmay, 
                       int N, int M, double limit);
+
+/**
+ * @brief Mean squared minimum distance between the points {xs, ys} and the 
+ *        transformed path {p0*pathx + p1, p2*pathy}, along with its gradient 
+ *        with respect to p. The gradient only depends on the nearest vertex
+ *        of each point, so both are found in the same pass.
+ * 
+ * @param xs Set of x coordinates of points
+ * @param ys Set of y coordinated of points
+ * @param pathx Set of x coordinates of untransformed path
+ * @param pathy Set of y coordinates of untransformed path
+ * @param p Transformation parameters {p0, p1, p2}
+ * @param grad Array of length 3 to put the gradient in
+ * @param sigmax Error on x point positions, taken to be constant
+ * @param sigmay Error on y point positions, taken to be constant
+ * @param N Number of points
+ * @param M Length of path
+ * @return double The mean squared minimum distance
+ */
+EXPORT double lossGrad(double* xs, double* ys, 
+                       double* pathx, double* pathy, double* p, double* grad,
+                       double sigmax, double sigmay, 
+                       int N, int M);
+
+/**
+ * @brief Tracks the length along the path {pathx, pathy}, parametrized by 
+ *        increasing lengths, for a sequence of points {x,y} by finding the
+ *        globally optimal trajectory (Viterbi) rather than the greedy one of
+ *        minLengthsHist. The cost of a trajectory is the sum of squared
+ *        weighted distances from each point to its vertex, plus 
+ *        penalty * |change in length| between consecutive points, which may
+ *        not be more than limit. The states of each point are restricted to a
+ *        band of W path indices centred on the best state of the previous
+ *        point, and the minimum over allowed transitions is found with 
+ *        sliding window minima, so this runs in O(N W).
+ * 
+ * @param xs Set of x coordinates of points
+ * @param ys Set of y coordinated of points
+ * @param pathx Set of x coordinates of path
+ * @param pathy Set of y coordinates of path
+ * @param lengths Set of increasing parametrization lengths
+ * @param output Array of same length of xs to put results in
+ * @param sigmax Error on x point positions, taken to be constant
+ * @param sigmay Error on y point positions, taken to be constant
+ * @param N Number of points
+ * @param M Length of path
+ * @param limit Largest change in length between consecutive points
+ * @param penalty Cost per unit change in length between consecutive points
+ * @param W Width of the band of path indices
+ * @return int The number of points whose state is on an inner edge of its
+ *         band (0 if the band never constrained the trajectory), -1 if memory
+ *         couldn't be allocated, -2 if the N * W back pointers don't fit in
+ *         a size_t
+ */
+EXPORT int viterbiLengths(double* xs, double* ys, 
+                          double* pathx, double* pathy, double* lengths, 
+                          double* output,
+                          double sigmax, double sigmay, 
+                          int N, int M, double limit, double penalty, int W);
+
+/**
+ * @brief Same as minLengthsHist, but continuing from the length prev of the
+ *        point before x[0], so that a stream of points can be tracked one
+ *        block at a time. If prev is NaN the first point is computed without
+ *        hysteresis. The range of lengths is the same as getRange's, but found
+ *        by bisection, so lengths must be increasing, and the time per point
+ *        is O(log M + number of lengths in range).
+ * 
+ * @param xs Set of x coordinates of points
+ * @param ys Set of y coordinated of points
+ * @param pathx Set of x coordinates of path
+ * @param pathy Set of y coordinates of path
+ * @param lengths Set of increasing parametrization lengths
+ * @param out Array of same length of xs to put results in
+ * @param sigmax Error on x point positions, taken to be constant
+ * @param sigmay Error on y point positions, taken to be constant
+ * @param N Number of points
+ * @param M Length of path
+ * @param limit radius around each previous length to look at.
+ * @param prev length of the point before the first one, or NaN.
+ */
+EXPORT int trackLengths(double* x, double* y, 
+                        double* pathx, double* pathy, double* lengths, 
+                        double* output,
+                        double sigmax, double sigmay, 
+                        int N, int M, double limit, double prev);
@@ -0,0 +1,25 @@
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+# spinmob starts Qt on import, which needs a display unless told otherwise.
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import matplotlib
+matplotlib.use('Agg')
+
+# The repository root is the cavspy package (see package_dir in setup.py),
+# so make it importable under that name when it isn't installed. It's linked
+# into a directory on PYTHONPATH so worker processes can import it too.
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+try:
+    import cavspy
+except ImportError:
+    _path = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, _path, True)
+    os.symlink(_root, os.path.join(_path, 'cavspy'))
+    sys.path.insert(0, _path)
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [_path, os.environ.get('PYTHONPATH')]))
+    import cavspy
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import pandas as pd
+
+from cavspy import cache
+
+def test_round_trip(tmp_path):
+    store = cache.DiskCache(str(tmp_path))
+    obj = {'array' : np.arange(12.0).reshape(3, 4),
+           'frame' : pd.DataFrame({'times' : np.arange(3.0), 'counts' : [1, 2, 3]}),
+           'nested' : [np.zeros(0), (1, 'two', None)]}
+    key = store.key('file', 1, 2)
+    assert store.get(key) is None
+    assert store.put(key, obj)
+
+    out = store.get(key)
+    assert isinstance(out['array'], np.memmap)
+    np.testing.assert_array_equal(out['array'], obj['array'])
+    assert list(out['frame'].columns) == ['times', 'counts']
+    for col in out['frame']:
+        np.testing.assert_array_equal(out['frame'][col], obj['frame'][col])
+    assert out['nested'][1] == (1, 'two', None)
+    # Copy on write by default, so the stored arrays never change
+    out['array'][0, 0] = 99
+    assert store.get(key)['array'][0, 0] == 0
+
+def test_uncacheable(tmp_path):
+    store = cache.DiskCache(str(tmp_path))
+    assert not store.put('k', {'f' : lambda: None})
+    assert not store.put('k', np.array([object()]))
+    assert store.get('k') is None
+
+def test_evicts_least_recently_used(tmp_path):
+    store = cache.DiskCache(str(tmp_path), max_size=3 * 8500)
+    for i in range(3):
+        store.put('k%d' % i, np.zeros(1000))
+        # Spread the use times out so the order is unambiguous
+        meta = os.path.join(str(tmp_path), 'k%d' % i, 'meta.pkl')
+        os.utime(meta, (i, i))
+    store.get('k0')
+    store.put('k3', np.zeros(1000))
+    assert store.get('k1') is None
+    assert store.get('k0') is not None
+    assert store.size() <= store.max_size
+    store.clear()
+    assert store.entries() == []
@@ -0,0 +1,198 @@
+import numpy as np
+import pytest
+from scipy import constants
+
+from cavspy import cavity as cv
+
+# r, fm, m, lamb, a, phi, theta, pc
+params = (0.99, 10E6, 0.5, 1.55E-6, 0.8, 0.1, 0.3, 0.7)
+dLs = np.linspace(-1E-8, 1E-8, 501)
+
+def test_grids_match_scalar_models():
+    r, fm, m, lamb, a, phi, theta, pc = params
+    rs = np.array([0.9, 0.99, 0.999])
+    phis = np.array([0.0, 0.1, 1.0, 2.0])
+    grid = cv.errf_grid(dLs, rs[:, None], fm, m, lamb, a, phis[None, :], theta)
+    assert grid.shape == (3, 4, len(dLs))
+    for i, rr in enumerate(rs):
+        for j, ph in enumerate(phis):
+            np.testing.assert_allclose(grid[i, j], cv.errf(dLs, rr, fm, m, lamb, a, ph, theta),
+                                       rtol=1E-12, atol=1E-15)
+    out = np.empty((3, len(dLs)))
+    cv.transf_grid(dLs, rs, fm, m, lamb, pc, out=out)
+    for i, rr in enumerate(rs):
+        np.testing.assert_allclose(out[i], cv.transf(dLs, rr, fm, m, lamb, pc), rtol=1E-12)
+
+##########################
+# Minimum Distance Pools #
+##########################
+def _brute(pairs, es, ts, sigmae, sigmat):
+    return np.sqrt(np.min(((pairs[:, 0, None] - es) / sigmae)**2
+                          + ((pairs[:, 1, None] - ts) / sigmat)**2, axis=1))
+
+@pytest.mark.parametrize("executor", ['thread', 'process'])
+def test_min_dist_engine(executor):
+    rng = np.random.default_rng(0)
+    es = np.sin(np.linspace(0, 6, 700))
+    ts = np.cos(np.linspace(0, 9, 700))
+    pairs = rng.normal(size=(1001, 2))
+    # Start numba's parallel threads first, which forked workers used to deadlock on
+    cv.errf_grid(dLs, *params[:7])
+    with cv.MinDistEngine(es, ts, 0.3, 0.5, workers=2, executor=executor) as engine:
+        np.testing.assert_allclose(engine(pairs), _brute(pairs, es, ts, 0.3, 0.5), rtol=1E-12)
+        assert len(engine(pairs[:1])) == 1
+
+def test_min_dists_reuses_engine():
+    es = np.linspace(0, 1, 100)
+    ts = es**2
+    pairs = np.random.default_rng(1).random((50, 2))
+    first = cv.min_dists(pairs, es, ts, 1.0, 1.0)
+    engine = cv._engine
+    np.testing.assert_allclose(cv.min_dists(pairs, es, ts, 1.0, 1.0), first)
+    assert cv._engine is engine
+    np.testing.assert_allclose(cv.min_dists(pairs, es, ts, 2.0, 1.0), _brute(pairs, es, ts, 2.0, 1.0))
+    assert cv._engine is not engine
+
+####################
+# Reference Curves #
+####################
+def test_pdh_curve_cache(tmp_path):
+    args = params + (dLs[0], dLs[-1], len(dLs))
+    cv.enable_curve_cache(str(tmp_path), memory=2)
+    try:
+        ls, es, ts = cv.pdh_curve(*args)
+        np.testing.assert_allclose(ls, dLs)
+        np.testing.assert_allclose(es, cv.errf(dLs, *params[:7]), rtol=1E-12, atol=1E-15)
+        np.testing.assert_allclose(ts, cv.transf(dLs, *params[:4], params[7]), rtol=1E-12)
+        assert not es.flags.writeable
+        assert cv.pdh_curve(*args)[1] is es
+
+        # Loaded from disk once it's gone from memory
+        cv._curves.clear()
+        _, disk, _ = cv.pdh_curve(*args)
+        assert disk is not es
+        np.testing.assert_array_equal(disk, es)
+
+        for num in range(10, 15):
+            cv.pdh_curve(*params, 0.0, 1E-9, num)
+        assert len(cv._curves) == 2
+        cv.enable_curve_cache(str(tmp_path), memory=1)
+        assert len(cv._curves) == 1
+    finally:
+        cv.disable_curve_cache()
+    assert len(cv._curves) == 0
+
+#####################
+# Sideband Fitting #
+#####################
+triple = dict(splitting=0.5, amp=1.0, slope=0.2, center=0.01, linewidth=0.05, ps=0.3, offset=0.1)
+xs = np.linspace(-1, 1, 2001)
+
+def test_compiled_triples_match():
+    np.testing.assert_allclose(cv._triple_fan_jit(xs, **triple), cv.triple_fan(xs, **triple), rtol=1E-13)
+    lor = {k : v for k, v in triple.items() if k != 'slope'}
+    np.testing.assert_allclose(cv._triple_lor_jit(xs, **lor), cv.triple_lor(xs, **lor), rtol=1E-13)
+
+def test_triple_jacobian_matches_finite_differences():
+    import lmfit as lm
+    model = lm.Model(cv.triple_fan)
+    pars = model.make_params(**triple)
+    jac = cv._triple_dfun(pars, None, None, x=xs)
+    for row, name in zip(jac, pars):
+        h = 1E-6 * max(abs(triple[name]), 1E-3)
+        up = dict(triple, **{name : triple[name] + h})
+        down = dict(triple, **{name : triple[name] - h})
+        # Residual is data - model
+        fd = -(cv.triple_fan(xs, **up) - cv.triple_fan(xs, **down)) / (2 * h)
+        np.testing.assert_allclose(row, fd, rtol=1E-5, atol=1E-6 * np.max(np.abs(fd)))
+
+def test_fit_triples_analytic_matches_numeric():
+    rng = np.random.default_rng(2)
+    # Sidebands a tenth of the carrier, as _guess_triple expects by default
+    lor = dict(splitting=0.5, amp=1.0, center=0.01, linewidth=0.05, ps=0.1, offset=0.1)
+    ys = cv.triple_lor(xs, **lor) + rng.normal(0, 0.003, len(xs))
+    results = [cv.fit_triples([(xs, ys)], cv.triple_lor, 1.0, executor='thread', analytic=analytic)
+               for analytic in (True, False)]
+    for res in results:
+        assert res['success'][0]
+        np.testing.assert_allclose(float(res['linewidth'][0].x), 0.05 / 0.5 * 2, rtol=0.01)
+    np.testing.assert_allclose(float(results[0]['linewidth'][0].x), float(results[1]['linewidth'][0].x),
+                               rtol=1E-5)
+
+###############
+# PDH Fitting #
+###############
+fm = 10E6
+lamb = 1.55E-6
+truth = dict(r=0.99, m=0.5, a=0.8, phi=0.1, theta=0.3, pc=0.7, scale=1E-8, x0=0.05,
+             amp_e=2.0, off_e=0.01, amp_t=3.0, off_t=0.02)
+
+def _pdh_traces(noise, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(-1, 1, 2001)
+    dL = truth['scale'] * (x - truth['x0'])
+    err = truth['amp_e'] * cv.errf(dL, truth['r'], fm, truth['m'], lamb, truth['a'],
+                                   truth['phi'], truth['theta']) + truth['off_e']
+    trans = truth['amp_t'] * cv.transf(dL, truth['r'], fm, truth['m'], lamb, truth['pc']) + truth['off_t']
+    return x, err + rng.normal(0, noise, len(x)), trans + rng.normal(0, noise, len(x))
+
+def test_pdh_jacobian_matches_finite_differences():
+    x, err, trans = _pdh_traces(0.0)
+    d = cv._PDHData(x, err, trans, fm, lamb, 1.0, 1.0)
+    v = np.array([truth[n] for n in cv._pdh_names])
+    jac = np.empty((len(v), len(d.data)))
+    d.eval(v, jac)
+    for i in range(len(v)):
+        h = 1E-5 * abs(v[i])
+        up = v.copy()
+        down = v.copy()
+        up[i] += h
+        down[i] -= h
+        fd = (d.eval(up) - d.eval(down)) / (2 * h)
+        # Relative to the largest change in either signal, finite differences
+        # lose some digits to rounding.
+        assert np.max(np.abs(jac[i] - fd)) <= 1E-5 * np.max(np.abs(fd)) + 1E-9 / h
+
+def test_fit_pdh_fits_traces():
+    x, err, trans = _pdh_traces(0.002)
+    clean = _pdh_traces(0.0)
+    start = cv.pdh_params(**dict(truth, x0=0.06, r=0.985, theta=0.25))
+    # The sidebands are far off the sweep, so these are hard to tell apart
+    for n in ('m', 'a', 'phi', 'pc', 'scale'):
+        start[n].vary = False
+    result = cv.fit_pdh(x, err, trans, start, fm, lamb)
+    assert result.success
+    for n in ('r', 'x0', 'amp_t', 'off_t'):
+        np.testing.assert_allclose(result.params[n].value, truth[n], rtol=1E-2)
+    d = cv._PDHData(x, *clean[1:], fm, lamb, 1.0, 1.0)
+    model = d.eval([result.params[n].value for n in cv._pdh_names])
+    assert np.max(np.abs(model - d.data)) < 0.002
+
+    rows = cv.fit_pdh_many([(x, err, trans), (x, None, None)], start, fm, lamb, executor='thread')
+    assert rows['success'].tolist() == [True, False]
+
+#####################
+# WhiteLight Length #
+#####################
+def _white_file(path, lengths):
+    wl = np.linspace(590, 660, 7001)
+    freq = constants.c / (wl * 1E-9)
+    cols = []
+    for L in lengths:
+        # Fabry-Perot fringes with an FSR of c/2L
+        cols.append(100 / (1 + 50 * np.sin(2 * np.pi * freq * L / constants.c)**2))
+    with open(path, 'w') as f:
+        f.write('\n' * 30)
+        f.write(','.join(['wl'] + ['c%d' % i for i in range(len(lengths))]) + '\n')
+        for row in zip(wl, *cols):
+            f.write(','.join('%.10g' % v for v in row) + '\n')
+    return str(path)
+
+def test_white_lengths_match_single_column(tmp_path):
+    path = _white_file(tmp_path / 'white.csv', [40E-6, 60E-6])
+    table = cv.white_lengths([path], dist=20)
+    assert table['success'].all()
+    for i, L in enumerate([40E-6, 60E-6]):
+        length, fsr = cv.white_length(path, col=i + 1, dist=20)
+        np.testing.assert_allclose(float(table['length'][i].x), float(length.x), rtol=1E-12)
+        np.testing.assert_allclose(float(table['length'][i].x), L * 1E6, rtol=0.01)
@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+
+from cavspy import compfun as cf
+
+freq = np.logspace(0, 6, 301)
+
+# The builders as they were written before RatCompFun, as functions of f.
+_old = {
+    'hp' : (lambda c: lambda f: 2*np.pi*f/(2*np.pi*c) / (2*np.pi*f/(2*np.pi*c) - 1j), (1E3,)),
+    'lp' : (lambda c: lambda f: -1j / ((2*np.pi*f/(2*np.pi*c)) - 1j), (1E3,)),
+    'pi' : (lambda corner, gain: lambda f: gain * (1 - 1.0j * corner / f), (50.0, 3.0)),
+    'ho' : (lambda res, damp: lambda f: 1 / (1 + 1j*2*np.pi*f*2*np.pi*damp/(2*np.pi*res)**2
+                                             - ((2*np.pi*f)/(2*np.pi*res))**2), (2E4, 300.0)),
+    'lag' : (lambda ff, a: lambda f: a*(1 + 1j*f/ff)/(a + 1j*f/ff), (1E3, 0.1)),
+    'lead' : (lambda ff, a: lambda f: a*(1 + 1j*f/ff)/(a*1j*f/ff + 1), (1E3, 0.1)),
+    'amp' : (lambda a: lambda f: np.ones(np.size(f)) * a, (2.5,)),
+    'delay' : (lambda dt: lambda f: np.exp(-1j*2*np.pi*f*dt), (1E-6,)),
+    'lfgl' : (lambda R1, R2, C1, C2: lambda f: (R2*(-1j + C1*R1*2*np.pi*f))
+              / (-1j*(R1 + R2) + (C1 + C2)*R1*R2*2*np.pi*f), (1E3, 1E4, 1E-7, 1E-8)),
+}
+
+@pytest.mark.parametrize("name", sorted(_old))
+def test_builders_match_old_lambdas(name):
+    old, args = _old[name]
+    new = getattr(cf, name)(*args)
+    np.testing.assert_allclose(new.func(freq), old(*args)(freq), rtol=1E-12, atol=1E-15)
+
+def test_rational_products_combine_roots():
+    chain = cf.lp(1E3) * cf.hp(10.0) * cf.pi(50.0, 3.0) / cf.lag(2E3, 0.5) * 2.0
+    assert isinstance(chain, cf.RatCompFun)
+    expected = (cf.lp(1E3).func(freq) * cf.hp(10.0).func(freq) * cf.pi(50.0, 3.0).func(freq)
+                / cf.lag(2E3, 0.5).func(freq) * 2.0)
+    np.testing.assert_allclose(chain.func(freq), expected, rtol=1E-10)
+    # The zero of the high pass cancels the pole of the integrator
+    assert not np.any(chain.poles == 0)
+
+def test_rational_sum():
+    a = cf.lp(1E3)
+    b = cf.hp(1E4)
+    np.testing.assert_allclose((a + b).func(freq), a.func(freq) + b.func(freq), rtol=1E-10)
+
+def _old_merge(cm1, cm2):
+    c = np.array(cm1.c)
+    f = cm1.f
+    newfs = []
+    newcs = []
+    for i, fr in enumerate(cm2.f):
+        if fr in f:
+            j = np.argmin(np.abs(f - fr))
+            c[j] = np.average([cm1.c[j], cm2.c[i]])
+        else:
+            newfs.append(fr)
+            newcs.append(cm2.c[i])
+    f = np.append(f, np.array(newfs))
+    c = np.append(c, np.array(newcs))
+    combined = sorted(zip(c, f), key=lambda pair: pair[1])
+    c, f = map(np.array, zip(*combined))
+    return cf.CompFun(c, f)
+
+def test_merge_matches_old_merge():
+    rng = np.random.default_rng(0)
+    f1 = np.sort(rng.choice(np.arange(1, 200), 80, replace=False)).astype(float)
+    f2 = np.sort(rng.choice(np.arange(1, 200), 60, replace=False)).astype(float)
+    a = cf.CompFun(rng.normal(size=80) + 1j * rng.normal(size=80), f1)
+    b = cf.CompFun(rng.normal(size=60) + 1j * rng.normal(size=60), f2)
+    old = _old_merge(a, b)
+    new = cf.merge(a, b)
+    np.testing.assert_array_equal(new.f, old.f)
+    np.testing.assert_allclose(new.c, old.c, rtol=1E-14)
+
+def test_merge_tolerance_and_weights():
+    a = cf.CompFun(np.array([1.0, 2.0]), np.array([10.0, 20.0]))
+    b = cf.CompFun(np.array([4.0, 8.0]), np.array([10.1, 30.0]))
+    merged = cf.merge(a, b, tol=0.2, weights=[1.0, 3.0])
+    np.testing.assert_allclose(merged.f, [10.075, 20.0, 30.0])
+    np.testing.assert_allclose(merged.c, [3.25, 2.0, 8.0])
+
+def test_vector_fit_recovers_model():
+    true = cf.RatCompFun([-2*np.pi*3E3], [-2*np.pi*100.0, -2*np.pi*(500 + 2E4j), -2*np.pi*(500 - 2E4j)], 1E8)
+    model = cf.vector_fit(true.apply(freq), 3)
+    np.testing.assert_allclose(model.func(freq), true.func(freq), rtol=1E-6)
+    assert np.all(model.poles.real < 0)
+
+def test_vector_fit_many_reports_errors():
+    good = cf.lp(1E3).apply(freq)
+    results = cf.vector_fit_many([good, cf.CompFun(np.array([]), np.array([]))], 1, executor='thread')
+    assert results['success'].tolist() == [True, False]
+    assert results['rms'][0] < 1E-8
+
+def _third_order(K):
+    # K / (s + 1)^3, in rad/s so crossovers are simple to find by hand
+    return cf.RatCompFun([], [-1.0, -1.0, -1.0], K)
+
+def test_margins_of_known_loop():
+    freq = np.logspace(-3, 1, 2001)
+    w180 = np.sqrt(3)
+    wc = np.sqrt(2**(2/3) - 1)
+    pm = 180 - 3 * np.degrees(np.arctan(wc))
+    for loop in (_third_order(2.0), _third_order(2.0).apply(freq)):
+        m = cf.margins(loop, freq)
+        tol = 1E-9 if isinstance(loop, cf.AnCompFun) else 1E-4
+        np.testing.assert_allclose(m['gain_margin'], 4.0, rtol=tol)
+        np.testing.assert_allclose(m['phase_crossover'], w180 / (2*np.pi), rtol=tol)
+        np.testing.assert_allclose(m['phase_margin'], pm, rtol=tol)
+        np.testing.assert_allclose(m['gain_crossover'], wc / (2*np.pi), rtol=tol)
+        np.testing.assert_allclose(m['delay_margin'], np.radians(pm) / wc, rtol=tol)
+
+def test_margins_of_unstable_loop():
+    m = cf.margins(_third_order(10.0), np.logspace(-3, 1, 2001))
+    assert m['phase_margin'] < 0
+    assert m['delay_margin'] == 0
+
+def test_margins_stacked_sweeps():
+    freq = np.logspace(-3, 1, 2001)
+    loops = [_third_order(K) for K in (0.5, 2.0, 4.0)]
+    table = cf.margins([loop.apply(freq) for loop in loops])
+    np.testing.assert_allclose(table['gain_margin'], [16.0, 4.0, 2.0], rtol=1E-4)
+    # No unity gain crossing below a gain of 1
+    assert table['phase_margin'][0] == np.inf
+    np.testing.assert_allclose(cf.margins(np.array([l.func(freq) for l in loops]), freq)['gain_margin'],
+                               table['gain_margin'])
+
+def test_resample_is_exact_for_power_laws():
+    coarse = np.logspace(0, 4, 41)
+    fine = np.logspace(0.5, 3.5, 97)
+    # 1/f^2 times a linear phase in log f is linear in both
+    func = cf.CompFun(np.exp(-2*np.log(coarse) + 1j * 0.3 * np.log(coarse)), coarse)
+    out = func.resample(fine)
+    np.testing.assert_allclose(out.c, np.exp(-2*np.log(fine) + 1j * 0.3 * np.log(fine)), rtol=1E-12)
+
+def test_align_arithmetic():
+    a = cf.lp(1E3).apply(np.logspace(0, 5, 51))
+    b = cf.hp(10.0).apply(np.logspace(1, 6, 73))
+    with pytest.raises(ValueError):
+        a * b
+    cf.enable_align()
+    try:
+        product = a * b
+    finally:
+        cf.disable_align()
+    keep = a.f >= 10.0
+    np.testing.assert_array_equal(product.f, a.f[keep])
+    np.testing.assert_allclose(product.c, a.c[keep] * cf.hp(10.0).func(a.f[keep]), rtol=5E-3)
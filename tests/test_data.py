@@ -0,0 +1,214 @@
+import pickle
+import numpy as np
+import pytest
+
+from cavspy import data
+
+###########
+# Readers #
+###########
+def _write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    return str(path)
+
+def test_sniff_csv_hints(tmp_path):
+    named = _write(tmp_path / 'named.csv', 'a,b\n1,2\n3,4\n')
+    assert data.sniff(named) == (data.read_csv, {'head' : 0, 'delim' : ','})
+    np.testing.assert_array_equal(data.read(named), [[1, 2], [3, 4]])
+
+    # No column names, so the header is left to read_csv
+    bare = _write(tmp_path / 'bare.txt', '1\t2\n3\t4\n')
+    assert data.sniff(bare)[1] == {'delim' : '\t'}
+    np.testing.assert_array_equal(data.read(bare), [[1, 2], [3, 4]])
+
+    # Commas and semicolons on every line, so pandas picks
+    ambiguous = _write(tmp_path / 'ambiguous.csv', '1;2,5\n3;4,5\n')
+    assert 'delim' not in data.sniff(ambiguous)[1]
+
+def test_read_kwargs_override_hints(tmp_path):
+    path = _write(tmp_path / 'named.csv', '# note\na,b\n1,2\n3,4\n')
+    frame = data.read(path, df=True)
+    assert list(frame.columns) == ['a', 'b']
+    # An explicit head is used as given
+    frame = data.read(path, df=True, head=2)
+    assert list(frame.columns) == ['1', '2']
+
+def test_register_reader(tmp_path):
+    seen = []
+    def reader(filename, **kwargs):
+        seen.append(kwargs)
+        return 'custom'
+    entry = len(data._readers)
+    data.register_reader(reader, magic=b'MAGIC!', hints=lambda block: {'size' : len(block)})
+    try:
+        path = _write(tmp_path / 'file.bin', 'MAGIC!rest')
+        assert data.read(path, extra=1) == 'custom'
+        assert seen == [{'size' : 10, 'extra' : 1}]
+    finally:
+        del data._readers[entry]
+
+def test_read_cache(tmp_path):
+    path = _write(tmp_path / 'named.csv', 'a,b\n1,2\n3,4\n')
+    data.enable_cache(str(tmp_path / 'cache'))
+    try:
+        first = data.read(path)
+        cached = data.read(path)
+        np.testing.assert_array_equal(cached, first)
+        assert isinstance(cached, np.memmap)
+        assert not isinstance(data.read(path, _cache=False), np.memmap)
+    finally:
+        data.disable_cache()
+
+def test_read_many_reports_errors(tmp_path):
+    paths = [_write(tmp_path / ('%d.csv' % i), 'a,b\n%d,2\n' % i) for i in range(5)]
+    paths.insert(2, str(tmp_path / 'missing.csv'))
+    results = list(data.read_many(paths, workers=2, executor='thread'))
+    assert [path for path, _ in results] == paths
+    assert isinstance(results[2][1], OSError)
+    assert [int(res[0, 0]) for _, res in results if not isinstance(res, Exception)] == list(range(5))
+
+##################
+# Lock-In Unpack #
+##################
+# unpack as it was, parsing each line on its own
+def _old_unpack(filename, fields=[], delim=';'):
+    chunks = {}
+    with open(filename) as f:
+        next(f)
+        for line in f:
+            entries = line.split(delim)
+            dic = chunks.setdefault(entries[0], {})
+            fieldname = entries[3]
+            values = np.array([float(x) for x in entries[4:]])
+            if fieldname in fields or len(fields) == 0:
+                if fieldname not in dic:
+                    dic[fieldname] = values
+                else:
+                    dic[fieldname] = np.concatenate((dic[fieldname], values))
+    return list(chunks.values())
+
+@pytest.mark.parametrize("block", [data.UNPACK_BLOCK, 64])
+def test_unpack_matches_line_parser(tmp_path, monkeypatch, block):
+    monkeypatch.setattr(data, 'UNPACK_BLOCK', block)
+    rng = np.random.default_rng(0)
+    lines = ['chunk;timestamp;size;fieldname;value\n']
+    for chunk in range(3):
+        for _ in range(4):
+            for field in ('r', 'phase', 'frequency'):
+                values = rng.normal(size=5)
+                lines.append('%d;0;5;%s;%s\n' % (chunk, field, ';'.join('%.17g' % v for v in values)))
+    path = _write(tmp_path / 'lockin.csv', ''.join(lines))
+
+    for fields in ([], ['r', 'frequency']):
+        new = data.unpack(path, fields=fields)
+        old = _old_unpack(path, fields=fields)
+        assert len(new) == len(old)
+        for n, o in zip(new, old):
+            assert n.keys() == o.keys()
+            for key in o:
+                np.testing.assert_array_equal(n[key], o[key])
+
+def test_unpack_rejects_bad_values(tmp_path):
+    path = _write(tmp_path / 'bad.csv', 'head\n0;0;2;x;1.0;oops\n')
+    with pytest.raises(ValueError):
+        data.unpack(path)
+
+#########
+# Scans #
+#########
+def _scan_file(path, scan_type, shape, pages):
+    header = ['Xstart (V): 0', 'Xstop (V): 1', 'Ystart (V): -1', 'Ystop (V): 1',
+              'Zstart (V): 0', 'Zstop (V): 2',
+              'Xpoints: %d' % shape[0], 'Ypoints: %d' % shape[1], 'Zpoints: %d' % shape[2],
+              'Scan type (0=triangle, 1=raster, 2=raster,slow return, 3=objective): %d' % scan_type]
+    lines = ['Scan data, number of header lines: %d' % (len(header) + 1)] + header
+    text = '\n'.join(lines) + '\n'
+    for i, page in enumerate(pages):
+        text += 'page %d\n' % i
+        text += ''.join(','.join('%g' % v for v in row) + '\n' for row in page)
+        text += '\n'
+    return _write(path, text)
+
+# load_3d_scan as it was, reading the whole file at once
+def _old_load_3d(filename, head):
+    with open(filename) as f:
+        for _ in range(head):
+            next(f)
+        pages = f.read().split('\n\n')[:-1]
+    pages = [np.array([line.split(',') for line in page.split('\n')[1:]], dtype=np.float32)
+             for page in pages]
+    return np.swapaxes(np.dstack(pages), 1, 2)
+
+def _pages(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 1000, (shape[2], shape[0], shape[1])).astype(float)
+
+def test_3d_scan_matches_old_loader(tmp_path):
+    shape = (4, 3, 5)
+    path = _scan_file(tmp_path / 'scan.txt', 5, shape, _pages(shape))
+    scan = data.read(path)
+    assert isinstance(scan, data.Scan)
+    assert not scan.loaded
+    expected = _old_load_3d(path, 11)
+    np.testing.assert_array_equal(scan.raw_data, expected)
+    np.testing.assert_array_equal(data.load_3d_scan(path, 11, memmap=str(tmp_path / 'cube.npy')), expected)
+
+def test_3d_scan_stopped_early(tmp_path):
+    shape = (4, 3, 5)
+    pages = _pages(shape)
+    path = _scan_file(tmp_path / 'scan.txt', 5, shape, pages[:2])
+    assert data.read(path).raw_data.shape == (4, 2, 3)
+
+def test_3d_scan_malformed_page(tmp_path):
+    shape = (2, 2, 1)
+    path = _scan_file(tmp_path / 'scan.txt', 5, shape, _pages(shape))
+    with open(path) as f:
+        text = f.read()
+    with open(path, 'w') as f:
+        f.write(text.replace('page 0\n', 'page 0\n1,x\n', 1))
+    with pytest.raises(ValueError):
+        data.read(path).raw_data
+
+def test_scan_mapping(tmp_path):
+    shape = (4, 3, 5)
+    path = _scan_file(tmp_path / 'scan.txt', 5, shape, _pages(shape))
+    scan = data.read(path)
+    assert 'data' in scan and not scan.loaded
+    keys = list(scan)
+    assert keys[0] == 'data'
+    assert {'Xpoints', 'scan_type', 'Vxs', 'Vys', 'Vzs'} <= set(keys)
+    assert 'xs' not in scan
+    assert not scan.loaded
+    assert len(scan) == len(keys)
+
+    np.testing.assert_allclose(scan['Vys'], np.linspace(-1, 1, 3))
+    scan.convert_units(pz_gain=-2.0, cpz_gain=0.5)
+    assert 'xs' in scan
+    np.testing.assert_allclose(scan['xs'], -2.0 * np.linspace(0, 1, 4))
+    # Negative piezo gain flips x and y
+    np.testing.assert_array_equal(scan['data'], np.flip(scan.raw_data, axis=(0, 1)))
+
+    scan['note'] = 'hi'
+    assert scan['note'] == 'hi'
+    del scan['note']
+    assert 'note' not in scan
+    del scan['data']
+    assert 'data' not in scan
+    with pytest.raises(KeyError):
+        scan['data']
+    assert dict(data.Scan({'scan_type' : 0, 'a' : 1})) == {'scan_type' : 0, 'a' : 1}
+
+def test_scan_cache_state_stays_lazy(tmp_path):
+    shape = (4, 3, 5)
+    path = _scan_file(tmp_path / 'scan.txt', 5, shape, _pages(shape))
+    scan = data.read(path)
+    state = scan._cache_state()
+    assert not scan.loaded
+    assert state['data'] is None
+    copy = data.Scan._from_cache_state(pickle.loads(pickle.dumps(state)))
+    assert not copy.loaded
+    np.testing.assert_array_equal(copy.raw_data, scan.raw_data)
+
+    loaded = data.Scan._from_cache_state(scan._cache_state())
+    assert loaded.loaded
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cavspy import lifetime as lt
+
+times = np.arange(400) * 0.05
+
+def _irf():
+    irf = np.exp(-0.5 * ((times - 1.0) / 0.1)**2)
+    return irf / np.sum(irf)
+
+def test_jacobian_matches_finite_differences():
+    model = lt.DecayModel(times, 2, _irf())
+    values = np.array([500.0, 2.0, 200.0, 0.5, 3.0])
+    _, jac = model.eval_jac(values)
+    for i in range(len(values)):
+        h = 1E-6 * values[i]
+        up = values.copy()
+        down = values.copy()
+        up[i] += h
+        down[i] -= h
+        np.testing.assert_allclose(jac[:, i], (model.eval(up) - model.eval(down)) / (2 * h),
+                                   rtol=1E-5, atol=1E-6 * np.max(np.abs(jac[:, i])))
+
+def test_convolution_matches_direct_sum():
+    irf = _irf()
+    model = lt.DecayModel(times, 1, irf)
+    decay = 100.0 * np.exp(-times / 1.5)
+    np.testing.assert_allclose(model.eval([100.0, 1.5, 0.0]), np.convolve(irf, decay)[:len(times)],
+                               atol=1E-10)
+
+@pytest.mark.parametrize("method", ['mle', 'lsq'])
+def test_fit_recovers_lifetimes(method):
+    rng = np.random.default_rng(0)
+    truth = lt.DecayModel(times, 2, _irf()).eval([4000.0, 3.0, 8000.0, 0.4, 5.0])
+    hist = pd.DataFrame({'times' : times, 'counts' : rng.poisson(truth)})
+    result = lt.fit_decay(hist, [2.0, 1.0], irf=_irf(), method=method)
+    taus = sorted([result.params['tau0'].value, result.params['tau1'].value])
+    np.testing.assert_allclose(taus, [0.4, 3.0], rtol=0.05)
+    assert result.success
+
+def test_fit_range_masks_bins():
+    rng = np.random.default_rng(1)
+    counts = rng.poisson(1000.0 * np.exp(-times / 2.0) + 2.0)
+    result = lt.fit_decay(counts, [1.0], times=times, tmin=1.0, tmax=15.0)
+    assert result.ndata == np.sum((times >= 1.0) & (times <= 15.0))
+    np.testing.assert_allclose(result.params['tau0'].value, 2.0, rtol=0.05)
+
+def test_fit_many_rows():
+    rng = np.random.default_rng(2)
+    hists = [rng.poisson(1000.0 * np.exp(-times / tau) + 1.0) for tau in (1.0, 2.0)]
+    results = lt.fit_many(hists + [np.zeros(3)], [1.5], times=times, executor='thread')
+    assert results['success'].tolist()[:2] == [True, True]
+    assert not results['success'][2]
+    assert isinstance(results['error'][2], Exception)
+    np.testing.assert_allclose([float(g.x) for g in results['tau0'][:2]], [1.0, 2.0], rtol=0.05)
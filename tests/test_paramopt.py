@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+from cavspy import paramopt as po
+
+def _trace(M, N, seed, noise=1.0):
+    # A curve that doesn't repeat, and a noisy random walk along it
+    rng = np.random.default_rng(seed)
+    ls = np.linspace(0, 1, M)
+    es = np.sin(7 * ls) + 2 * ls
+    ts = np.cos(11 * ls**2)
+    walk = np.clip(0.5 + np.cumsum(rng.normal(0, 0.002, N)), 0, 1)
+    idx = np.searchsorted(ls, walk).clip(0, M - 1)
+    return (ls, es, ts,
+            es[idx] + rng.normal(0, noise, N),
+            ts[idx] + rng.normal(0, noise, N))
+
+def _cost(lengths, ls, es, ts, xs, ys):
+    idx = np.searchsorted(ls, lengths)
+    return np.sum((xs - es[idx])**2 + (ys - ts[idx])**2)
+
+def _tracks(M, N, seed, noise, limit):
+    ls, es, ts, xs, ys = _trace(M, N, seed, noise)
+    full = po.min_lengths_dp((xs, ys), es, ts, 1.0, 1.0, ls, limit, width='full')
+    banded = po.min_lengths_dp((xs, ys), es, ts, 1.0, 1.0, ls, limit)
+    greedy = po.min_lengths_hist((xs, ys), es, ts, 1.0, 1.0, ls, limit)
+    costs = [_cost(lengths, ls, es, ts, xs, ys) for lengths in (full, banded, greedy)]
+    return full, banded, costs
+
+@pytest.mark.parametrize("seed", [4, 8])
+def test_dp_band_matches_full_dp(seed):
+    full, banded, (best, _, greedy) = _tracks(2000, 5000, seed, 0.05, 0.01)
+    np.testing.assert_array_equal(banded, full)
+    assert best <= greedy + 1E-9
+    assert np.all(np.abs(np.diff(full)) <= 0.01 + 1E-12)
+
+@pytest.mark.parametrize("seed", [4, 8])
+def test_dp_band_on_noisy_trace(seed):
+    # The band can't always hold the optimum this deep in the noise,
+    # but it should stay close to it, and well ahead of the greedy tracker.
+    _, _, (best, banded, greedy) = _tracks(500, 5000, seed, 1.0, 0.01)
+    assert best <= banded + 1E-9
+    assert banded <= best * 1.02
+    assert banded < greedy
+
+@pytest.mark.parametrize("limit", [0.001, 0.01, 0.05])
+def test_stream_matches_get_lengths(limit):
+    ls, es, ts, xs, ys = _trace(500, 5000, 1)
+    p = [1.0, 0.0, 1.0]
+    whole = po.get_lengths((xs, ys), es, ts, 1.0, 1.0, ls, p, hist=limit)
+    stream = po.LengthStream(es, ts, 1.0, 1.0, ls, p, limit)
+    blocks = [stream.push((xs[i:i+397], ys[i:i+397])) for i in range(0, len(xs), 397)]
+    np.testing.assert_array_equal(np.concatenate(blocks), whole)
+
+#############
+# PathIndex #
+#############
+def _segment_dists(xs, ys, es, ts, sigmae, sigmat):
+    # Projection of every point onto every segment
+    pu = (xs[:, None] - es[:-1]) / sigmae
+    pv = (ys[:, None] - ts[:-1]) / sigmat
+    du = np.diff(es) / sigmae
+    dv = np.diff(ts) / sigmat
+    frac = np.clip((pu * du + pv * dv) / (du**2 + dv**2), 0, 1)
+    return np.min(np.hypot(pu - frac * du, pv - frac * dv), axis=1)
+
+@pytest.mark.parametrize("p", [None, [1.0, 0.0, 1.0], [1.3, 0.2, 0.8], [-0.7, -0.1, 2.5]])
+def test_path_index_matches_brute(p):
+    ls, es, ts, xs, ys = _trace(700, 3000, 2, noise=0.3)
+    brute_p = [1.0, 0.0, 1.0] if p is None else p
+    new_es = brute_p[0] * es + brute_p[1]
+    new_ts = brute_p[2] * ts
+    brute = po.min_lengths((xs, ys), new_es, new_ts, 0.4, 0.7, ls)
+    for built in (None, p):
+        index = po.PathIndex(es, ts, 0.4, 0.7, p=built)
+        np.testing.assert_array_equal(index.lengths(xs, ys, ls, p), brute)
+        np.testing.assert_allclose(index.dists(xs, ys, p), po.min_dists((xs, ys), new_es, new_ts, 0.4, 0.7),
+                                   rtol=1E-12)
+
+    index = po.PathIndex(es, ts, 0.4, 0.7, segments=True, p=p)
+    np.testing.assert_allclose(index.dists(xs, ys, p), _segment_dists(xs, ys, new_es, new_ts, 0.4, 0.7),
+                               rtol=1E-10, atol=1E-12)
+
+def test_path_index_ties_take_lowest_index():
+    es = np.array([0.0, 1.0, 0.0, 1.0])
+    ts = np.array([0.0, 0.0, 0.0, 0.0])
+    index = po.PathIndex(es, ts, 1.0, 1.0)
+    _, idx, _ = index.query(np.array([0.0, 1.0, 0.5]), np.zeros(3))
+    assert idx.tolist() == [0, 1, 0]
+
+def test_make_func_tree_matches_brute():
+    _, es, ts, xs, ys = _trace(500, 2000, 3, noise=0.2)
+    brute = po.make_func((xs, ys), es, ts, 0.5, 0.5)
+    tree = po.make_func((xs, ys), es, ts, 0.5, 0.5, method='tree')
+    brute_grad = po.make_func_grad((xs, ys), es, ts, 0.5, 0.5)
+    tree_grad = po.make_func_grad((xs, ys), es, ts, 0.5, 0.5, method='tree')
+    for p in ([1.0, 0.0, 1.0], [1.0005, 0.01, 0.9995], [1.2, -0.3, 0.7], [-1.0, 0.1, 1.0]):
+        np.testing.assert_allclose(tree(p), brute(p), rtol=1E-12)
+        loss, grad = brute_grad(p)
+        np.testing.assert_allclose(loss, brute(p), rtol=1E-12)
+        np.testing.assert_allclose(tree_grad(p)[1], grad, rtol=1E-9, atol=1E-12)
+        fd = []
+        for i in range(3):
+            h = np.zeros(3)
+            h[i] = 1E-7
+            fd.append((brute(np.add(p, h)) - brute(np.subtract(p, h))) / 2E-7)
+        np.testing.assert_allclose(grad, fd, rtol=1E-4, atol=1E-6)
+
+def test_get_lengths_from_curve():
+    from cavspy import cavity
+    curve = (0.99, 10E6, 0.5, 1.55E-6, 0.8, 0.1, 0.3, 0.7, -1E-8, 1E-8, 501)
+    ls, es, ts = cavity.pdh_curve(*curve)
+    rng = np.random.default_rng(5)
+    idx = rng.integers(0, len(ls), 1000)
+    xs = es[idx] + rng.normal(0, 1E-3, len(idx))
+    ys = ts[idx] + rng.normal(0, 1E-3, len(idx))
+    p = [1.1, 0.01, 0.9]
+    np.testing.assert_array_equal(po.get_lengths((xs, ys), None, None, 1.0, 1.0, None, p, curve=curve),
+                                  po.get_lengths((xs, ys), es, ts, 1.0, 1.0, ls, p))
@@ -0,0 +1,123 @@
+import struct
+import numpy as np
+import pytest
+
+from cavspy import data
+from cavspy import tttr
+
+def _write_tags(f, magic, tags):
+    f.write(magic.ljust(8, b'\0'))
+    f.write(b'1.0'.ljust(8, b'\0'))
+    for name, typ, value in tags + [('Header_End', tttr.ty_empty8, 0)]:
+        name, idx = (name.split('(')[0], int(name.split('(')[1][:-1])) if '(' in name else (name, -1)
+        if typ == tttr.ty_float8:
+            value = struct.unpack('<q', struct.pack('<d', value))[0]
+        f.write(tttr._tag.pack(name.encode('ascii'), idx, typ, value))
+
+def _write_ptu(path, rec_type, records, res=4E-12, glob_res=1E-9, sync_rate=0):
+    with open(path, 'wb') as f:
+        _write_tags(f, b'PQTTTR', [
+            ('TTResultFormat_TTTRRecType', tttr.ty_int8, rec_type),
+            ('TTResult_NumberOfRecords', tttr.ty_int8, len(records)),
+            ('MeasDesc_Resolution', tttr.ty_float8, res),
+            ('MeasDesc_GlobalResolution', tttr.ty_float8, glob_res),
+            ('TTResult_SyncRate', tttr.ty_int8, sync_rate)])
+        f.write(np.asarray(records, dtype='<u4').tobytes())
+
+def _picoharp_t3(rng, n):
+    # Photons on channels 1-4 with overflows every so often
+    channel = rng.integers(1, 5, n).astype(np.uint32)
+    dtime = rng.integers(0, 4096, n).astype(np.uint32)
+    nsync = rng.integers(0, 65536, n).astype(np.uint32)
+    overflow = rng.random(n) < 0.1
+    channel[overflow] = 0xF
+    dtime[overflow] = 0
+    return (channel << 28) | (dtime << 16) | nsync
+
+# Record by record decoding, as in PicoQuant's demo code
+def _slow_t3(records):
+    ofl = 0
+    out = []
+    for rec in records:
+        rec = int(rec)
+        channel = rec >> 28
+        dtime = (rec >> 16) & 0xFFF
+        nsync = rec & 0xFFFF
+        if channel == 0xF:
+            if dtime == 0:
+                ofl += 65536
+            continue
+        out.append((ofl + nsync, dtime, channel))
+    return out
+
+def test_decode_picoharp_t3_matches_record_loop():
+    rng = np.random.default_rng(0)
+    records = _picoharp_t3(rng, 5000)
+    first, ofl = tttr.decode_records(records[:2000], tttr.rt_picoharp_t3)
+    second, _ = tttr.decode_records(records[2000:], tttr.rt_picoharp_t3, ofl)
+    fast = [(int(t), int(d), int(c)) for dec in (first, second)
+            for t, d, c in zip(dec['time'][dec['photon']], dec['dtime'][dec['photon']],
+                               dec['channel'][dec['photon']])]
+    assert fast == _slow_t3(records)
+
+def test_read_ptu_t3_histogram(tmp_path):
+    rng = np.random.default_rng(1)
+    records = _picoharp_t3(rng, 20000)
+    path = str(tmp_path / 'decay.ptu')
+    _write_ptu(path, tttr.rt_picoharp_t3, records)
+    photons = np.array([d for _, d, c in _slow_t3(records) if c == 2])
+
+    hist = tttr.read_ptu(path, channel=2, binning=8, chunk_size=999)
+    assert len(hist) == 512
+    np.testing.assert_array_equal(hist['counts'], np.bincount(photons // 8, minlength=512))
+    np.testing.assert_allclose(hist['times'][:2], [0.016, 0.048])
+    # Same file found by its magic bytes
+    np.testing.assert_array_equal(data.read(path, channel=2, binning=8)['counts'], hist['counts'])
+
+def test_read_ptu_t3_bins_capped_by_dtime(tmp_path):
+    rng = np.random.default_rng(2)
+    path = str(tmp_path / 'slow.ptu')
+    # One sync period spans 25000 bins, but dtime only reaches 4096
+    _write_ptu(path, tttr.rt_picoharp_t3, _picoharp_t3(rng, 100), sync_rate=10**7)
+    assert len(tttr.read_ptu(path)) == 4096
+    assert len(tttr.read_ptu(path, binning=3)) == 1366
+    _write_ptu(path, tttr.rt_picoharp_t3, _picoharp_t3(rng, 100), sync_rate=10**9)
+    assert len(tttr.read_ptu(path)) == 250
+
+def test_read_ptu_t2_delays_across_chunks(tmp_path):
+    # HydraHarp V2 T2: syncs are special records on channel 0
+    syncs = np.arange(0, 10000, 1000)
+    photons = np.sort(np.random.default_rng(3).integers(0, 10000, 300))
+    times = np.concatenate((syncs, photons))
+    is_sync = np.concatenate((np.ones(len(syncs), bool), np.zeros(len(photons), bool)))
+    order = np.argsort(times, kind='stable')
+    times, is_sync = times[order], is_sync[order]
+    records = np.where(is_sync, (1 << 31) | times, (1 << 25) | times).astype(np.uint32)
+    path = str(tmp_path / 't2.ptu')
+    _write_ptu(path, tttr.rt_hydraharp2_t2, records, glob_res=1E-12, sync_rate=10**9)
+
+    hist = tttr.read_ptu(path, chunk_size=7)
+    np.testing.assert_array_equal(hist['counts'], np.bincount(photons % 1000, minlength=1000))
+
+def test_read_phu(tmp_path):
+    counts = np.arange(100, dtype=np.uint32)
+    path = str(tmp_path / 'hist.phu')
+    with open(path, 'wb') as f:
+        _write_tags(f, b'PQHISTO', [
+            ('HistResDscr_HistogramBins(0)', tttr.ty_int8, len(counts)),
+            ('HistResDscr_MDescResolution(0)', tttr.ty_float8, 1E-11),
+            ('HistResDscr_DataOffset(0)', tttr.ty_int8, 0)])
+        offset = f.tell()
+    # Point the data offset at the end of the header
+    with open(path, 'r+b') as f:
+        f.seek(16 + 2 * tttr._tag.size)
+        f.write(tttr._tag.pack(b'HistResDscr_DataOffset', 0, tttr.ty_int8, offset))
+        f.seek(offset)
+        f.write(counts.tobytes())
+    hist = data.read(path)
+    np.testing.assert_array_equal(hist['counts'], counts)
+    np.testing.assert_allclose(hist['times'][1], 0.015)
+
+def test_unknown_record_type():
+    with pytest.raises(ValueError):
+        tttr.decode_records(np.zeros(3, dtype=np.uint32), 0x1234)
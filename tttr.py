@@ -0,0 +1,318 @@
+import struct
+import numpy as np
+import pandas as pd
+
+#######################
+# PicoQuant Tag Files #
+#######################
+# Both .ptu (time tagged) and .phu (histogram) files start with an 8 byte
+# magic string and 8 byte version, followed by a list of tags:
+#   32 byte name, int32 index, uint32 type, 8 byte value
+# Tags whose value is a length are followed by that many bytes of data.
+# See PicoQuant's file format demos for details.
+ty_empty8      = 0xFFFF0008
+ty_bool8       = 0x00000008
+ty_int8        = 0x10000008
+ty_bitset64    = 0x11000008
+ty_color8      = 0x12000008
+ty_float8      = 0x20000008
+ty_datetime    = 0x21000008
+ty_float8array = 0x2001FFFF
+ty_ansistring  = 0x4001FFFF
+ty_widestring  = 0x4002FFFF
+ty_binaryblob  = 0xFFFFFFFF
+
+_tag = struct.Struct('<32siIq')
+
+# TTTR record types
+rt_picoharp_t3     = 0x00010303
+rt_picoharp_t2     = 0x00010203
+rt_hydraharp_t3    = 0x00010304
+rt_hydraharp_t2    = 0x00010204
+rt_hydraharp2_t3   = 0x01010304
+rt_hydraharp2_t2   = 0x01010204
+rt_timeharp260n_t3 = 0x00010305
+rt_timeharp260n_t2 = 0x00010205
+rt_timeharp260p_t3 = 0x00010306
+rt_timeharp260p_t2 = 0x00010206
+rt_multiharp_t3    = 0x00010307
+rt_multiharp_t2    = 0x00010207
+
+# Record types laid out like the HydraHarp V2 records, and
+# the two original HydraHarp types with their older overflow handling.
+_hydra_t3 = [rt_hydraharp_t3, rt_hydraharp2_t3, rt_timeharp260n_t3,
+             rt_timeharp260p_t3, rt_multiharp_t3]
+_hydra_t2 = [rt_hydraharp_t2, rt_hydraharp2_t2, rt_timeharp260n_t2,
+             rt_timeharp260p_t2, rt_multiharp_t2]
+_hydra_v1 = [rt_hydraharp_t3, rt_hydraharp_t2]
+
+def read_tags(filename):
+    """
+    Reads the header tags of a PicoQuant .ptu or .phu file.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the file.
+
+    Returns
+    -------
+    dict, int
+        The tags, keyed by name, with "name(idx)" used for indexed tags,
+        and the byte offset at which the header ends.
+    """
+    tags = {}
+    with open(filename, 'rb') as f:
+        magic = f.read(8).rstrip(b'\0').decode('ascii', errors='replace')
+        version = f.read(8).rstrip(b'\0').decode('ascii', errors='replace')
+        tags['Magic'] = magic
+        tags['Version'] = version
+        while True:
+            raw = f.read(_tag.size)
+            if len(raw) < _tag.size:
+                raise ValueError("Reached end of %s before Header_End" % filename)
+            name, idx, typ, value = _tag.unpack(raw)
+            name = name.rstrip(b'\0').decode('ascii', errors='replace')
+            if idx > -1:
+                name = "%s(%d)" % (name, idx)
+
+            if typ in (ty_float8, ty_datetime):
+                value = struct.unpack('<d', struct.pack('<q', value))[0]
+            elif typ == ty_bool8:
+                value = bool(value)
+            elif typ == ty_float8array:
+                value = np.frombuffer(f.read(value), dtype='<f8')
+            elif typ == ty_ansistring:
+                value = f.read(value).rstrip(b'\0').decode('latin-1')
+            elif typ == ty_widestring:
+                value = f.read(value).decode('utf-16-le').rstrip('\0')
+            elif typ == ty_binaryblob:
+                value = f.read(value)
+            tags[name] = value
+
+            if name == 'Header_End':
+                return tags, f.tell()
+
+###################
+# Record Decoding #
+###################
+def decode_records(records, rec_type, ofl=0):
+    """
+    Decodes a block of raw 32 bit TTTR records.
+    Overflow records are unwrapped into absolute sync counts (T3) or
+    time tags (T2) with a cumulative sum, so no python loop is needed.
+
+    Parameters
+    ----------
+    records : np.array
+        uint32 records, as stored in the file.
+    rec_type : int
+        The TTResultFormat_TTTRRecType tag of the file.
+    ofl : int, optional
+        Overflow correction carried over from the previous block, by default 0
+
+    Returns
+    -------
+    dict, int
+        Decoded records with keys:
+         - 'time' : absolute sync count (T3) or time tag (T2) of each record.
+         - 'dtime' : start-stop time in units of the resolution (T3 only, else None).
+         - 'channel' : channel of each record.
+         - 'photon' : mask of photon records.
+         - 'sync' : mask of sync records (T2 only, else all False).
+         - 'marker' : mask of marker records.
+        along with the overflow correction to carry over to the next block.
+    """
+    records = np.asarray(records, dtype=np.uint32)
+    if rec_type == rt_picoharp_t3:
+        nsync = records & 0xFFFF
+        dtime = (records >> 16) & 0xFFF
+        channel = records >> 28
+        special = channel == 0xF
+        overflow = special & (dtime == 0)
+        marker = special & (dtime != 0)
+        wraps = overflow * np.uint64(65536)
+        time = nsync
+    elif rec_type == rt_picoharp_t2:
+        time = records & 0x0FFFFFFF
+        dtime = None
+        channel = records >> 28
+        special = channel == 0xF
+        overflow = special & ((time & 0xF) == 0)
+        marker = special & ((time & 0xF) != 0)
+        wraps = overflow * np.uint64(210698240)
+    elif rec_type in _hydra_t3 or rec_type in _hydra_t2:
+        t3 = rec_type in _hydra_t3
+        if t3:
+            time = records & 0x3FF
+            dtime = (records >> 10) & 0x7FFF
+            wrap = 1024
+        else:
+            time = records & 0x1FFFFFF
+            dtime = None
+            wrap = 33552000 if rec_type in _hydra_v1 else 33554432
+        channel = (records >> 25) & 0x3F
+        special = (records >> 31) == 1
+        overflow = special & (channel == 0x3F)
+        marker = special & (channel >= 1) & (channel <= 15)
+        if rec_type in _hydra_v1:
+            wraps = overflow * np.uint64(wrap)
+        else:
+            # Newer overflow records hold how many overflows happened.
+            wraps = overflow * np.maximum(time, 1).astype(np.uint64) * np.uint64(wrap)
+    else:
+        raise ValueError("Unknown TTTR record type %#010x" % rec_type)
+
+    if rec_type == rt_picoharp_t3 or rec_type in _hydra_t3:
+        sync = np.zeros(len(records), dtype=bool)
+    elif rec_type == rt_picoharp_t2:
+        # Sync input is recorded as channel 0
+        sync = channel == 0
+    else:
+        sync = special & (channel == 0)
+
+    ofls = np.cumsum(wraps, dtype=np.uint64) + np.uint64(ofl)
+    time = ofls + time
+    photon = ~special & ~sync
+    new_ofl = int(ofls[-1]) if len(ofls) else ofl
+    return {'time' : time,
+            'dtime' : dtime,
+            'channel' : channel,
+            'photon' : photon,
+            'sync' : sync,
+            'marker' : marker}, new_ofl
+
+def iter_records(filename, chunk_size=2**24):
+    """
+    Memory-maps the records of a .ptu file and yields them decoded,
+    chunk_size records at a time, see decode_records.
+
+    Yields
+    ------
+    dict
+        Decoded records of each chunk.
+    """
+    tags, offset = read_tags(filename)
+    rec_type = tags['TTResultFormat_TTTRRecType']
+    n = tags['TTResult_NumberOfRecords']
+    records = np.memmap(filename, dtype='<u4', mode='r', offset=offset, shape=(n,))
+    ofl = 0
+    for start in range(0, n, chunk_size):
+        decoded, ofl = decode_records(records[start:start+chunk_size], rec_type, ofl)
+        yield decoded
+
+##############
+# Histograms #
+##############
+def read_ptu(filename, channel=None, binning=1, bins=None, cntr_time=True, chunk_size=2**24, **kwargs):
+    """
+    Builds a lifetime histogram from a PicoQuant .ptu time tagged file.
+    The file is memory-mapped and decoded chunk_size records at a time, so
+    only one chunk is ever in memory. For T3 files the histogram is of the
+    recorded start-stop times, for T2 files it's of the time from the most
+    recent sync to each photon.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the .ptu file.
+    channel : int or [int], optional
+        Only count photons on these channels, by default all of them.
+    binning : int, optional
+        Number of resolution steps per histogram bin, by default 1
+    bins : int, optional
+        Number of histogram bins, by default enough to cover one sync period,
+        but no more than the range of the start-stop time for T3 files.
+    cntr_time : bool, optional
+        If True, times are given at the center of each bin, by default True
+    chunk_size : int, optional
+        Number of records decoded at once, by default 2**24
+
+    Returns
+    -------
+    pd.DataFrame
+        Histogram with columns "times" (ns) and "counts", like read_tcspc.
+    """
+    tags, _ = read_tags(filename)
+    rec_type = tags['TTResultFormat_TTTRRecType']
+    t3 = rec_type == rt_picoharp_t3 or rec_type in _hydra_t3
+    if t3:
+        res = tags['MeasDesc_Resolution']
+        dtime_bins = 4096 if rec_type == rt_picoharp_t3 else 32768
+    else:
+        res = tags['MeasDesc_GlobalResolution']
+    width = res * binning
+
+    if bins is None:
+        sync_rate = tags.get('TTResult_SyncRate', 0)
+        if sync_rate > 0:
+            bins = int(np.ceil(1 / (sync_rate * width)))
+            # Start-stop times can't go past the range of the dtime field.
+            if t3:
+                bins = min(bins, int(np.ceil(dtime_bins / binning)))
+        elif t3:
+            bins = int(np.ceil(dtime_bins / binning))
+        else:
+            raise ValueError("No sync rate in %s, number of bins must be given" % filename)
+    if channel is not None:
+        channel = np.atleast_1d(channel)
+
+    counts = np.zeros(bins, dtype=np.int64)
+    last_sync = None
+    for rec in iter_records(filename, chunk_size):
+        photon = rec['photon']
+        if channel is not None:
+            photon = photon & np.isin(rec['channel'], channel)
+
+        if t3:
+            delays = rec['dtime'][photon]
+        else:
+            # Time since the most recent sync, including ones from earlier chunks.
+            syncs = rec['time'][rec['sync']]
+            if last_sync is not None:
+                syncs = np.concatenate(([last_sync], syncs))
+            times = rec['time'][photon]
+            before = np.searchsorted(syncs, times, side='right') - 1
+            keep = before >= 0
+            delays = times[keep] - syncs[before[keep]]
+            if len(syncs):
+                last_sync = syncs[-1]
+
+        idx = delays // binning
+        idx = idx[idx < bins]
+        counts += np.bincount(idx.astype(np.intp), minlength=bins)
+
+    return _histogram(counts, width, cntr_time)
+
+def read_phu(filename, curve=0, cntr_time=True, **kwargs):
+    """
+    Reads one histogram curve from a PicoQuant .phu histogram file.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the .phu file.
+    curve : int, optional
+        Which curve in the file to read, by default 0
+    cntr_time : bool, optional
+        If True, times are given at the center of each bin, by default True
+
+    Returns
+    -------
+    pd.DataFrame
+        Histogram with columns "times" (ns) and "counts", like read_tcspc.
+    """
+    tags, _ = read_tags(filename)
+    offset = tags['HistResDscr_DataOffset(%d)' % curve]
+    bins = tags['HistResDscr_HistogramBins(%d)' % curve]
+    res = tags['HistResDscr_MDescResolution(%d)' % curve]
+    counts = np.fromfile(filename, dtype='<u4', count=bins, offset=offset)
+    return _histogram(counts, res, cntr_time)
+
+# Histogram counts with bin width given in seconds into read_tcspc's format.
+def _histogram(counts, width, cntr_time):
+    ns_per_chn = width * 1E9
+    times = np.arange(len(counts)) * ns_per_chn
+    if cntr_time:
+        times += ns_per_chn/2
+    return pd.DataFrame({'times' : times, 'counts' : counts})